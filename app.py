@@ -1,78 +1,207 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import os
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+import datetime
+import functools
+import hashlib
+import shutil
+import click
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.exceptions import RequestEntityTooLarge
 from dotenv import load_dotenv
-from sqlalchemy import text
-from database import init_db, db, Category, Subcategory, Rules, RuleActions, RuleConditions # Import from database.py
-from data_processor import process_files, get_remaining_imports, delete_gifts_import, add_transaction, get_account_summary_view, logger# Import from file_processor.py
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import selectinload
+from database import init_db, bootstrap_db, create_transaction_objects, schema_ready, db, pool_stats, set_database_role, Category, Subcategory, Rules, RuleActions, RuleConditions # Import from database.py
+from rules_engine import categorise_transactions, normalise_conditions, preview_rule, PREVIEW_PAGE_SIZE
+from import_jobs import submit_import, get_import_job, cancel_queued_jobs as cancel_queued_import_jobs, fail_interrupted_jobs as fail_interrupted_import_jobs
+from rule_jobs import submit_recategorise, get_rule_job, cancel_queued_jobs as cancel_queued_rule_jobs, fail_interrupted_jobs as fail_interrupted_rule_jobs
+from search import search_transactions
+from migrations import run_migrations, schema_version, latest_version
+from cache import cached, invalidate, ACCOUNTS, CATEGORIES, RULES
+from perf import init_perf
+from manifest import forget_files
+from uploads import remove_spooled_uploads, spool_uploads, stream_uploads
+from data_processor import get_import_accounts, process_files, get_import_page, get_import_summary, IMPORT_PAGE_SIZE, delete_gifts_import, add_transaction, get_account_summary_view, get_balance_history, reconcile_account_balances, refresh_balance_snapshots, engine, logger# Import from file_processor.py
 
 load_dotenv() 
 
-app = Flask(__name__, static_folder='static')
-app.config['UPLOAD_FOLDER'] = 'import'
-app.config['ALLOWED_EXTENSIONS'] = {'gifts'}
-app.secret_key = os.getenv('SECRET_KEY', 'your_default_secret_key')  # Use the secret key from .env or a default value
+# Routes and CLI commands, registered on the app by create_app
+bp = Blueprint('main', __name__, cli_group=None)
+
+# Dummy users database, hashed on first login rather than at import (hashing takes ~150ms)
+@functools.cache
+def users():
+    return {
+        'user': generate_password_hash('password')  # username: user, password: password
+    }
 
-# Initialize the database
-init_db(app)
+MAX_BALANCE_HISTORY_DAYS = 366 * 20
 
-# Dummy users database
-users = {
-    'user': generate_password_hash('password')  # username: user, password: password
-}
+# Static files are served by the blueprint with a content hash in the URL (?v=), see static_version
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', 365 * 24 * 3600))
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
-@app.route('/')
+@bp.route('/')
 def index():
     if 'username' in session:
         return render_template('index.html')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        user_password_hash = users.get(username)
+        user_password_hash = users().get(username)
 
         if user_password_hash and check_password_hash(user_password_hash, password):
             session['username'] = username
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         else:
             return "Invalid username or password", 403
 
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.pop('username', None)
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/accounts')
+@bp.route('/accounts')
 def accounts():
     if 'username' in session:
-        rows = get_account_summary_view()
+        rows = cached((ACCOUNTS,), 'account_summary', lambda: [tuple(row) for row in get_account_summary_view()])
         return render_template('accounts.html', rows=rows)
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/expenses')
+@bp.route('/api/accounts/<account_number>/balance_history')
+def account_balance_history(account_number):
+    if 'username' in session:
+        interval = request.args.get('interval', 'daily')
+        if interval not in ['daily', 'monthly']:
+            return jsonify({'error': f'Invalid interval: {interval}'}), 400
+        try:
+            end = datetime.date.fromisoformat(request.args['end']) if request.args.get('end') else datetime.date.today()
+            start = datetime.date.fromisoformat(request.args['start']) if request.args.get('start') else end - datetime.timedelta(days=90)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid date: {e}'}), 400
+        if start > end:
+            return jsonify({'error': 'start must be on or before end'}), 400
+        if (end - start).days > MAX_BALANCE_HISTORY_DAYS:
+            return jsonify({'error': f'Date range is limited to {MAX_BALANCE_HISTORY_DAYS} days'}), 400
+
+        rows = get_balance_history(account_number, start, end, interval)
+        if rows is None:
+            return jsonify({'error': 'Account not found'}), 404
+        return jsonify({
+            'account_number': account_number,
+            'interval': interval,
+            'balances': [{'date': row.day.isoformat(), 'balance': float(row.balance)} for row in rows]
+        })
+    return jsonify({'error': 'Unauthorized'}), 403
+
+@bp.route('/api/db/pool')
+def database_pool():
+    if 'username' in session:
+        return jsonify(pool_stats())
+    return jsonify({'error': 'Unauthorized'}), 403
+
+@bp.route('/api/transactions/search')
+def transactions_search():
+    if 'username' in session:
+        try:
+            with engine.connect() as conn:
+                page = search_transactions(conn, request.args.get('q'), request.args.get('cursor'), request.args.get('limit', PREVIEW_PAGE_SIZE))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(page)
+    return jsonify({'error': 'Unauthorized'}), 403
+
+@bp.route('/expenses')
 def expenses():
     if 'username' in session:
         return render_template('expenses.html')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/import')
+@bp.route('/import')
 def import_data():
     if 'username' in session:
-        rows = get_remaining_imports()
-        table_empty = len(rows) == 0
-        return render_template('import.html', is_table_empty=table_empty, rows=rows)
-    return redirect(url_for('login'))
+        accounts = get_import_accounts()
+        return render_template('import.html', is_table_empty=len(accounts) == 0, accounts=accounts)
+    return redirect(url_for('main.login'))
+
+def import_filter_args(values=None):
+    # Staged row filters from the query string, or from a form or JSON body. Raises ValueError.
+    values = request.args if values is None else values
+    def optional(name, convert):
+        value = values.get(name)
+        return convert(value) if value not in (None, '') else None
+    return {
+        'account': values.get('account') or None,
+        'min_duplicates': optional('min_duplicates', int),
+        'max_duplicates': optional('max_duplicates', int),
+        'near_duplicates': values.get('near_duplicates') in (True, 'true'),
+        'covered': values.get('covered') in (True, 'true'),
+        'date_from': optional('date_from', datetime.date.fromisoformat),
+        'date_to': optional('date_to', datetime.date.fromisoformat),
+    }
+
+def import_selection_args():
+    # (ids, filters) for bulk accept and reject. A form posts checked rows as selected_rows, a JSON
+    # body may give ids and any import_filter_args. Rows must match both the ids and the filters.
+    if request.is_json:
+        values = request.get_json()
+        ids = values.get('ids')
+    else:
+        values = request.form
+        ids = values.getlist('selected_rows') if 'selected_rows' in values else None
+    return ids, import_filter_args(values)
+
+def bulk_import_response(action, count):
+    # JSON callers get the count, the review page form is sent back to the page
+    if request.is_json:
+        return jsonify({action: count})
+    return redirect(url_for('main.import_data'))
+
+@bp.route('/api/imports')
+def import_rows():
+    if 'username' in session:
+        try:
+            run = request.args.get('run')
+            page = get_import_page(
+                **import_filter_args(),
+                run=int(run) if run else None,
+                sort=request.args.get('sort', 'date'),
+                descending=request.args.get('order') == 'desc',
+                cursor=request.args.get('cursor'),
+                limit=request.args.get('limit', IMPORT_PAGE_SIZE),
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(page)
+    return jsonify({'error': 'Unauthorized'}), 403
+
+@bp.route('/api/imports/summary')
+def import_summary():
+    if 'username' in session:
+        try:
+            summary = get_import_summary(
+                **import_filter_args(),
+                cursor=request.args.get('cursor'),
+                limit=request.args.get('limit', IMPORT_PAGE_SIZE),
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(summary)
+    return jsonify({'error': 'Unauthorized'}), 403
 
-@app.route('/api/expenses', methods=['POST'])
+@bp.route('/api/expenses', methods=['POST'])
 def add_expense():
     if 'username' in session:
         new_expense = request.json
@@ -80,43 +209,57 @@ def add_expense():
         return jsonify(new_expense), 201
     return jsonify({'error': 'Unauthorized'}), 403
 
-@app.route('/api/import_data', methods=['POST'])
+@bp.route('/api/import_data', methods=['POST'])
 def upload_files():
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+
     # Check if the post request has the file part
-    if 'files' not in request.files:
-        flash('No file part')
-        return redirect(request.url)
-    
-    # Get the list of files from the request
-    files = request.files.getlist('files')
-    
-    # Check if any files were selected
-    if not files or all(file.filename == '' for file in files):
-        flash('No selected files')
-        return redirect(request.url)
-    
-    # Process each file in the list
-    for file in files:
-        # Check if the file is allowed based on its extension
-        if file and allowed_file(file.filename):
-            # Secure the filename and save the file to the upload folder
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            flash(f'File {filename} successfully uploaded')
-        else:
-            flash('Allowed file types are .gifts')
-    
-    # Get the list of files in the upload folder
-    upload_folder = app.config['UPLOAD_FOLDER']
-    uploaded_files = [os.path.join(upload_folder, f) for f in os.listdir(upload_folder) if os.path.isfile(os.path.join(upload_folder, f))]
-    
-    # Process the uploaded files
-    process_files(uploaded_files)
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'No file part'}), 400
+
+    def allowed_files(files):
+        # Check if each file is allowed based on its extension before any of it is read
+        for filename, lines in files:
+            if not allowed_file(filename):
+                raise ValueError('Allowed file types are .gifts')
+            yield secure_filename(filename), lines
+
+    # Stream only the files of this request from the body to a spool folder, checking their type,
+    # size and encoding on the way. Parsing and loading them is left to the import job, so the
+    # request takes as long as the body takes to arrive and a failure leaves nothing staged.
+    try:
+        folder, paths = spool_uploads(allowed_files(stream_uploads(request.stream, boundary)))
+    except RequestEntityTooLarge as e:
+        return jsonify({'error': e.description}), 413
+    except ValueError as e:
+        # Includes UnicodeDecodeError for files that are not utf-8 text
+        return jsonify({'error': str(e)}), 400
 
-    # Redirect to the index page after processing
-    return redirect(url_for('import_data'))
+    # Check if any files were selected
+    if not paths:
+        return jsonify({'error': 'No selected files'}), 400
+
+    # Load and merge the files in the background, the client polls /api/import_jobs/<id>
+    try:
+        job_id = submit_import(folder, paths)
+    except OperationalError as e:
+        shutil.rmtree(folder, ignore_errors=True)
+        logger.error(f"Import job could not be created: {e}")
+        return jsonify({'error': 'The database is unavailable, try the upload again'}), 503
+    return jsonify({'job_id': job_id, 'status_url': url_for('main.import_job_status', job_id=job_id)}), 202
+
+@bp.route('/api/import_jobs/<int:job_id>')
+def import_job_status(job_id):
+    if 'username' in session:
+        job = get_import_job(job_id)
+        if not job:
+            return jsonify({'error': 'Import job not found'}), 404
+        return jsonify(job)
+    return jsonify({'error': 'Unauthorized'}), 403
 
-@app.route('/api/expenses/<int:expense_id>', methods=['PUT'])
+@bp.route('/api/expenses/<int:expense_id>', methods=['PUT'])
 def update_expense(expense_id):
     if 'username' in session:
         updated_expense = request.json
@@ -127,53 +270,167 @@ def update_expense(expense_id):
         return jsonify({'error': 'Expense not found'}), 404
     return jsonify({'error': 'Unauthorized'}), 403
 
-@app.route('/static/<path:filename>')
+@functools.lru_cache(maxsize=256)
+def file_hash(path, mtime_ns):
+    # Keyed on the modification time so an edited file gets a new hash without a restart
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()[:12]
+
+def static_version(filename):
+    path = safe_join(STATIC_FOLDER, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    return file_hash(path, os.stat(path).st_mtime_ns)
+
+@bp.app_url_defaults
+def add_static_version(endpoint, values):
+    # url_for('main.serve_static', filename=...) links to the current content of the file
+    if endpoint == 'main.serve_static' and 'v' not in values:
+        version = static_version(values.get('filename', ''))
+        if version:
+            values['v'] = version
+
+@bp.route('/static/<path:filename>')
 def serve_static(filename):
-    return send_from_directory('static', filename)
+    # A URL carrying the file's current hash never changes content, so it is cached for a year.
+    # Anything else is revalidated against the ETag on every use.
+    versioned = request.args.get('v') is not None and request.args.get('v') == static_version(filename)
+    response = send_from_directory(STATIC_FOLDER, filename, max_age=STATIC_MAX_AGE if versioned else None)
+    if versioned:
+        response.cache_control.immutable = True
+    return response
 
 
-@app.route('/api/add_duplicate_transaction', methods=['POST'])
+@bp.route('/api/add_duplicate_transaction', methods=['POST'])
 def add_duplicate_transaction():
-    selected_rows = request.form.getlist('selected_rows')
-    add_transaction(selected_rows,)
-    return redirect(url_for('import_data'))
+    if 'username' in session:
+        try:
+            ids, filters = import_selection_args()
+            accepted = add_transaction(ids, **filters)
+        except ValueError as e:
+            if request.is_json:
+                return jsonify({'error': str(e)}), 400
+            return redirect(url_for('main.import_data'))
+        return bulk_import_response('accepted', accepted)
+    return jsonify({'error': 'Unauthorized'}), 403
 
-@app.route('/api/delete_duplicate_transaction', methods=['POST'])
+@bp.route('/api/delete_duplicate_transaction', methods=['POST'])
 def delete_duplicate_transaction():
-    selected_rows = request.form.getlist('selected_rows')
-    delete_gifts_import(selected_rows,)
-    return redirect(url_for('import_data'))
+    if 'username' in session:
+        try:
+            ids, filters = import_selection_args()
+            deleted = delete_gifts_import(ids, **filters)
+        except ValueError as e:
+            if request.is_json:
+                return jsonify({'error': str(e)}), 400
+            return redirect(url_for('main.import_data'))
+        return bulk_import_response('deleted', deleted)
+    return jsonify({'error': 'Unauthorized'}), 403
 
-@app.route('/delete_all_duplicate_transactions', methods=['POST'])
+@bp.route('/delete_all_duplicate_transactions', methods=['POST'])
 def delete_all_duplicate_transactions():
-    delete_gifts_import("*")
-    return redirect(url_for('import_data'))
+    if 'username' in session:
+        delete_gifts_import("*")
+        return redirect(url_for('main.import_data'))
+    return redirect(url_for('main.login'))
+
+@bp.cli.command('reconcile-balances')
+@click.option('--rebuild', is_flag=True, help='Rebuild account_balances from transactions when it does not match.')
+def reconcile_balances_command(rebuild):
+    """Check account_balances against the full transactions aggregate."""
+    set_database_role('worker')
+    mismatches = reconcile_account_balances(rebuild=rebuild)
+    if not mismatches:
+        click.echo('account_balances matches transactions.')
+        return
+    for row in mismatches:
+        click.echo(f"{row.account_number}: stored {row.stored_balance} ({row.stored_count}), expected {row.expected_balance} ({row.expected_count})")
+    click.echo('Rebuilt account_balances.' if rebuild else f'{len(mismatches)} accounts differ, rerun with --rebuild to fix.')
+    if not rebuild:
+        raise SystemExit(1)
+
+@bp.cli.command('apply-rules')
+def apply_rules_command():
+    """Categorise every transaction that has no category yet."""
+    set_database_role('worker')
+    with engine.connect() as conn:
+        click.echo(f'Wrote {categorise_transactions(conn)} transaction categories.')
+
+@bp.cli.command('refresh-snapshots')
+def refresh_snapshots_command():
+    """Create any missing month end balance snapshots."""
+    set_database_role('worker')
+    click.echo(f'Created {refresh_balance_snapshots()} balance snapshots.')
+
+@bp.cli.command('forget-import')
+@click.argument('file_name')
+def forget_import_command(file_name):
+    """Remove a file from the import manifest so it can be imported again."""
+    set_database_role('worker')
+    with engine.connect() as conn:
+        click.echo(f'Removed {forget_files(conn, file_name)} manifest entries for {file_name}.')
+
+@bp.cli.command('import-files')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', type=int, default=None, help='Worker processes that load the files, defaults to IMPORT_FILE_WORKERS.')
+def import_files_command(paths, workers):
+    """Load .gifts exports from disk and merge them, as an upload would."""
+    set_database_role('worker')
+    results = process_files(list(paths), workers=workers)
+    for result in results:
+        for error in result['errors']:
+            click.echo(error)
+    click.echo(f"Loaded {sum(result['loaded'] for result in results)} rows from {len(results)} files.")
 
 def currency_format(value):
     return "${:,.2f}".format(value)
 
-app.jinja_env.filters['currency'] = currency_format
+bp.add_app_template_filter(currency_format, 'currency')
 
 ### Categories
 
-@app.route('/categories')
+# Pages are rendered from plain data rather than model instances so it can be cached across requests.
+# Relationships are loaded with one SELECT ... IN per relationship, so a page costs the same number
+# of queries however many rows it shows (see benchmark.py queries).
+
+def load_categories():
+    return [
+        {
+            'id': c.id, 'name': c.name,
+            'subcategories': [{'id': sc.id, 'name': sc.name, 'category_id': sc.category_id} for sc in c.subcategories],
+        }
+        for c in Category.query.options(selectinload(Category.subcategories)).all()
+    ]
+
+def load_rules():
+    return [
+        {
+            'id': r.id, 'name': r.name, 'description': r.description,
+            'conditions': [{'field': c.field, 'operator': c.operator, 'value': c.value} for c in r.conditions],
+            'actions': [{'category_id': a.category_id, 'subcategory_id': a.subcategory_id} for a in r.actions],
+        }
+        for r in Rules.query.options(selectinload(Rules.conditions), selectinload(Rules.actions)).all()
+    ]
+
+@bp.route('/categories')
 def categories():
     if 'username' in session:
-        categories = Category.query.all()
+        categories = cached((CATEGORIES,), 'categories', load_categories)
         return render_template('categories.html', categories=categories)
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/add_category', methods=['POST'])
+@bp.route('/add_category', methods=['POST'])
 def add_category():
     if 'username' in session:
         category_name = request.form['category_name']
         new_category = Category(name=category_name)
         db.session.add(new_category)
         db.session.commit()
-        return redirect(url_for('categories'))
-    return redirect(url_for('login'))
+        invalidate(CATEGORIES)
+        return redirect(url_for('main.categories'))
+    return redirect(url_for('main.login'))
 
-@app.route('/add_subcategory', methods=['POST'])
+@bp.route('/add_subcategory', methods=['POST'])
 def add_subcategory():
     if 'username' in session:
         category_id = request.form['category_id']
@@ -181,10 +438,11 @@ def add_subcategory():
         new_subcategory = Subcategory(name=subcategory_name, category_id=category_id)
         db.session.add(new_subcategory)
         db.session.commit()
-        return redirect(url_for('categories'))
-    return redirect(url_for('login'))
+        invalidate(CATEGORIES)
+        return redirect(url_for('main.categories'))
+    return redirect(url_for('main.login'))
 
-@app.route('/edit_category', methods=['POST'])
+@bp.route('/edit_category', methods=['POST'])
 def edit_category():
     if 'username' in session:
         category_id = request.form['category_id']
@@ -192,9 +450,10 @@ def edit_category():
         category = Category.query.get(category_id)
         category.name = category_name
         db.session.commit()
-        return redirect(url_for('categories'))
-    return redirect(url_for('login'))
-@app.route('/edit_subcategory', methods=['POST'])
+        invalidate(CATEGORIES)
+        return redirect(url_for('main.categories'))
+    return redirect(url_for('main.login'))
+@bp.route('/edit_subcategory', methods=['POST'])
 def edit_subcategory():
     if 'username' in session:
         subcategory_id = request.form['subcategory_id']
@@ -202,41 +461,42 @@ def edit_subcategory():
         subcategory = Subcategory.query.get(subcategory_id)
         subcategory.name = subcategory_name
         db.session.commit()
-        return redirect(url_for('categories'))
-    return redirect(url_for('login'))
-@app.route('/delete_category/<int:category_id>')
+        invalidate(CATEGORIES)
+        return redirect(url_for('main.categories'))
+    return redirect(url_for('main.login'))
+@bp.route('/delete_category/<int:category_id>')
 def delete_category(category_id):
     if 'username' in session:
         category = Category.query.get(category_id)
         db.session.delete(category)
         db.session.commit()
-        return redirect(url_for('categories'))
-    return redirect(url_for('login'))
+        invalidate(CATEGORIES)
+        return redirect(url_for('main.categories'))
+    return redirect(url_for('main.login'))
 
-@app.route('/delete_subcategory/<int:subcategory_id>')
+@bp.route('/delete_subcategory/<int:subcategory_id>')
 def delete_subcategory(subcategory_id):
     if 'username' in session:
         subcategory = Subcategory.query.get(subcategory_id)
         db.session.delete(subcategory)
         db.session.commit()
-        return redirect(url_for('categories'))
-    return redirect(url_for('login'))
+        invalidate(CATEGORIES)
+        return redirect(url_for('main.categories'))
+    return redirect(url_for('main.login'))
 
 
 ### Rules
 
-@app.route('/rules')
+@bp.route('/rules')
 def rules():
     if 'username' in session:
-        rules = Rules.query.all()
-        categories = Category.query.all()
-        subcategories = Subcategory.query.all()
-        categories_dict = [{'id': c.id, 'name': c.name} for c in categories]
-        subcategories_dict = [{'id': sc.id, 'name': sc.name, 'category_id': sc.category_id} for sc in subcategories]
+        rules, categories = cached((RULES, CATEGORIES), 'rules', lambda: (load_rules(), load_categories()))
+        categories_dict = [{'id': c['id'], 'name': c['name']} for c in categories]
+        subcategories_dict = [sc for c in categories for sc in c['subcategories']]
         return render_template('rules.html', rules=rules, categories=categories_dict, subcategories=subcategories_dict)
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/api/rule/<int:rule_id>')
+@bp.route('/api/rule/<int:rule_id>')
 def get_rule(rule_id):
     if 'username' in session:
         rule = Rules.query.get(rule_id)
@@ -251,9 +511,9 @@ def get_rule(rule_id):
             'actions': [{'category_id': a.category_id, 'subcategory_id': a.subcategory_id} for a in rule.actions]
         }
         return jsonify(rule_data)
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/api/add_edit_rule', methods=['POST'])
+@bp.route('/api/add_edit_rule', methods=['POST'])
 def add_edit_rule():
     if 'username' in session:
         rule_id = request.form.get('rule_id')
@@ -268,15 +528,27 @@ def add_edit_rule():
 
         if not rule_name:
             flash('Rule name is required', 'error')
-            return redirect(url_for('rules'))
+            return redirect(url_for('main.rules'))
+
+        # Conditions are checked the way the rules engine compiles them, so a saved rule always runs
+        conditions = [
+            {'field': field, 'operator': operator, 'value': value, 'and_condition': and_condition}
+            for field, operator, value, and_condition in zip(condition_fields, condition_operators, condition_values, condition_and_conditions)
+        ]
+        try:
+            normalise_conditions(conditions)
+        except ValueError as e:
+            flash(f'Rule not saved: {e}', 'error')
+            return redirect(url_for('main.rules'))
 
         if rule_id:
             rule = Rules.query.get(rule_id)
             if not rule:
                 flash('Rule not found', 'error')
-                return redirect(url_for('rules'))
+                return redirect(url_for('main.rules'))
             rule.name = rule_name
             rule.description = rule_description
+            rule.version = (rule.version or 1) + 1
         else:
             rule = Rules(name=rule_name, description=rule_description)
             db.session.add(rule)
@@ -286,14 +558,13 @@ def add_edit_rule():
         RuleActions.query.filter_by(rule_id=rule.id).delete()
 
         # Add new conditions
-        #for field, operator, value, and_condition in zip(condition_fields, condition_operators, condition_values, condition_and_conditions):
-        for field, operator, value, and_condition in zip(condition_fields, condition_operators, condition_values, condition_and_conditions):
+        for condition in conditions:
             condition = RuleConditions(
                 rule_id=rule.id,
-                field=field,
-                operator=operator,
-                value=value,
-                and_condition=True if and_condition.lower() == 'true' else False
+                field=condition['field'],
+                operator=condition['operator'],
+                value=condition['value'],
+                and_condition=True if condition['and_condition'].lower() == 'true' else False
             )
             
             db.session.add(condition)
@@ -306,72 +577,115 @@ def add_edit_rule():
             db.session.add(action)
 
         db.session.commit()
-        flash('Rule saved successfully', 'success')
-        return redirect(url_for('rules'))
-    return redirect(url_for('login'))
-
-@app.route('/delete_rule/<int:rule_id>')
+        invalidate(RULES)
+        # Re-evaluate only the transactions the old or new version of the rule could match
+        job_id = submit_recategorise(rule.id, rule.version)
+        flash(f'Rule saved successfully, updating categories (job {job_id})', 'success')
+        return redirect(url_for('main.rules'))
+    return redirect(url_for('main.login'))
+
+@bp.route('/delete_rule/<int:rule_id>')
 def delete_rule(rule_id):
     if 'username' in session:
         rule = Rules.query.get(rule_id)
         if rule:
             db.session.delete(rule)
             db.session.commit()
-            flash('Rule deleted successfully', 'success')
+            invalidate(RULES)
+            job_id = submit_recategorise(rule_id)
+            flash(f'Rule deleted successfully, updating categories (job {job_id})', 'success')
         else:
             flash('Rule not found', 'error')
-        return redirect(url_for('rules'))
-    return redirect(url_for('login'))
+        return redirect(url_for('main.rules'))
+    return redirect(url_for('main.login'))
+
+@bp.route('/api/rule_jobs/<int:job_id>')
+def rule_job_status(job_id):
+    if 'username' in session:
+        job = get_rule_job(job_id)
+        if not job:
+            return jsonify({'error': 'Rule job not found'}), 404
+        return jsonify(job)
+    return jsonify({'error': 'Unauthorized'}), 403
 
-@app.route('/api/get_associated_transactions', methods=['POST'])
+@bp.route('/api/get_associated_transactions', methods=['POST'])
 def get_associated_transactions():
     if 'username' in session:
         conditions = request.json.get('conditions', [])
         if not conditions:
             return jsonify({'error': 'No conditions provided'}), 400
 
-        query = """
-        SELECT t.*, a.account_name as account_name 
-        FROM transactions t
-        JOIN accounts a ON t.account_number = a.account_number
-        WHERE 
-        """
-        query_conditions = []
-        query_params = {}
-
-        for i, condition in enumerate(conditions):
-            field = condition.get('field')
-            operator = condition.get('operator')
-            value = condition.get('value')
-            and_condition = condition.get('and_condition')
-
-            if operator.lower() not in ['=', '!=', '<', '<=', '>', '>=', 'like']:
-                return jsonify({'error': f'Invalid operator: {operator}'}), 400
-
-            if operator == 'like':
-                value = f"%{value}%"  # Add wildcards for LIKE operator
-
-            param_key = f"value_{i}"
-            if i == 0:
-                query_conditions.append(f"t.{field} {operator} :{param_key}")
-            else:
-                conjunction = 'AND' if and_condition.lower() == 'true' else 'OR'
-                query_conditions.append(f"{conjunction} t.{field} {operator} :{param_key}")
-
-            query_params[param_key] = value
-
-        query += ' '.join(query_conditions)
-        # Log the full SQL query text with parameters
-        logger.info(f"Query: {query}, Params: {query_params}")
-        
-        result = db.session.execute(text(query), query_params).fetchmany(100)
-        transactions = [row._asdict() for row in result]
-
-        return jsonify(transactions)
-    return redirect(url_for('login'))
-
+        try:
+            with engine.connect() as conn:
+                page = preview_rule(conn, conditions, request.json.get('cursor'), request.json.get('limit', PREVIEW_PAGE_SIZE))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        return jsonify(page)
+    return redirect(url_for('main.login'))
+
+
+@bp.cli.command('bootstrap-db')
+def bootstrap_db_command():
+    """Create the database, tables, views and triggers, then apply pending migrations."""
+    set_database_role('worker')
+    started = time.perf_counter()
+    bootstrap_db(current_app)
+    applied = run_migrations(engine)
+    create_transaction_objects()
+    click.echo(f"Applied migrations {', '.join(map(str, applied))}." if applied else 'No pending migrations.')
+    click.echo(f'Database ready in {time.perf_counter() - started:.2f}s.')
+
+startup = {'first_request_done': False}
+
+@bp.before_app_request
+def check_database():
+    # The first request in each process checks the schema exists and is migrated (no DDL) and reports
+    # how long the process took to serve it. Until bootstrap-db has run every request gets a 503.
+    if startup['first_request_done']:
+        return None
+    if not schema_ready() or schema_version(engine) < latest_version():
+        logger.error("Database schema is missing or out of date, run flask bootstrap-db")
+        return "Database not initialised or out of date, run flask bootstrap-db", 503
+    startup['first_request_done'] = True
+    logger.info(f"Startup: first request {time.perf_counter() - IMPORT_STARTED:.3f}s after import started")
+    return None
+
+def create_app():
+    # Static files are served by main.serve_static rather than Flask's own static route
+    app = Flask(__name__, static_folder=None)
+    app.config['ALLOWED_EXTENSIONS'] = {'gifts'}
+    app.secret_key = os.getenv('SECRET_KEY', 'your_default_secret_key')  # Use the secret key from .env or a default value
+
+    # Connections are only opened when first used, provisioning is flask bootstrap-db
+    init_db(app)
+    init_perf(app)
+    app.register_blueprint(bp)
+
+    logger.info(f"Startup: app created {time.perf_counter() - IMPORT_STARTED:.3f}s after import started")
+    return app
+
+def recover_interrupted_jobs():
+    # Once per server start, before any worker takes requests (gunicorn.conf.py when_ready): jobs
+    # left queued or running by the previous server are marked failed and their uploads removed
+    try:
+        imports, rules = fail_interrupted_import_jobs(), fail_interrupted_rule_jobs()
+    except OperationalError as e:
+        logger.warning(f"Could not check for interrupted jobs: {e}")
+        return
+    spooled = remove_spooled_uploads()
+    if imports or rules or spooled:
+        logger.warning(f"Marked {imports} import jobs and {rules} rule jobs interrupted by a restart as failed, removed {spooled} spooled uploads")
+
+def cancel_queued_jobs():
+    # When a worker process stops (gunicorn.conf.py worker_exit)
+    imports, rules = cancel_queued_import_jobs(), cancel_queued_rule_jobs()
+    if imports or rules:
+        logger.warning(f"Cancelled {imports} queued import jobs and {rules} queued rule jobs, the worker is stopping")
 
 if __name__ == '__main__':
+    app = create_app()
+    recover_interrupted_jobs()
     app.run(host='0.0.0.0', port=5000)
 
     
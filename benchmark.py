@@ -0,0 +1,479 @@
+import argparse
+import csv
+import datetime
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import text
+from data_processor import engine, process_files, process_transactions
+from database import database_role, ensure_transaction_partitions
+from gifts_parser import GIFTS_FIELDNAMES, parse_gifts
+from rules_engine import categorise_transactions, normalise_conditions, preview_statement
+from search import search_query, search_statement
+from app import create_app
+from perf import percentile, track_sql
+import cache
+
+# Benchmarks for the import pipeline. These TRUNCATE the transactions and gifts_import tables,
+# so point POSTGRES_DB at a throwaway database before running them, e.g.
+#   POSTGRES_DB=simplebudget_bench python benchmark.py merge --existing 10000 100000 1000000 --force
+
+def seed_transactions(conn, count, accounts=3):
+    conn.execute(text("TRUNCATE transactions, gifts_import RESTART IDENTITY CASCADE"))
+    ensure_transaction_partitions(conn, datetime.date(2020, 1, 1), datetime.date(2020, 1, 1) + datetime.timedelta(days=1499))
+    conn.execute(text("""
+        INSERT INTO transactions (
+            "account_number", "amount", "date", "payee", "particulars", "code", "reference", "transaction_type", "destination_account_number"
+        )
+        SELECT
+            'bench-' || (i % :accounts), (i % 1000) - 500, DATE '2020-01-01' + (i % 1500), 'PAYEE ' || (i % 300),
+            'part ' || (i % 40), '', 'ref' || i, 'DD', 'dest-' || (i % 50)
+        FROM generate_series(1, :count) AS i
+    """), {'count': count, 'accounts': accounts})
+
+def stage_rows(conn, count, existing):
+    # Half of the staged rows repeat existing transactions, the other half are new
+    conn.execute(text("""
+        INSERT INTO gifts_import (
+            "record_type", "internal_reference", "source_account_number", "amount", "unknown", "transaction_reference",
+            "particulars", "code", "reference", "payee", "date", "optional", "transaction_type", "misc_field",
+            "destination_account_number", "consecutive_duplicates"
+        )
+        SELECT
+            3, i, 'bench-' || (n % 3), (n % 1000) - 500, 0, i,
+            'part ' || (n % 40), '', CASE WHEN i % 2 = 0 THEN 'ref' || n ELSE 'new' || i END, 'PAYEE ' || (n % 300),
+            DATE '2020-01-01' + (n % 1500), '', 'DD', 0, 'dest-' || (n % 50), 0
+        FROM generate_series(1, :count) AS i
+        CROSS JOIN LATERAL (SELECT (i * 7919) % GREATEST(:existing, 1) + 1 AS n) picked
+        ORDER BY i
+    """), {'count': count, 'existing': existing})
+
+def bench_merge(args):
+    results = []
+    for existing in args.existing:
+        for mode in args.modes:
+            with engine.connect() as conn:
+                seed_transactions(conn, existing)
+                stage_rows(conn, args.staged, existing)
+                conn.execute(text("ANALYZE transactions"))
+                conn.execute(text("ANALYZE gifts_import"))
+
+            started = time.perf_counter()
+            process_transactions(mode)
+            elapsed = time.perf_counter() - started
+
+            with engine.connect() as conn:
+                remaining = conn.execute(text("SELECT COUNT(*) FROM gifts_import")).scalar()
+            results.append((existing, mode, elapsed, remaining))
+            print(f"existing={existing} staged={args.staged} mode={mode} seconds={elapsed:.3f} "
+                  f"rows_per_second={args.staged / elapsed:.0f} duplicates={remaining}", flush=True)
+    return results
+
+def seed_rules(conn, count):
+    # Rules that look like hand written ones: payee equals, particulars contains, amount below,
+    # chained with a mix of AND and OR
+    conn.execute(text("TRUNCATE rules, rule_conditions, rule_actions, transactions_categories, category, subcategory RESTART IDENTITY CASCADE"))
+    conn.execute(text("INSERT INTO category (name) SELECT 'Category ' || i FROM generate_series(1, 20) AS i"))
+    conn.execute(text("INSERT INTO rules (name) SELECT 'Rule ' || i FROM generate_series(1, :count) AS i"), {'count': count})
+    conn.execute(text("""
+        INSERT INTO rule_conditions (rule_id, field, operator, value, and_condition)
+        SELECT i, 'payee', '=', 'PAYEE ' || (i % 300), false FROM generate_series(1, :count) AS i
+        UNION ALL
+        SELECT i, 'particulars', 'like', 'part ' || (i % 40), i % 2 = 0 FROM generate_series(1, :count) AS i
+        UNION ALL
+        SELECT i, 'amount', '<', ((i % 7) * -50)::text, true FROM generate_series(1, :count) AS i WHERE i % 3 = 0
+    """), {'count': count})
+    conn.execute(text("""
+        INSERT INTO rule_actions (rule_id, category_id) SELECT i, (i % 20) + 1 FROM generate_series(1, :count) AS i
+    """), {'count': count})
+
+def bench_rules(args):
+    results = []
+    for transactions in args.transactions:
+        for rules in args.rules:
+            with engine.connect() as conn:
+                seed_transactions(conn, transactions)
+                seed_rules(conn, rules)
+                conn.execute(text("ANALYZE transactions"))
+
+            started = time.perf_counter()
+            with engine.connect() as conn:
+                categorised = categorise_transactions(conn)
+            elapsed = time.perf_counter() - started
+            results.append((transactions, rules, elapsed, categorised))
+            print(f"transactions={transactions} rules={rules} seconds={elapsed:.3f} "
+                  f"rows_per_second={transactions / elapsed:.0f} categorised={categorised}", flush=True)
+    return results
+
+def bench_search(args):
+    # Times the search and `like` preview queries, tests/test_plans.py checks their plans
+    with engine.connect() as conn:
+        seed_transactions(conn, args.transactions)
+        conn.execute(text("ANALYZE transactions"))
+
+        shape, values = normalise_conditions([{'field': 'reference', 'operator': 'like', 'value': args.term}])
+        queries = [
+            ('search', search_statement(False), {'query': search_query(args.term), 'limit': 101}),
+            ('like', preview_statement(shape, False), {'value_0': values[0], 'limit': 101}),
+        ]
+        results = []
+        for name, statement, params in queries:
+            started = time.perf_counter()
+            rows = len(conn.execute(statement, params).fetchall())
+            elapsed = time.perf_counter() - started
+            results.append((name, elapsed))
+            print(f"query={name} transactions={args.transactions} rows={rows} seconds={elapsed:.4f}", flush=True)
+    return results
+
+SYNTHETIC_START = datetime.date(2023, 1, 1)
+SYNTHETIC_PAYEES = ['COUNTDOWN', 'NEW WORLD', 'Z ENERGY', 'SALARY', 'RENT', 'PAK N SAVE', 'SPARK', 'WATERCARE']
+
+def synthetic_account(index):
+    return f"12-3456-{index + 1:07d}-00"
+
+def parse_record_mix(value):
+    # "3:98,6:2" -> {3: 98.0, 6: 2.0}, weights of the record types of the lines after the headers
+    try:
+        return {int(record_type): float(weight) for record_type, weight in (part.split(':') for part in value.split(','))}
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"expected record_type:weight,... not {value}") from e
+
+def generate_gifts_files(folder, files=1, accounts=1, lines=1000, record_mix=None, duplicate_ratio=0.0, days=365, seed=1):
+    # Synthetic bank exports: lines new lines spread over files files and accounts accounts, dated
+    # over days days with each file covering the next slice of the span. Every file starts with a
+    # record type 5 header per account. Each file after the first repeats the last duplicate_ratio
+    # of the previous file's lines, the way overlapping exports do. Only record type 3 lines are
+    # transactions, the rest are staged and dropped. Returns the file paths.
+    rng = random.Random(seed)
+    record_mix = record_mix or {3: 98, 6: 2}
+    record_types, weights = list(record_mix), list(record_mix.values())
+    per_file = -(-lines // files)
+    paths = []
+    previous = []
+    for index in range(files):
+        first_day = days * index // files
+        last_day = max(first_day, days * (index + 1) // files - 1)
+        body = []
+        for i in range(min(per_file, lines - index * per_file)):
+            day = rng.randint(first_day, last_day)
+            date = (SYNTHETIC_START + datetime.timedelta(days=day)).strftime('%d/%m/%y')
+            account = synthetic_account(rng.randrange(accounts))
+            amount = rng.randint(-50000, 50000) / 100
+            record_type = rng.choices(record_types, weights)[0]
+            if record_type == 3:
+                payee = rng.choice(SYNTHETIC_PAYEES)
+                line = (f"3,{i},{account},{amount:.2f},0,{i},{payee[:12]},,ref{rng.randrange(100)},{payee},{date},,DD,0,"
+                        f"99-0000-{rng.randrange(9999):04d}-00")
+            else:
+                line = f"{record_type},0,{account},{amount:.2f},0,0,,,,,{date},,,0,"
+            body.append((day, line))
+        body.sort(key=lambda dated: dated[0])
+        overlap = previous[len(previous) - int(len(previous) * duplicate_ratio):] if duplicate_ratio else []
+
+        path = os.path.join(folder, f"synthetic-{index + 1:03d}.gifts")
+        with open(path, 'w') as file:
+            opened = (SYNTHETIC_START + datetime.timedelta(days=first_day)).strftime('%d/%m/%y')
+            for account in range(accounts):
+                file.write(f"5,0,{synthetic_account(account)},1000.00,0,0,,,,Account {account + 1},{opened},,,0,\n")
+            for _, line in overlap + body:
+                file.write(line + '\n')
+        paths.append(path)
+        previous = body
+    return paths
+
+def legacy_parse(file):
+    # The csv.DictReader and per-row strptime path process_file used before gifts_parser
+    reader = csv.DictReader(file, fieldnames=GIFTS_FIELDNAMES)
+    for row in reader:
+        try:
+            row['record_type'] = int(row['record_type']) if row['record_type'] else 0
+            row['internal_reference'] = int(row['internal_reference']) if row['internal_reference'] else 0
+            row['unknown'] = int(row['unknown']) if row['unknown'] else 0
+            row['transaction_reference'] = int(row['transaction_reference']) if row['transaction_reference'] else 0
+            row['misc_field'] = int(row['misc_field']) if row['misc_field'] else 0
+            row['amount'] = float(row['amount']) if row['amount'] else None
+            row['date'] = datetime.datetime.strptime(row['date'], '%d/%m/%y') if row['date'] else None
+        except ValueError:
+            continue
+        yield tuple(row[name] for name in GIFTS_FIELDNAMES)
+
+def bench_parse(args):
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        path, = generate_gifts_files(folder, lines=args.lines - 1, record_mix={3: 1})
+        for name, parser in [('legacy', legacy_parse), ('gifts_parser', parse_gifts)]:
+            best = None
+            for _ in range(args.repeat):
+                with open(path, 'r', newline='') as file:
+                    started = time.perf_counter()
+                    count = sum(1 for _ in parser(file))
+                    elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            results.append((name, count, best))
+            print(f"parser={name} lines={count} seconds={best:.3f} rows_per_second={count / best:.0f}", flush=True)
+    return results
+
+def count_lines(path):
+    with open(path) as file:
+        return sum(1 for _ in file)
+
+def reset_pipeline_tables(conn):
+    # TRUNCATE does not fire the account_balances triggers, so the derived tables are emptied too.
+    # The manifest is emptied so the same generated files are imported again rather than skipped.
+    conn.execute(text("""
+        TRUNCATE transactions, gifts_import, accounts, payees, account_balances, account_balance_snapshots, import_jobs, import_manifest
+        RESTART IDENTITY CASCADE
+    """))
+
+def read_endpoints(args):
+    # (name, method, path, json body) of the read paths timed after each import
+    end = SYNTHETIC_START + datetime.timedelta(days=min(args.days, 366) - 1)
+    return [
+        ('accounts', 'GET', '/accounts', None),
+        ('rules', 'GET', '/rules', None),
+        ('balance_history', 'GET', f"/api/accounts/{synthetic_account(0)}/balance_history?start={SYNTHETIC_START}&end={end}", None),
+        ('import_rows', 'GET', '/api/imports?limit=100', None),
+        ('import_summary', 'GET', '/api/imports/summary?limit=100', None),
+        ('search', 'GET', '/api/transactions/search?q=countdown&limit=100', None),
+        ('rule_preview', 'POST', '/api/get_associated_transactions', {'conditions': [{'field': 'payee', 'operator': '=', 'value': 'COUNTDOWN'}]}),
+    ]
+
+def emit(record, output=None):
+    # One JSON object per line, on stdout and appended to output
+    line = json.dumps(record, sort_keys=True)
+    print(line, flush=True)
+    if output:
+        with open(output, 'a') as file:
+            file.write(line + '\n')
+
+def bench_pipeline(args):
+    # An upload's import job as the app runs it (process_files on the spooled files, with the
+    # worker role) then the read endpoints, at each --lines scale.
+    # Reads go through the Flask test client with the page cache cleared, so each one runs its queries.
+    client = create_app().test_client()
+    with client.session_transaction() as session:
+        session['username'] = 'bench'
+    run = {'benchmark': 'pipeline', 'label': args.label, 'files': args.files, 'accounts': args.accounts,
+           'duplicate_ratio': args.duplicate_ratio, 'days': args.days}
+    results = []
+    for lines in args.lines:
+        with engine.connect() as conn:
+            reset_pipeline_tables(conn)
+            seed_rules(conn, args.rules)
+        with tempfile.TemporaryDirectory() as folder:
+            paths = generate_gifts_files(folder, args.files, args.accounts, lines, args.record_mix, args.duplicate_ratio, args.days)
+            staged = sum(count_lines(path) for path in paths)
+            started = time.perf_counter()
+            with track_sql(f"Benchmark import of {lines} lines") as stats, database_role('worker'):
+                process_files(paths)
+            elapsed = time.perf_counter() - started
+        with engine.connect() as conn:
+            inserted = conn.execute(text("SELECT COUNT(*) FROM transactions")).scalar()
+        record = {**run, 'lines': lines, 'name': 'upload', 'rows': staged, 'inserted': inserted,
+                  'seconds': round(elapsed, 3), 'rows_per_second': round(staged / elapsed), 'statements': stats.statements,
+                  'db_seconds': round(stats.seconds, 3)}
+        emit(record, args.output)
+        results.append(record)
+
+        client.get('/login')
+        for name, method, path, body in read_endpoints(args):
+            latencies = []
+            statements = []
+            for _ in range(args.requests):
+                cache.cache.clear()
+                started = time.perf_counter()
+                response = client.open(path, method=method, json=body)
+                latencies.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 200:
+                    sys.exit(f"{method} {path} returned {response.status_code}")
+                statements.append(int(response.headers['Server-Timing'].split('desc="')[1].split()[0]))
+            latencies.sort()
+            record = {**run, 'lines': lines, 'name': name, 'requests': args.requests,
+                      'p50_ms': round(percentile(latencies, 0.5), 2), 'p95_ms': round(percentile(latencies, 0.95), 2),
+                      'statements': max(statements)}
+            emit(record, args.output)
+            results.append(record)
+    return results
+
+# Lower is better for these, higher for rows_per_second
+COMPARE_METRICS = {'rows_per_second': False, 'p50_ms': True, 'p95_ms': True, 'statements': True}
+
+def load_results(path):
+    with open(path) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    return {(record['benchmark'], record['lines'], record['name']): record for record in records}
+
+def bench_compare(args):
+    # Matches the records of two --output files on (benchmark, lines, name) and fails when a metric
+    # got worse by more than --tolerance
+    before, after = load_results(args.before), load_results(args.after)
+    regressions = []
+    for key in sorted(before.keys() & after.keys()):
+        for metric, lower_is_better in COMPARE_METRICS.items():
+            if metric not in before[key] or metric not in after[key] or not before[key][metric]:
+                continue
+            change = after[key][metric] / before[key][metric] - 1
+            worse = change if lower_is_better else -change
+            if worse > args.tolerance:
+                regressions.append(f"{key[2]}@{key[1]} {metric}")
+            print(f"benchmark={key[0]} lines={key[1]} name={key[2]} metric={metric} before={before[key][metric]} "
+                  f"after={after[key][metric]} change={change:+.1%}", flush=True)
+    if regressions:
+        sys.exit(f"regressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+    return regressions
+
+# Run in a fresh interpreter so module imports are cold
+STARTUP_PROBE = """
+import time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+status = application.test_client().get('/login').status_code
+first_request = time.perf_counter()
+print(imported - started, created - started, first_request - started, status)
+"""
+
+def bench_startup(args):
+    results = []
+    for _ in range(args.repeat):
+        output = subprocess.run([sys.executable, '-c', STARTUP_PROBE], capture_output=True, text=True, check=True).stdout
+        imported, created, first_request, status = output.split()[-4:]
+        results.append((float(imported), float(created), float(first_request), int(status)))
+        print(f"import_seconds={float(imported):.3f} create_app_seconds={float(created):.3f} "
+              f"first_request_seconds={float(first_request):.3f} status={status}", flush=True)
+    return results
+
+SERVERS = {
+    'dev': ['flask', '--app', 'app', 'run', '--port', '{port}'],
+    'gunicorn': ['gunicorn', '-c', 'gunicorn.conf.py', '--bind', '127.0.0.1:{port}', '--access-logfile', '/dev/null'],
+}
+
+def wait_for_server(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not start in {timeout}s")
+
+def load_client(port, paths, seconds):
+    # One client: logs in, then requests the paths in turn over a keep-alive connection until
+    # the time is up. Returns (requests, errors).
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('POST', '/login', urllib.parse.urlencode({'username': 'user', 'password': 'password'}),
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    headers = {'Cookie': response.getheader('Set-Cookie', '').split(';')[0]}
+    requests = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        conn.request('GET', paths[requests % len(paths)], headers=headers)
+        response = conn.getresponse()
+        response.read()
+        requests += 1
+        errors += response.status >= 400
+        if response.will_close:
+            conn.close()
+    return requests, errors
+
+def bench_serve(args):
+    # Throughput of the dev server and gunicorn under the same concurrent load. Each client is a
+    # separate process so the load generator is not limited by one interpreter.
+    results = []
+    for server in args.servers:
+        command = [part.format(port=args.port) for part in SERVERS[server]]
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(args.port)
+            with ProcessPoolExecutor(max_workers=args.clients) as clients:
+                futures = [clients.submit(load_client, args.port, args.paths, args.seconds) for _ in range(args.clients)]
+                totals = [future.result() for future in futures]
+        finally:
+            process.terminate()
+            process.wait()
+        requests = sum(done for done, _ in totals)
+        errors = sum(failed for _, failed in totals)
+        results.append((server, requests / args.seconds, errors))
+        print(f"server={server} clients={args.clients} seconds={args.seconds} requests={requests} "
+              f"requests_per_second={requests / args.seconds:.0f} errors={errors}", flush=True)
+    return results
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--force', action='store_true', help='confirm the target database may be truncated')
+    parser = argparse.ArgumentParser(description='Simple Budget import benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    merge = subparsers.add_parser('merge', parents=[common], help='row by row vs set based process_transactions')
+    merge.add_argument('--existing', type=int, nargs='+', default=[10000, 100000, 1000000])
+    merge.add_argument('--staged', type=int, default=2000)
+    merge.add_argument('--modes', nargs='+', default=['row', 'set'], choices=['row', 'set'])
+    merge.set_defaults(run=bench_merge, truncates=True)
+
+    rules = subparsers.add_parser('rules', parents=[common], help='categorise transactions with the rules engine')
+    rules.add_argument('--transactions', type=int, nargs='+', default=[100000])
+    rules.add_argument('--rules', type=int, nargs='+', default=[500])
+    rules.set_defaults(run=bench_rules, truncates=True)
+
+    search = subparsers.add_parser('search', parents=[common], help='search and like preview query times')
+    search.add_argument('--transactions', type=int, default=100000)
+    search.add_argument('--term', default='ref1234')
+    search.set_defaults(run=bench_search, truncates=True)
+
+    parse = subparsers.add_parser('parse', help='legacy DictReader conversion vs gifts_parser, no database needed')
+    parse.add_argument('--lines', type=int, default=500000)
+    parse.add_argument('--repeat', type=int, default=3)
+    parse.set_defaults(run=bench_parse, truncates=False, force=True)
+
+    startup = subparsers.add_parser('startup', help='import, create_app and first request times of a fresh process')
+    startup.add_argument('--repeat', type=int, default=5)
+    startup.set_defaults(run=bench_startup, truncates=False, force=True)
+
+    pipeline = subparsers.add_parser('pipeline', parents=[common], help='synthetic import and read endpoints at several scales, JSON lines output')
+    pipeline.add_argument('--lines', type=int, nargs='+', default=[10000, 100000], help='new .gifts lines per run, spread over --files')
+    pipeline.add_argument('--files', type=int, default=4)
+    pipeline.add_argument('--accounts', type=int, default=5)
+    pipeline.add_argument('--record-mix', type=parse_record_mix, default={3: 98, 6: 2}, help='record_type:weight,... of the non header lines')
+    pipeline.add_argument('--duplicate-ratio', type=float, default=0.1, help='share of each file repeated at the start of the next')
+    pipeline.add_argument('--days', type=int, default=730)
+    pipeline.add_argument('--rules', type=int, default=50)
+    pipeline.add_argument('--requests', type=int, default=20, help='requests per read endpoint')
+    pipeline.add_argument('--label', default='', help='recorded with each result, e.g. a commit')
+    pipeline.add_argument('--output', help='append the JSON lines to this file')
+    pipeline.set_defaults(run=bench_pipeline, truncates=True)
+
+    compare = subparsers.add_parser('compare', help='compare two pipeline --output files')
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.add_argument('--tolerance', type=float, default=0.1, help='fail when a metric is this much worse')
+    compare.set_defaults(run=bench_compare, truncates=False, force=True)
+
+    serve = subparsers.add_parser('serve', help='load test the dev server against gunicorn, needs a bootstrapped database')
+    serve.add_argument('--servers', nargs='+', default=['dev', 'gunicorn'], choices=list(SERVERS))
+    serve.add_argument('--clients', type=int, default=16)
+    serve.add_argument('--seconds', type=int, default=10)
+    serve.add_argument('--port', type=int, default=5099)
+    serve.add_argument('--paths', nargs='+', default=['/accounts', '/login', '/static/css/styles.css'])
+    serve.set_defaults(run=bench_serve, truncates=False, force=True)
+
+    args = parser.parse_args(argv)
+    if args.truncates and not args.force:
+        parser.error('benchmarks truncate transactions and gifts_import, rerun with --force against a throwaway database')
+    args.run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import text
+from database import logger, engine
+
+# Read-through cache for data that only changes on import or when categories and rules are edited.
+# Each data set has a version counter that its write paths bump (see invalidate). Entries are kept
+# per process, keyed by the version they were loaded at, so a bump in any worker makes every worker
+# reload on its next read. CACHE_TTL bounds how stale an entry can get if a write skips the bump.
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 256))
+CACHE_TTL = float(os.getenv('CACHE_TTL', 300))
+# 'postgres' shares the version counters between worker processes, 'local' keeps them in process
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'postgres')
+
+# Data sets
+ACCOUNTS = 'accounts'
+CATEGORIES = 'categories'
+RULES = 'rules'
+
+class PostgresVersions:
+    # Version counters in the cache_versions table (migrations/0003_cache_versions.sql)
+    def get(self, names):
+        with engine.connect() as conn:
+            versions = dict(conn.execute(text("""
+                SELECT name, version FROM cache_versions WHERE name = ANY(:names)
+            """), {'names': list(names)}).fetchall())
+        return {name: versions.get(name, 0) for name in names}
+
+    def bump(self, names):
+        with engine.connect() as conn:
+            conn.execute(text("""
+                INSERT INTO cache_versions (name, version)
+                SELECT name, 1 FROM unnest(CAST(:names AS TEXT[])) AS name
+                ON CONFLICT (name) DO UPDATE SET version = cache_versions.version + 1
+            """), {'names': list(names)})
+
+class LocalVersions:
+    # Stand-in for a single process, or when the database should not be touched
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versions = {}
+
+    def get(self, names):
+        with self.lock:
+            return {name: self.versions.get(name, 0) for name in names}
+
+    def bump(self, names):
+        with self.lock:
+            for name in names:
+                self.versions[name] = self.versions.get(name, 0) + 1
+
+class LRUCache:
+    # Bounded, thread safe, least recently used first out, entries expire ttl seconds after loading
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        # (True, value) on a hit, (False, None) on a miss or an expired entry
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+versions = LocalVersions() if CACHE_BACKEND == 'local' else PostgresVersions()
+cache = LRUCache(CACHE_MAX_ENTRIES, CACHE_TTL)
+
+def cached(names, key, loader):
+    # loader() for the data sets in names, from the cache while none of their versions has changed.
+    # The versions are read before loading, so a bump during a load leaves the entry under the old
+    # versions where it is never read again.
+    current = versions.get(names)
+    cache_key = (key, tuple(current[name] for name in names))
+    hit, value = cache.get(cache_key)
+    if hit:
+        return value
+    value = loader()
+    cache.set(cache_key, value)
+    return value
+
+def invalidate(*names):
+    # Call after the write has committed, otherwise a reader could cache the old data under the new version
+    versions.bump(names)
+    logger.debug(f"Invalidated cached {', '.join(names)}")
@@ -1,141 +1,395 @@
-import datetime
 import os
-import csv
+import io
+import base64
+import json
+import datetime
 import logging
-from sqlalchemy import create_engine, text
-from database import logger
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from sqlalchemy import text
+from database import logger, engine, set_database_role, ensure_transaction_partitions
+from gifts_parser import GIFTS_FIELDNAMES, RECORD_TYPE, SOURCE_ACCOUNT_NUMBER, DATE, parse_gifts, write_reject_report
+from rules_engine import categorise_transactions
+from duplicates import DUPLICATE_MATCH_COLUMNS, detect_near_duplicates, existing_duplicates_query
+from cache import invalidate, ACCOUNTS
+from manifest import ALL_STAGED, FileManifest, covered_ranges, file_checksum, identical_file, staged_scope, unmerged_manifests, mark_merged
+
+# Rows are buffered and sent to Postgres with COPY in chunks of this size
+COPY_CHUNK_SIZE = int(os.getenv('IMPORT_COPY_CHUNK_SIZE', 10000))
+
+# Lines that fail conversion are listed in <file>.rejects.csv in this folder. Reports older than
+# IMPORT_REJECT_RETENTION_DAYS are deleted when the next report is written (0 keeps them all).
+IMPORT_REJECT_FOLDER = os.getenv('IMPORT_REJECT_FOLDER', 'rejects')
+IMPORT_REJECT_RETENTION_DAYS = float(os.getenv('IMPORT_REJECT_RETENTION_DAYS', 30))
+
+# Files of an upload or of flask import-files are parsed and loaded by this many worker processes
+IMPORT_FILE_WORKERS = int(os.getenv('IMPORT_FILE_WORKERS', min(4, os.cpu_count() or 1)))
+
+# Staged rows are merged in file order then line order. Parallel loads interleave ids, so id alone
+# is not file order; rows staged before file_seq existed have no file_seq and sort first by id.
+STAGED_ROW_ORDER = 'gi.file_seq NULLS FIRST, gi.line_number, gi.id'
+
+# Import review sort keys: the SQL expression (NULLs coalesced so keyset comparisons hold) and how
+# a cursor value is converted back to it
+IMPORT_SORTS = {
+    'id': ('gi.id', int),
+    'date': ("COALESCE(gi.date, DATE '1900-01-01')", datetime.date.fromisoformat),
+    'amount': ('COALESCE(gi.amount, 0)', float),
+    'payee': ("COALESCE(gi.payee, '')", str),
+    'consecutive_duplicates': ('COALESCE(gi.consecutive_duplicates, 0)', int),
+}
+IMPORT_PAGE_SIZE = 100
+IMPORT_MAX_PAGE_SIZE = 500
 
-POSTGRES_USER = os.getenv('POSTGRES_USER')
-POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-POSTGRES_DB = os.getenv('POSTGRES_DB')
-POSTGRES_HOST = os.getenv('POSTGRES_HOST')
+# Staged rows numbered by run of consecutive duplicates: a run starts at every row that is not
+# the second or later duplicate in a row, in merge order
+IMPORT_RUNS = f"""
+    SELECT gi.*,
+        COUNT(*) FILTER (WHERE COALESCE(gi.consecutive_duplicates, 0) <= 1) OVER (ORDER BY {STAGED_ROW_ORDER}) AS duplicate_run
+    FROM gifts_import gi
+"""
 
-DATABASE_URI = f'postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}'
-engine = create_engine(DATABASE_URI, isolation_level="AUTOCOMMIT")
+def _copy_value(value):
+    # CSV COPY: unquoted \N is NULL, anything quoted is taken literally (so '' stays '')
+    if value is None:
+        return '\\N'
+    return '"' + str(value).replace('"', '""') + '"'
 
-def process_file(file_path):
-    logger.info(f"Processing uploadfile {file_path}.")
+def _copy_rows(cursor, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(','.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(f"""
+        COPY gifts_import ({', '.join(f'"{name}"' for name in GIFTS_FIELDNAMES)}, "consecutive_duplicates", "file_seq", "line_number", "covered")
+        FROM STDIN WITH (FORMAT csv, NULL '\\N')
+    """, buffer)
 
+def report_progress(progress, phase, rows=0, error=None):
+    # progress is an optional callback(phase, rows, error) used by background import jobs
+    if progress:
+        progress(phase, rows, error)
+
+def new_payees_query(scope_sql='TRUE'):
+    # The payee of the latest staged row in scope of each destination account not yet in payees.
+    # The distinct destinations are walked one index probe at a time (gifts_import_payee_window_idx)
+    # and each one's latest row read from the same index, so the staged rows are never read in full
+    # and sorted.
+    return f"""
+        WITH RECURSIVE destinations AS (
+            SELECT (
+                SELECT gi."destination_account_number" FROM gifts_import gi
+                WHERE gi."record_type" = 3 AND gi."destination_account_number" IS NOT NULL AND {scope_sql}
+                ORDER BY gi."destination_account_number" LIMIT 1
+            ) AS account_number
+            UNION ALL
+            SELECT (
+                SELECT gi."destination_account_number" FROM gifts_import gi
+                WHERE gi."record_type" = 3 AND gi."destination_account_number" > d.account_number AND {scope_sql}
+                ORDER BY gi."destination_account_number" LIMIT 1
+            )
+            FROM destinations d
+            WHERE d.account_number IS NOT NULL
+        )
+        SELECT d.account_number, latest.payee
+        FROM destinations d
+        CROSS JOIN LATERAL (
+            SELECT gi.payee FROM gifts_import gi
+            WHERE gi."record_type" = 3 AND gi."destination_account_number" = d.account_number AND {scope_sql}
+            ORDER BY gi.date DESC, gi.file_seq DESC NULLS LAST, gi.line_number DESC, gi.id DESC
+            LIMIT 1
+        ) latest
+        WHERE NOT EXISTS (SELECT 1 FROM payees p WHERE p."account_number" = d.account_number)
+    """
+
+# Only one import may merge staged rows at a time, across threads and worker processes
+MERGE_LOCK_KEY = 727001
+
+@contextmanager
+def import_merge_lock():
     with engine.connect() as conn:
-        if file_path.endswith('.gifts'):
-            with open(file_path, 'r') as file:
-                fieldnames = [
-                    'record_type', 'internal_reference', 'source_account_number', 'amount', 'unknown',
-                    'transaction_reference', 'particulars', 'code', 'reference', 'payee', 'date', 'optional',
-                    'transaction_type', 'misc_field', 'destination_account_number'
-                ]
-                reader = csv.DictReader(file, fieldnames=fieldnames)
-                for row in reader:
-                    # logger.info(f"Processing row: {row}")
-                    insert_query = text("""
-                        INSERT INTO gifts_import (
-                            "record_type", "internal_reference", "source_account_number", "amount", "unknown",
-                            "transaction_reference", "particulars", "code", "reference", "payee", "date", "optional",
-                            "transaction_type", "misc_field", "destination_account_number", "consecutive_duplicates"
-                        ) VALUES (
-                            :record_type, :internal_reference, :source_account_number, :amount, :unknown,
-                            :transaction_reference, :particulars, :code, :reference, :payee, :date, :optional,
-                            :transaction_type, :misc_field, :destination_account_number, 0
-                        )
-                    """)
-                    # Convert the row values to appropriate types
-                    try:
-                        row['record_type'] = int(row['record_type']) if row['record_type'] else 0
-                        row['internal_reference'] = int(row['internal_reference']) if row['internal_reference'] else 0
-                        row['unknown'] = int(row['unknown']) if row['unknown'] else 0
-                        row['transaction_reference'] = int(row['transaction_reference']) if row['transaction_reference'] else 0
-                        row['misc_field'] = int(row['misc_field']) if row['misc_field'] else 0
-                        row['amount'] = float(row['amount']) if row['amount'] else None
-                        row['date'] = datetime.datetime.strptime(row['date'], '%d/%m/%y') if row['date'] else None
-                    except ValueError as e:
-                        logger.error(f"Data type conversion error: {e}")
-                        logger.info(f"Processing row: {row}")
-                        continue
-                    
-                    conn.execute(insert_query, {
-                        'record_type': row['record_type'],
-                        'internal_reference': row['internal_reference'],
-                        'source_account_number': row['source_account_number'],
-                        'amount': row['amount'] if row['amount'] is not None else 0,
-                        'unknown': row['unknown'],
-                        'transaction_reference': row['transaction_reference'],
-                        'particulars': row['particulars'],
-                        'code': row['code'],
-                        'reference': row['reference'],
-                        'payee': row['payee'],
-                        'date': row['date'],
-                        'optional': row['optional'],
-                        'transaction_type': row['transaction_type'],
-                        'misc_field': row['misc_field'],
-                        'destination_account_number': row['destination_account_number']
-                    })
-
-    # Delete the file after processing
-    try:
-        os.remove(file_path)
-        logger.info(f"Deleted file {file_path}.")
-    except OSError as e:
-        logger.error(f"Error deleting file {file_path}: {e}")
-
-
-def process_files(file_paths):
-    for file_path in file_paths:
-        process_file(file_path)
-    process_accounts()
-    process_payees()
-    process_transactions()
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {'key': MERGE_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': MERGE_LOCK_KEY})
+
+def skipped_identical(name, previous, progress=None):
+    # load_gifts result for a file whose content is already in the import manifest
+    error = f"{os.path.basename(name)} is identical to {previous.file_name} imported {previous.imported_at:%Y-%m-%d %H:%M}, skipped"
+    logger.info(error)
+    report_progress(progress, 'parse', error=error)
+    return {'file': name, 'loaded': 0, 'skipped': 0, 'covered': 0, 'errors': [error], 'reject_report': None}
+
+def load_gifts(conn, lines, name, file_seq=None, progress=None):
+    # Parse .gifts lines and COPY them into gifts_import COPY_CHUNK_SIZE rows at a time, on the
+    # caller's transaction, and add the file to the import manifest. A file identical to one
+    # already in the manifest is rolled back and skipped. Lines that fail conversion are logged
+    # and written to a reject report.
+    # The checksum is taken as the lines go by, so an identical file is only recognised once it
+    # has been parsed and copied. process_file checks files on disk before calling this.
+    loaded = 0
+    errors = []
+    rejects = []
+    reject_report = None
+    report_progress(progress, 'parse')
+    started = time.perf_counter()
+    manifest = FileManifest(covered_ranges(conn))
+    with conn.begin_nested() as savepoint:
+        cursor = conn.connection.cursor()
+        chunk = []
+        for record in parse_gifts(manifest.lines(lines), rejects):
+            covered = record[RECORD_TYPE] == 3 and manifest.add(record[SOURCE_ACCOUNT_NUMBER], record[DATE], record[-1])
+            chunk.append(record[:-1] + (0, file_seq, record[-1], covered))
+            if len(chunk) == COPY_CHUNK_SIZE:
+                _copy_rows(cursor, chunk)
+                loaded += len(chunk)
+                report_progress(progress, 'load', len(chunk))
+                chunk = []
+        if chunk:
+            _copy_rows(cursor, chunk)
+            loaded += len(chunk)
+            report_progress(progress, 'load', len(chunk))
+        cursor.close()
+
+        recorded = manifest.record(conn, os.path.basename(name), file_seq) is not None
+        if not recorded:
+            savepoint.rollback()
+    if not recorded:
+        return skipped_identical(name, manifest.identical(conn), progress)
+
+    for reject in rejects:
+        logger.error(f"Data type conversion error: {reject.reason}")
+        logger.info(f"Processing line {reject.line_number}: {reject.raw}")
+        errors.append(f"{os.path.basename(name)} line {reject.line_number}: {reject.reason}")
+        report_progress(progress, 'parse', error=errors[-1])
+    if rejects:
+        reject_report = os.path.join(IMPORT_REJECT_FOLDER, os.path.basename(name) + '.rejects.csv')
+        prune_reject_reports()
+        write_reject_report(reject_report, rejects)
+        logger.info(f"Wrote {len(rejects)} rejected lines to {reject_report}.")
+
+    elapsed = time.perf_counter() - started
+    rate = loaded / elapsed if elapsed > 0 else loaded
+    logger.info(f"Loaded {loaded} rows from {name} in {elapsed:.2f}s ({rate:.0f} rows/s), skipped {len(rejects)}, {manifest.covered} covered by earlier files.")
+    return {'file': name, 'loaded': loaded, 'skipped': len(rejects), 'covered': manifest.covered, 'errors': errors, 'reject_report': reject_report}
+
+def prune_reject_reports():
+    if IMPORT_REJECT_RETENTION_DAYS <= 0 or not os.path.isdir(IMPORT_REJECT_FOLDER):
+        return
+    cutoff = time.time() - IMPORT_REJECT_RETENTION_DAYS * 86400
+    for entry in os.scandir(IMPORT_REJECT_FOLDER):
+        if entry.name.endswith('.rejects.csv') and entry.is_file() and entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+                logger.info(f"Deleted reject report {entry.path}, older than {IMPORT_REJECT_RETENTION_DAYS:g} days.")
+            except OSError as e:
+                logger.warning(f"Could not delete reject report {entry.path}: {e}")
+
+def process_file(file_path, progress=None, file_seq=None):
+    # Load one .gifts file from disk, spooled by an upload or given to flask import-files. The file
+    # is left where it is.
+    logger.info(f"Processing file {file_path}.")
+    result = {'file': file_path, 'loaded': 0, 'skipped': 0, 'covered': 0, 'errors': [], 'reject_report': None}
+
+    if file_path.endswith('.gifts'):
+        # A file already in the manifest is skipped without parsing it
+        with engine.connect() as conn:
+            previous = identical_file(conn, file_checksum(file_path))
+        if previous:
+            return skipped_identical(file_path, previous, progress)
+        # Load the whole file in one transaction so a failure leaves nothing half imported
+        with engine.execution_options(isolation_level="READ COMMITTED").begin() as conn:
+            with open(file_path, 'r', encoding='utf-8', newline='') as file:
+                result = load_gifts(conn, file, file_path, file_seq, progress)
+
+    return result
+
+def allocate_file_seqs(count):
+    with engine.connect() as conn:
+        return [conn.execute(text("SELECT nextval('gifts_import_file_seq')")).scalar() for _ in range(count)]
+
+def _init_file_worker():
+    # Forked workers must not reuse the parent's pooled connections
+    engine.dispose(close=False)
+    set_database_role('worker')
+
+def load_files(file_paths, progress=None, workers=None):
+    workers = IMPORT_FILE_WORKERS if workers is None else workers
+    # Sequence numbers are taken in upload order before loading starts, so the merge order
+    # does not depend on which worker finishes first
+    file_seqs = allocate_file_seqs(len(file_paths))
+    if workers <= 1 or len(file_paths) <= 1:
+        return [process_file(file_path, progress, file_seq) for file_path, file_seq in zip(file_paths, file_seqs)]
+
+    logger.info(f"Loading {len(file_paths)} files with {workers} workers")
+    results = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(file_paths)), initializer=_init_file_worker) as pool:
+        futures = [pool.submit(process_file, file_path, None, file_seq) for file_path, file_seq in zip(file_paths, file_seqs)]
+        for future in as_completed(futures):
+            result = future.result()
+            for error in result['errors']:
+                report_progress(progress, 'parse', error=error)
+            report_progress(progress, 'load', result['loaded'])
+            results.append(result)
+    return results
+
+def process_files(file_paths, progress=None, workers=None):
+    results = load_files(file_paths, progress, workers)
+    merge_staged_rows(progress)
+    return results
+
+def merge_staged_rows(progress=None):
+    # Accounts, payees and transactions from the rows staged in gifts_import when the merge
+    # starts. Files staged while it runs wait for the next merge, their header rows included.
+    with import_merge_lock():
+        with engine.connect() as conn:
+            manifest_ids = unmerged_manifests(conn)
+        scope = staged_scope(manifest_ids)
+        report_progress(progress, 'accounts')
+        process_accounts(scope)
+        report_progress(progress, 'payees')
+        process_payees(scope)
+        report_progress(progress, 'transactions')
+        process_transactions(progress=progress, scope=scope)
+        with engine.connect() as conn:
+            mark_merged(conn, manifest_ids)
+    invalidate(ACCOUNTS)
+    refresh_balance_snapshots()
   
-def process_accounts():
+def process_accounts(scope=ALL_STAGED):
     logger.info(f"process accounts")
+    scope_sql, scope_params = scope
     with engine.connect() as conn:
-        conn.execute(text("""
+        conn.execute(text(f"""
             INSERT INTO accounts ("account_number", "account_name", opening_balance)
-            SELECT DISTINCT "source_account_number", payee, amount
-            FROM gifts_import
-            WHERE "record_type"=5 AND "source_account_number" NOT IN (
+            SELECT DISTINCT gi."source_account_number", gi.payee, gi.amount
+            FROM gifts_import gi
+            WHERE gi."record_type"=5 AND {scope_sql} AND gi."source_account_number" NOT IN (
                 SELECT "account_number" FROM accounts
             )
-        """))
-def process_payees():
+        """), scope_params)
+def process_payees(scope=ALL_STAGED):
     logger.info(f"process payees")
+    scope_sql, scope_params = scope
     with engine.connect() as conn:
-        conn.execute(text("""
-            WITH ranked_payees AS (
-            SELECT 
-                "destination_account_number", 
-                payee,
-                ROW_NUMBER() OVER (PARTITION BY "destination_account_number" ORDER BY date DESC) AS rn
-            FROM gifts_import
-            WHERE "record_type" = 3
-            )
+        conn.execute(text(f"""
             INSERT INTO payees ("account_number", "account_name")
-            SELECT 
-            "destination_account_number", 
-            payee
-            FROM ranked_payees
-            WHERE rn = 1
-            AND "destination_account_number" NOT IN (
-            SELECT "account_number" FROM payees
+            {new_payees_query(scope_sql)}
+        """), scope_params)
+
+        conn.execute(text(f"""
+            DELETE FROM gifts_import gi WHERE gi."record_type" != 3 AND {scope_sql}
+        """), scope_params)
+
+# 'set' merges staged rows with a handful of set-based statements, 'row' is the original per-row loop
+MERGE_MODE = os.getenv('IMPORT_MERGE_MODE', 'set')
+
+def staged_date_range(conn, where='TRUE', params=None):
+    # (first, last) date of the staged transactions matching where, (None, None) when there are none
+    return tuple(conn.execute(text(f"""
+        SELECT MIN(gi.date), MAX(gi.date) FROM gifts_import gi WHERE gi."record_type" = 3 AND {where}
+    """), params or {}).fetchone())
+
+def process_transactions(mode=None, progress=None, scope=ALL_STAGED):
+    mode = mode or MERGE_MODE
+    with engine.connect() as conn:
+        ensure_transaction_partitions(conn, *staged_date_range(conn, *scope))
+        detect_near_duplicates(conn, scope=scope)
+    if mode == 'row':
+        process_transactions_rowwise(progress, scope)
+    elif mode == 'set':
+        process_transactions_setbased(progress, scope)
+    else:
+        raise ValueError(f"Unknown merge mode: {mode}")
+
+def process_transactions_setbased(progress=None, scope=ALL_STAGED):
+    logger.info(f"process transactions (set based)")
+    scope_sql, scope_params = scope
+    started = time.perf_counter()
+    not_null = ' AND '.join(f'gi."{g}" IS NOT NULL' for g, _ in DUPLICATE_MATCH_COLUMNS)
+    partition = ', '.join(f'gi."{g}"' for g, _ in DUPLICATE_MATCH_COLUMNS)
+    with engine.execution_options(isolation_level="READ COMMITTED").begin() as conn:
+        ### The existing check only reads the transactions partitions of the staged years
+        existing, params = existing_duplicates_query(*staged_date_range(conn, f'NOT gi.covered AND {scope_sql}', scope_params), scope)
+        ### Classify every staged row in file order. A row is a duplicate when it matches an existing
+        ### transaction, or an earlier staged row with the same values (which the row loop would have inserted
+        ### first). Rows with a NULL in any match column never compare equal, so they are never duplicates.
+        ### Near duplicates found by detect_near_duplicates, and rows on dates an earlier file covered
+        ### (see manifest.py), are held back for review the same way without the existing check.
+        conn.execute(text(f"""
+            CREATE TEMP TABLE gifts_merge ON COMMIT DROP AS
+            WITH existing AS ({existing})
+            SELECT
+                gi.id,
+                ROW_NUMBER() OVER (ORDER BY {STAGED_ROW_ORDER}) AS merge_order,
+                (gi.covered OR gi.near_duplicate_id IS NOT NULL OR ({not_null} AND (
+                    e.id IS NOT NULL
+                    OR ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY {STAGED_ROW_ORDER}) > 1
+                ))) AS is_duplicate
+            FROM gifts_import gi
+            LEFT JOIN existing e ON e.id = gi.id
+            WHERE gi."record_type" = 3 AND {scope_sql}
+        """), params)
+
+        promoted_ids = conn.execute(text("""
+            INSERT INTO transactions (
+                "account_number", "amount", "date", "payee", "particulars", "code", "reference", "transaction_type", "destination_account_number"
             )
-        """))
+            SELECT gi."source_account_number", gi."amount", gi."date", gi."payee", gi."particulars", gi."code", gi."reference", gi."transaction_type", gi."destination_account_number"
+            FROM gifts_import gi
+            JOIN gifts_merge m ON m.id = gi.id
+            WHERE NOT m.is_duplicate
+            ORDER BY m.merge_order
+            RETURNING id
+        """)).scalars().all()
+        inserted = len(promoted_ids)
 
         conn.execute(text("""
-            DELETE FROM gifts_import WHERE "record_type" != 3
+            DELETE FROM gifts_import gi
+            USING gifts_merge m
+            WHERE gi.id = m.id AND NOT m.is_duplicate
         """))
 
-def process_transactions(): 
+        ### Each inserted row starts a new run, duplicates are numbered within their run
+        duplicates = conn.execute(text("""
+            UPDATE gifts_import gi
+            SET consecutive_duplicates = runs.consecutive_duplicates
+            FROM (
+                SELECT id, is_duplicate,
+                    COUNT(*) FILTER (WHERE is_duplicate) OVER (PARTITION BY run ORDER BY merge_order) AS consecutive_duplicates
+                FROM (
+                    SELECT id, merge_order, is_duplicate,
+                        COUNT(*) FILTER (WHERE NOT is_duplicate) OVER (ORDER BY merge_order) AS run
+                    FROM gifts_merge
+                ) numbered
+            ) runs
+            WHERE gi.id = runs.id AND runs.is_duplicate
+        """)).rowcount
+
+        categorise_transactions(conn, promoted_ids)
+
+    report_progress(progress, 'transactions', inserted + duplicates)
+    elapsed = time.perf_counter() - started
+    logger.info(f"Processed {inserted + duplicates} transactions in {elapsed:.2f}s, inserted {inserted}, duplicates {duplicates}")
+
+def process_transactions_rowwise(progress=None, scope=ALL_STAGED):
     logger.info(f"process transactions")
+    scope_sql, scope_params = scope
     with engine.connect() as conn:    
         ### Get all rows from gifts_import where record_type = 3
-        result = conn.execute(text("""
-            SELECT * FROM gifts_import WHERE "record_type" = 3
-        """))
+        result = conn.execute(text(f"""
+            SELECT * FROM gifts_import gi WHERE "record_type" = 3 AND {scope_sql} ORDER BY {STAGED_ROW_ORDER}
+        """), scope_params)
         rows = result.fetchall()
         headers = result.keys()
         process_count = 0
         batch_count = 200
         batch = 0
         consecutive_duplicates = 0
+        promoted_ids = []
         for row in [dict(zip(headers, row)) for row in rows]:
             # Ensure row does not already exist in transactions table match on source_account_number, amount, date, payee, particulars, code, reference, transaction_type, destination_account_number
             if process_count == batch_count:
@@ -143,7 +397,8 @@ def process_transactions():
                 process_count = 0  + (batch * batch_count)
                 batch += 1
             process_count += 1
-            existing_transaction = conn.execute(text("""
+            report_progress(progress, 'transactions', 1)
+            existing_transaction = row['covered'] or conn.execute(text("""
                 SELECT 1 FROM transactions
                 WHERE "account_number" = :source_account_number
                 AND "amount" = :amount
@@ -166,14 +421,15 @@ def process_transactions():
                 'destination_account_number': row['destination_account_number']
             }).fetchone()
 
-            # If not, insert row into transactions table and delete from gifts_import
-            if not existing_transaction:
-                conn.execute(text("""
+            # If not, and it is not held back as a near duplicate, insert row into transactions table and delete from gifts_import
+            if not existing_transaction and row['near_duplicate_id'] is None:
+                promoted_ids.append(conn.execute(text("""
                     INSERT INTO transactions (
                         "account_number", "amount", "date", "payee", "particulars", "code", "reference", "transaction_type", "destination_account_number"
                     ) VALUES (
                         :source_account_number, :amount, :date, :payee, :particulars, :code, :reference, :transaction_type, :destination_account_number
                     )
+                    RETURNING id
                 """), {
                     'source_account_number': row['source_account_number'],
                     'amount': row['amount'],
@@ -184,7 +440,7 @@ def process_transactions():
                     'reference': row['reference'],
                     'transaction_type': row['transaction_type'],
                     'destination_account_number': row['destination_account_number']
-                })
+                }).scalar())
 
                 conn.execute(text("""
                     DELETE FROM gifts_import WHERE id = :id
@@ -198,74 +454,348 @@ def process_transactions():
                     UPDATE gifts_import SET consecutive_duplicates = :consecutive_duplicates WHERE id = :id
                 """), {'consecutive_duplicates': consecutive_duplicates, 'id': row['id']})
 
+        categorise_transactions(conn, promoted_ids)
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def import_filters(account=None, min_duplicates=None, max_duplicates=None, near_duplicates=False, covered=False, date_from=None, date_to=None):
+    conditions = []
+    params = {}
+    if account:
+        conditions.append('gi.source_account_number = :account')
+        params['account'] = account
+    if min_duplicates is not None:
+        conditions.append('gi.consecutive_duplicates >= :min_duplicates')
+        params['min_duplicates'] = int(min_duplicates)
+    if max_duplicates is not None:
+        conditions.append('gi.consecutive_duplicates <= :max_duplicates')
+        params['max_duplicates'] = int(max_duplicates)
+    if near_duplicates:
+        conditions.append('gi.near_duplicate_id IS NOT NULL')
+    if covered:
+        conditions.append('gi.covered')
+    if date_from is not None:
+        conditions.append('gi.date >= :date_from')
+        params['date_from'] = date_from
+    if date_to is not None:
+        conditions.append('gi.date <= :date_to')
+        params['date_to'] = date_to
+    return conditions, params
+
+def review_filters(**filters):
+    # import_filters limited to the rows in the review queue: transactions (header rows are only
+    # staged for the merge) of files that have been merged. Rows of a file waiting for its merge
+    # are not shown or selected until the merge has classified them.
+    scope_sql, params = staged_scope()
+    conditions, filter_params = import_filters(**filters)
+    return ['gi."record_type" = 3', scope_sql] + conditions, {**params, **filter_params}
 
-def get_remaining_imports(): 
-    logger.info(f"get remaining imports")
+def import_selection(ids=None, **filters):
+    # WHERE clause for the review queue rows picked by id, by import_filters, or both (rows must
+    # match both). Raises ValueError when neither is given, so an empty request never selects everything.
+    conditions, params = import_filters(**filters)
+    if ids is not None:
+        conditions.append('gi.id = ANY(:ids)')
+        params['ids'] = [int(id) for id in ids]
+    if not conditions:
+        raise ValueError('No staged rows selected')
+    review, review_params = review_filters()
+    return ' AND '.join(review + conditions), {**review_params, **params}
+
+def get_import_accounts():
+    # Accounts with rows in the review queue, for the review page filter. Empty when nothing is left to review.
+    conditions, params = review_filters()
     with engine.connect() as conn:
-        result = conn.execute(text("""
-            SELECT 
-            gi.id, 
-            a.account_name,
-            gi.date, 
-            gi.amount, 
-            gi.payee, 
-            gi.particulars, 
-            gi.code, 
-            gi.reference,
-            gi.consecutive_duplicates
+        return conn.execute(text(f"""
+            SELECT gi.source_account_number AS account_number, a.account_name, COUNT(*) AS rows
             FROM gifts_import gi
             LEFT JOIN accounts a ON gi.source_account_number = a.account_number
-        """))
-        return result.fetchall()
+            WHERE {' AND '.join(conditions)}
+            GROUP BY gi.source_account_number, a.account_name
+            ORDER BY a.account_name, gi.source_account_number
+        """), params).fetchall()
+
+def get_import_page(run=None, sort='date', descending=False, cursor=None, limit=IMPORT_PAGE_SIZE, **filters):
+    # One keyset page of review queue rows matching import_filters, optionally limited to one run
+    # from get_import_summary. Raises ValueError for an unknown sort or an invalid cursor.
+    if sort not in IMPORT_SORTS:
+        raise ValueError(f"Invalid sort: {sort}")
+    sort_key, convert = IMPORT_SORTS[sort]
+    direction = 'DESC' if descending else 'ASC'
+    limit = max(1, min(int(limit), IMPORT_MAX_PAGE_SIZE))
+
+    conditions, params = review_filters(**filters)
+    source = 'gifts_import gi'
+    if run is not None:
+        source = f"({IMPORT_RUNS}) gi"
+        conditions.append('gi.duplicate_run = :run')
+        params['run'] = int(run)
+    if cursor:
+        value, id = decode_cursor(cursor)
+        conditions.append(f"({sort_key}, gi.id) {'<' if descending else '>'} (:cursor_value, :cursor_id)")
+        params['cursor_value'] = convert(value)
+        params['cursor_id'] = int(id)
+    params['limit'] = limit + 1
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"""
+            SELECT
+                {sort_key} AS sort_key,
+                gi.id,
+                gi.source_account_number AS account_number,
+                a.account_name,
+                gi.date,
+                gi.amount,
+                gi.payee,
+                gi.particulars,
+                gi.code,
+                gi.reference,
+                gi.consecutive_duplicates,
+                gi.near_duplicate_score,
+                gi.covered,
+                t.date AS near_duplicate_date,
+                t.payee AS near_duplicate_payee
+            FROM {source}
+            LEFT JOIN accounts a ON gi.source_account_number = a.account_number
+            LEFT JOIN transactions t ON gi.near_duplicate_id = t.id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {sort_key} {direction}, gi.id {direction}
+            LIMIT :limit
+        """), params).fetchall()
+
+    page = [row._asdict() for row in rows[:limit]]
+    for row in page:
+        del row['sort_key']
+        for field in ['date', 'near_duplicate_date']:
+            row[field] = row[field].isoformat() if row[field] else None
+    return {
+        'rows': page,
+        'next_cursor': encode_cursor(rows[limit - 1].sort_key, rows[limit - 1].id) if len(rows) > limit else None,
+    }
+
+def get_import_summary(cursor=None, limit=IMPORT_PAGE_SIZE, **filters):
+    # Review queue rows matching import_filters collapsed to one line per run of consecutive duplicates, in merge order
+    limit = max(1, min(int(limit), IMPORT_MAX_PAGE_SIZE))
+    conditions, params = review_filters(**filters)
+    if cursor:
+        conditions.append('gi.duplicate_run > :after_run')
+        params['after_run'] = int(decode_cursor(cursor)[0])
+    params['limit'] = limit + 1
+
+    with engine.connect() as conn:
+        groups = conn.execute(text(f"""
+            SELECT
+                gi.duplicate_run AS run,
+                MIN(gi.source_account_number) AS account_number,
+                MIN(a.account_name) AS account_name,
+                COUNT(*) AS rows,
+                MIN(gi.date) AS first_date,
+                MAX(gi.date) AS last_date,
+                MIN(gi.payee) AS payee,
+                SUM(gi.amount) AS total_amount,
+                MAX(gi.consecutive_duplicates) AS consecutive_duplicates,
+                COUNT(gi.near_duplicate_id) AS near_duplicates
+            FROM ({IMPORT_RUNS}) gi
+            LEFT JOIN accounts a ON gi.source_account_number = a.account_number
+            WHERE {' AND '.join(conditions)}
+            GROUP BY gi.duplicate_run
+            ORDER BY gi.duplicate_run
+            LIMIT :limit
+        """), params).fetchall()
+
+    page = [group._asdict() for group in groups[:limit]]
+    for group in page:
+        for field in ['first_date', 'last_date']:
+            group[field] = group[field].isoformat() if group[field] else None
+    return {
+        'groups': page,
+        'next_cursor': encode_cursor(groups[limit - 1].run) if len(groups) > limit else None,
+    }
 
 def get_account_summary_view():
+    # Same columns as view_account_summary, read from the maintained account_balances table
     with engine.connect() as conn:
         result = conn.execute(text("""
-        SELECT * FROM view_account_summary
+        SELECT
+            a.id,
+            a.account_name,
+            a.account_number,
+            a.opening_balance,
+            round(a.opening_balance::numeric + COALESCE(b.balance, 0), 2) AS balance
+        FROM accounts a
+        LEFT JOIN account_balances b ON b.account_number = a.account_number
         """))
         return result.fetchall()
 
-def add_transaction(ids):
-    logger.info(f"add transaction")
+def refresh_balance_snapshots():
+    # Add month end snapshots for every complete month after each account's latest snapshot.
+    # Invalidation always removes a suffix, so the latest remaining snapshot is a valid base.
+    logger.info(f"refresh balance snapshots")
     with engine.connect() as conn:
-        ids = [int(id) for id in ids]
+        created = conn.execute(text("""
+            WITH base AS (
+                SELECT DISTINCT ON (account_number) account_number, snapshot_date, balance
+                FROM account_balance_snapshots
+                ORDER BY account_number, snapshot_date DESC
+            ),
+            months AS (
+                SELECT
+                    t.account_number,
+                    (date_trunc('month', t.date) + interval '1 month - 1 day')::date AS month_end,
+                    SUM(t.amount::numeric) AS total
+                FROM transactions t
+                LEFT JOIN base b ON b.account_number = t.account_number
+                WHERE (b.snapshot_date IS NULL OR t.date > b.snapshot_date)
+                AND t.date < date_trunc('month', current_date)
+                GROUP BY 1, 2
+            )
+            INSERT INTO account_balance_snapshots (account_number, snapshot_date, balance)
+            SELECT
+                m.account_number,
+                m.month_end,
+                COALESCE(b.balance, 0) + SUM(m.total) OVER (PARTITION BY m.account_number ORDER BY m.month_end)
+            FROM months m
+            LEFT JOIN base b ON b.account_number = m.account_number
+            ON CONFLICT DO NOTHING
+        """)).rowcount
+    logger.info(f"Created {created} balance snapshots")
+    return created
+
+def get_balance_history(account_number, start, end, interval='daily'):
+    # Running balance for each day (or month end) in [start, end]. Only transactions after the
+    # nearest snapshot before start are summed. Returns None for an unknown account.
+    with engine.connect() as conn:
+        opening_balance = conn.execute(text("""
+            SELECT opening_balance FROM accounts WHERE account_number = :account_number
+        """), {'account_number': account_number}).scalar()
+        if opening_balance is None:
+            return None
+
         result = conn.execute(text("""
-            SELECT * FROM gifts_import WHERE id = ANY(:ids)
-        """), {'ids': ids})
-        rows = result.fetchall()
-        headers = result.keys()
-        for row in [dict(zip(headers, row)) for row in rows]:
-            conn.execute(text("""
-                INSERT INTO transactions (
-                    "account_number", "amount", "date", "payee", "particulars", "code", "reference", "transaction_type", "destination_account_number"
-                ) VALUES (
-                    :source_account_number, :amount, :date, :payee, :particulars, :code, :reference, :transaction_type, :destination_account_number
-                )
-            """), {
-                'source_account_number': row['source_account_number'],
-                'amount': row['amount'],
-                'date': row['date'],
-                'payee': row['payee'],
-                'particulars': row['particulars'],
-                'code': row['code'],
-                'reference': row['reference'],
-                'transaction_type': row['transaction_type'],
-                'destination_account_number': row['destination_account_number']
-            })
+            WITH base AS (
+                SELECT snapshot_date, balance
+                FROM account_balance_snapshots
+                WHERE account_number = :account_number AND snapshot_date < :start
+                ORDER BY snapshot_date DESC
+                LIMIT 1
+            ),
+            daily AS (
+                SELECT date, SUM(amount::numeric) AS total
+                FROM transactions
+                WHERE account_number = :account_number
+                AND date > COALESCE((SELECT snapshot_date FROM base), '-infinity'::date)
+                AND date <= :end
+                GROUP BY date
+            ),
+            days AS (
+                SELECT day::date AS day
+                FROM generate_series(CAST(:start AS date), CAST(:end AS date), interval '1 day') AS day
+            ),
+            running AS (
+                SELECT
+                    days.day,
+                    CAST(:opening_balance AS numeric)
+                    + COALESCE((SELECT balance FROM base), 0)
+                    + COALESCE((SELECT SUM(total) FROM daily WHERE date < :start), 0)
+                    + SUM(COALESCE(daily.total, 0)) OVER (ORDER BY days.day) AS balance
+                FROM days
+                LEFT JOIN daily ON daily.date = days.day
+            )
+            SELECT day, round(balance, 2) AS balance
+            FROM running
+            WHERE :interval = 'daily'
+            OR day = (date_trunc('month', day) + interval '1 month - 1 day')::date
+            OR day = :end
+            ORDER BY day
+        """), {'account_number': account_number, 'start': start, 'end': end, 'interval': interval, 'opening_balance': opening_balance})
+        return result.fetchall()
+
+def reconcile_account_balances(rebuild=False):
+    # Compare account_balances with the full aggregate over transactions, and rebuild it when asked
+    logger.info(f"reconcile account balances")
+    with engine.execution_options(isolation_level="READ COMMITTED").begin() as conn:
+        if rebuild:
+            conn.execute(text("LOCK TABLE transactions IN SHARE MODE"))
+        # The triggers leave a zero row behind when an account's last transaction is deleted, which
+        # matches an account with no transactions
+        mismatches = conn.execute(text("""
+            WITH actual AS (
+                SELECT account_number, SUM(amount::numeric) AS balance, COUNT(*) AS transaction_count
+                FROM transactions
+                GROUP BY account_number
+            )
+            SELECT
+                COALESCE(actual.account_number, b.account_number) AS account_number,
+                actual.balance AS expected_balance,
+                b.balance AS stored_balance,
+                actual.transaction_count AS expected_count,
+                b.transaction_count AS stored_count
+            FROM actual
+            FULL JOIN account_balances b ON b.account_number = actual.account_number
+            WHERE COALESCE(actual.balance, 0) <> COALESCE(b.balance, 0)
+            OR COALESCE(actual.transaction_count, 0) <> COALESCE(b.transaction_count, 0)
+        """)).fetchall()
+
+        for row in mismatches:
+            logger.warning(f"Account balance mismatch for {row.account_number}: stored {row.stored_balance} ({row.stored_count} transactions), expected {row.expected_balance} ({row.expected_count} transactions)")
 
+        if rebuild and mismatches:
+            conn.execute(text("DELETE FROM account_balances"))
             conn.execute(text("""
-                DELETE FROM gifts_import WHERE id = :id
-            """), {'id': row['id']})
+                INSERT INTO account_balances (account_number, balance, transaction_count)
+                SELECT account_number, SUM(amount::numeric), COUNT(*) FROM transactions GROUP BY account_number
+            """))
+            logger.info(f"Rebuilt account_balances.")
+    if rebuild and mismatches:
+        invalidate(ACCOUNTS)
+    return mismatches
 
-def delete_gifts_import(ids):
+def add_transaction(ids=None, **filters):
+    # Accept staged rows picked by import_selection as transactions: one DELETE ... RETURNING feeding
+    # one INSERT ... SELECT, in file order, categorised in the same transaction. Returns the number accepted.
+    logger.info(f"add transaction")
+    where, params = import_selection(ids, **filters)
+    with engine.connect() as conn:
+        ensure_transaction_partitions(conn, *staged_date_range(conn, where, params))
+    with engine.execution_options(isolation_level="READ COMMITTED").begin() as conn:
+        promoted_ids = conn.execute(text(f"""
+            WITH accepted AS (
+                DELETE FROM gifts_import gi WHERE {where}
+                RETURNING gi.*
+            )
+            INSERT INTO transactions (
+                "account_number", "amount", "date", "payee", "particulars", "code", "reference", "transaction_type", "destination_account_number"
+            )
+            SELECT
+                gi."source_account_number", gi."amount", gi."date", gi."payee", gi."particulars", gi."code", gi."reference",
+                gi."transaction_type", gi."destination_account_number"
+            FROM accepted gi
+            ORDER BY {STAGED_ROW_ORDER}
+            RETURNING id
+        """), params).scalars().all()
+        categorise_transactions(conn, promoted_ids)
+    logger.info(f"Accepted {len(promoted_ids)} staged rows")
+    invalidate(ACCOUNTS)
+    return len(promoted_ids)
+
+def delete_gifts_import(ids=None, **filters):
+    # Reject staged rows picked by import_selection, or every row in the review queue when ids is "*".
+    # Returns the number deleted.
     logger.info(f"delete gifts import")
     with engine.connect() as conn:
         if ids == "*":
-            conn.execute(text("""
-                DELETE FROM gifts_import
-            """))
-        else:
-            ids = [int(id) for id in ids]
-            conn.execute(text("""
-                DELETE FROM gifts_import WHERE id = ANY(:ids)
-            """), {'ids': ids})
\ No newline at end of file
+            conditions, params = review_filters()
+            return conn.execute(text(f"""
+                DELETE FROM gifts_import gi WHERE {' AND '.join(conditions)}
+            """), params).rowcount
+        where, params = import_selection(ids, **filters)
+        return conn.execute(text(f"""
+            DELETE FROM gifts_import gi WHERE {where}
+        """), params).rowcount
\ No newline at end of file
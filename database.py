@@ -1,8 +1,14 @@
 import os
 import logging
+import threading
+import time
+import contextvars
+import datetime
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import create_engine, text
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy_utils import database_exists, create_database
 from dotenv import load_dotenv
 
@@ -23,17 +29,144 @@ POSTGRES_HOST = os.getenv('POSTGRES_HOST')
 DATABASE_URI = f'postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}'
 ROOT_DATABASE_URI = f'postgresql://{POSTGRES_ROOT_USER}:{POSTGRES_ROOT_PASSWORD}@{POSTGRES_HOST}/postgres'
 
-db = SQLAlchemy()
+# One connection pool per process, shared by the web app, Flask-SQLAlchemy, import and rule jobs
+# and CLI commands
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# Checkouts that wait longer than this many seconds are logged with the pool status
+DB_POOL_WAIT_WARNING = float(os.getenv('DB_POOL_WAIT_WARNING', 0.5))
+
+# Session settings per role. Web requests give up quickly, jobs, CLI commands and schema setup
+# ('worker') run for as long as they need.
+DB_ROLE_SETTINGS = {
+    'web': {
+        'statement_timeout': os.getenv('DB_WEB_STATEMENT_TIMEOUT', '30s'),
+        'lock_timeout': os.getenv('DB_WEB_LOCK_TIMEOUT', '5s'),
+    },
+    'worker': {
+        'statement_timeout': os.getenv('DB_WORKER_STATEMENT_TIMEOUT', '0'),
+        'lock_timeout': os.getenv('DB_WORKER_LOCK_TIMEOUT', '0'),
+    },
+}
+db_role = contextvars.ContextVar('db_role', default='web')
+
+def set_database_role(role):
+    # For thread and process pool initializers, so every connection their tasks use gets the role
+    db_role.set(role)
+
+@contextmanager
+def database_role(role):
+    token = db_role.set(role)
+    try:
+        yield
+    finally:
+        db_role.reset(token)
+
+pool_stats_lock = threading.Lock()
+pool_counters = {'checkouts': 0, 'timeouts': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0}
+
+class InstrumentedQueuePool(QueuePool):
+    # Counts checkouts and how long each one waited for a connection, including opening a new one
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            with pool_stats_lock:
+                pool_counters['timeouts'] += 1
+            logger.error(f"Timed out waiting for a database connection: {self.status()}")
+            raise
+        waited = time.perf_counter() - started
+        with pool_stats_lock:
+            pool_counters['checkouts'] += 1
+            pool_counters['wait_seconds_total'] += waited
+            pool_counters['wait_seconds_max'] = max(pool_counters['wait_seconds_max'], waited)
+        if waited >= DB_POOL_WAIT_WARNING:
+            logger.warning(f"Waited {waited:.2f}s for a database connection: {self.status()}")
+        return connection
+
+def apply_role_settings(dbapi_connection, connection_record, connection_proxy):
+    # Pool checkout hook. Settings are only sent when the connection last served another role,
+    # and committed straight away so a later rollback can't undo them.
+    role = db_role.get()
+    if connection_record.info.get('db_role') == role:
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in DB_ROLE_SETTINGS[role].items():
+        cursor.execute(f"SET {name} = %s", (value,))
+    cursor.close()
+    if not dbapi_connection.autocommit:
+        dbapi_connection.commit()
+    connection_record.info['db_role'] = role
+
+def create_db_engine():
+    # Raw SQL runs in autocommit mode, transactional work asks for
+    # engine.execution_options(isolation_level="READ COMMITTED").begin()
+    engine = create_engine(
+        DATABASE_URI,
+        isolation_level="AUTOCOMMIT",
+        poolclass=InstrumentedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+    event.listen(engine, 'checkout', apply_role_settings)
+    return engine
+
+engine = create_db_engine()
+
+def pool_stats():
+    pool = engine.pool
+    with pool_stats_lock:
+        counters = dict(pool_counters)
+    return {
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        'overflow': max(pool.overflow(), 0),
+        'max_overflow': DB_MAX_OVERFLOW,
+        **counters,
+    }
+
+class SharedEngineSQLAlchemy(SQLAlchemy):
+    # Flask-SQLAlchemy would create a second engine and pool, the ORM session uses the shared one
+    # with ordinary transactions instead. _make_engine is internal to Flask-SQLAlchemy, which is
+    # pinned to the 3.1 series in requirements.txt, check this override when raising the pin.
+    def _make_engine(self, bind_key, options, app):
+        return engine.execution_options(isolation_level="READ COMMITTED")
+
+db = SharedEngineSQLAlchemy()
 
 def init_db(app):
     app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.init_app(app)
 
+def schema_ready():
+    # True once bootstrap_db has created every table and the account summary view
+    names = list(db.metadata.tables) + ['view_account_summary']
+    try:
+        with engine.connect() as conn:
+            found = conn.execute(text("""
+                SELECT COUNT(*) FROM pg_class WHERE relnamespace = 'public'::regnamespace AND relname = ANY(:names)
+            """), {'names': names}).scalar()
+    except OperationalError as e:
+        logger.error(f"Database {POSTGRES_DB} is not available: {str(e.orig).strip()}")
+        return False
+    return found == len(names)
+
+def bootstrap_db(app):
+    # Provisioning for flask bootstrap-db: database, user and tables. Column changes and other
+    # indexes are versioned scripts in migrations/, the objects built on transactions are created
+    # after them by create_transaction_objects.
     createDBorUser = False
 
     # Check postgres database exists and has correct permissions using non-root user
-    engine = create_engine(DATABASE_URI)
     try:
         with engine.connect() as conn:
             # Check if the database exists
@@ -61,8 +194,8 @@ def init_db(app):
     
     if createDBorUser:
         # Create the database and user if they don't exist
-        engine = create_engine(ROOT_DATABASE_URI)
-        with engine.connect() as conn:
+        root_engine = create_engine(ROOT_DATABASE_URI)
+        with root_engine.connect() as conn:
             conn.execution_options(isolation_level="AUTOCOMMIT")
             user_exists_query = text(f"SELECT rolcanlogin FROM pg_roles WHERE rolname='{POSTGRES_USER}'")
             result = conn.execute(user_exists_query).fetchone()
@@ -89,7 +222,7 @@ def init_db(app):
                 logger.info(f"User {POSTGRES_USER} not found.")
                 
         # Create the database
-        with engine.connect() as conn:
+        with root_engine.connect() as conn:
             conn.execution_options(isolation_level="AUTOCOMMIT")
             # Check if the database exists before creating it
             db_exists_query = text(f"SELECT 1 FROM pg_database WHERE datname='{POSTGRES_DB}'")
@@ -113,6 +246,7 @@ def init_db(app):
                 logger.info(f"Granted all privileges on database {POSTGRES_DB} to {POSTGRES_USER}.")
             else:
                 logger.info(f"User {POSTGRES_USER} already has all privileges on database {POSTGRES_DB}.")
+        root_engine.dispose()
 
     # Create the database tables
     with app.app_context():
@@ -120,6 +254,9 @@ def init_db(app):
             create_database(DATABASE_URI)
         db.create_all()
 
+def create_transaction_objects():
+    # The account summary view, balance triggers and search indexes on transactions. Run after the
+    # migrations, 0005 replaces transactions with a partitioned table and drops them.
     with engine.connect() as conn:
         conn.execution_options(isolation_level="AUTOCOMMIT")
         # Create the view for the account summary
@@ -140,11 +277,145 @@ def init_db(app):
         """
         conn.execute(text(view_query))
 
+        create_account_balance_triggers(conn)
+        create_balance_snapshot_triggers(conn)
+        create_search_indexes(conn)
+
+def create_account_balance_triggers(conn):
+    # account_balances holds the running SUM(amount) per account. Statement level triggers apply
+    # each INSERT/UPDATE/DELETE on transactions as one grouped upsert, so bulk imports cost one
+    # extra statement rather than one per row.
+    conn.execute(text("""
+        CREATE OR REPLACE FUNCTION account_balances_apply() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO account_balances (account_number, balance, transaction_count)
+                SELECT account_number, SUM(amount::numeric), COUNT(*) FROM new_rows GROUP BY account_number
+                ON CONFLICT (account_number) DO UPDATE
+                SET balance = account_balances.balance + EXCLUDED.balance,
+                    transaction_count = account_balances.transaction_count + EXCLUDED.transaction_count;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO account_balances (account_number, balance, transaction_count)
+                SELECT account_number, -SUM(amount::numeric), -COUNT(*) FROM old_rows GROUP BY account_number
+                ON CONFLICT (account_number) DO UPDATE
+                SET balance = account_balances.balance + EXCLUDED.balance,
+                    transaction_count = account_balances.transaction_count + EXCLUDED.transaction_count;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """))
+    conn.execute(text("""
+        CREATE OR REPLACE FUNCTION account_balances_truncate() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM account_balances;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """))
+    triggers = {
+        'account_balances_insert': "AFTER INSERT ON transactions REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION account_balances_apply()",
+        'account_balances_update': "AFTER UPDATE ON transactions REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION account_balances_apply()",
+        'account_balances_delete': "AFTER DELETE ON transactions REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION account_balances_apply()",
+        'account_balances_truncate': "AFTER TRUNCATE ON transactions FOR EACH STATEMENT EXECUTE FUNCTION account_balances_truncate()",
+    }
+    for name, definition in triggers.items():
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {name} ON transactions"))
+        conn.execute(text(f"CREATE TRIGGER {name} {definition}"))
+
+    # Seed the table the first time it is created on a database that already has transactions
+    empty = conn.execute(text("""
+        SELECT NOT EXISTS (SELECT 1 FROM account_balances) AND EXISTS (SELECT 1 FROM transactions)
+    """)).scalar()
+    if empty:
+        logger.info(f"Seeding account_balances from transactions.")
+        conn.execute(text("""
+            INSERT INTO account_balances (account_number, balance, transaction_count)
+            SELECT account_number, SUM(amount::numeric), COUNT(*) FROM transactions GROUP BY account_number
+        """))
+
+def create_balance_snapshot_triggers(conn):
+    # A month end snapshot is only valid while no transaction on or before its date changes.
+    # Back dated imports drop the account's snapshots from the earliest affected date onwards,
+    # refresh_balance_snapshots rebuilds them after the import.
+    conn.execute(text("""
+        CREATE OR REPLACE FUNCTION balance_snapshots_invalidate() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                DELETE FROM account_balance_snapshots;
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                DELETE FROM account_balance_snapshots s
+                USING (SELECT account_number, MIN(date) AS date FROM new_rows GROUP BY account_number) changed
+                WHERE s.account_number = changed.account_number AND s.snapshot_date >= changed.date;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM account_balance_snapshots s
+                USING (SELECT account_number, MIN(date) AS date FROM old_rows GROUP BY account_number) changed
+                WHERE s.account_number = changed.account_number AND s.snapshot_date >= changed.date;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """))
+    triggers = {
+        'balance_snapshots_insert': "AFTER INSERT ON transactions REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION balance_snapshots_invalidate()",
+        'balance_snapshots_update': "AFTER UPDATE ON transactions REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION balance_snapshots_invalidate()",
+        'balance_snapshots_delete': "AFTER DELETE ON transactions REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION balance_snapshots_invalidate()",
+        'balance_snapshots_truncate': "AFTER TRUNCATE ON transactions FOR EACH STATEMENT EXECUTE FUNCTION balance_snapshots_invalidate()",
+    }
+    for name, definition in triggers.items():
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {name} ON transactions"))
+        conn.execute(text(f"CREATE TRIGGER {name} {definition}"))
+
+def ensure_transaction_partitions(conn, first_date, last_date):
+    # transactions has one partition per year and no default partition (migrations/0005), so every
+    # insert path creates the years of its dates first. Call it outside the inserting transaction:
+    # creating a partition locks transactions until the creating transaction commits.
+    created = conn.execute(text("SELECT transactions_ensure_partitions(:first_date, :last_date)"), {
+        'first_date': first_date, 'last_date': last_date,
+    }).scalar()
+    if created:
+        logger.info(f"Created {created} transactions partitions for {first_date} to {last_date}")
+    return created
+
+def transaction_partition_bounds(first_date, last_date):
+    # [start, end) of each yearly transactions partition from first_date to last_date
+    if first_date is None or last_date is None:
+        return []
+    return [(datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)) for year in range(first_date.year, last_date.year + 1)]
+
+# Text columns covered by transaction search and indexed for rule `like` conditions
+SEARCH_FIELDS = ['payee', 'particulars', 'code', 'reference']
+
+def create_search_indexes(conn):
+    # search_vector holds the words of SEARCH_FIELDS for /api/transactions/search. pg_trgm GIN
+    # indexes let `like` conditions (LIKE '%value%') use an index rather than scan transactions.
+    # Without the extension those conditions still work, they just scan.
+    words = " || ' ' || ".join(f"coalesce({field}, '')" for field in SEARCH_FIELDS)
+    conn.execute(text(f"""
+        ALTER TABLE transactions ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', {words})) STORED
+    """))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS transactions_search_vector_idx ON transactions USING gin (search_vector)"))
+    try:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except DBAPIError as e:
+        logger.warning(f"pg_trgm is not available, like conditions will scan transactions: {str(e.orig).splitlines()[0]}")
+        return
+    for field in SEARCH_FIELDS:
+        conn.execute(text(f"""
+            CREATE INDEX IF NOT EXISTS transactions_{field}_trgm_idx ON transactions USING gin ({field} gin_trgm_ops)
+        """))
+
 # Define your models here
+# Range partitioned by year of date with primary key (id, date), see migrations/0005
 class Transactions(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     account_number = db.Column(db.String(32), nullable=False) 
-    date = db.Column(db.Date, nullable=False)
+    date = db.Column(db.Date, primary_key=True)
     amount = db.Column(db.Float, nullable=False)
     particulars = db.Column(db.String(32), nullable=True)         # Column 7
     code = db.Column(db.String(32), nullable=True)                # Column 8
@@ -161,6 +432,18 @@ class Accounts(db.Model):
     account_name = db.Column(db.String(32), nullable=False)
     opening_balance = db.Column(db.Float, nullable=False, default=0.0)
 
+# Maintained by triggers on transactions, see create_account_balance_triggers
+class AccountBalances(db.Model):
+    account_number = db.Column(db.String(32), primary_key=True)
+    balance = db.Column(db.Numeric, nullable=False, default=0)            # SUM(transactions.amount), excludes opening balance
+    transaction_count = db.Column(db.Integer, nullable=False, default=0)
+
+# Month end checkpoints: SUM(transactions.amount) up to and including snapshot_date, excludes opening balance
+class AccountBalanceSnapshots(db.Model):
+    account_number = db.Column(db.String(32), primary_key=True)
+    snapshot_date = db.Column(db.Date, primary_key=True)
+    balance = db.Column(db.Numeric, nullable=False)
+
 class Payees(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     account_number = db.Column(db.String(32), nullable=False, unique=True)
@@ -184,6 +467,22 @@ class GiftsImport(db.Model):
     misc_field = db.Column(db.Integer, nullable=True)                # Column 14
     destination_account_number = db.Column(db.String(32), nullable=True) # Column 15
     consecutive_duplicates = db.Column(db.Integer, nullable=False, default=0) # No. of consecutive duplicates
+    near_duplicate_id = db.Column(db.Integer, nullable=True)             # Closest fuzzy match in transactions
+    near_duplicate_score = db.Column(db.Float, nullable=True)            # Similarity of that match, 0-1
+    file_seq = db.Column(db.BigInteger, nullable=True)                   # Upload order of the source file
+    line_number = db.Column(db.Integer, nullable=True)                   # Line within the source file
+    covered = db.Column(db.Boolean, nullable=False, default=False, server_default='false')  # Date already covered by an imported file
+
+# Background imports submitted through /api/import_data, see import_jobs.py
+class ImportJobs(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(16), nullable=False, default='queued')  # queued, running, done, failed
+    phase = db.Column(db.String(16), nullable=True)                      # parse, load, accounts, payees, transactions
+    files = db.Column(db.Integer, nullable=False, default=0)
+    rows_processed = db.Column(db.Integer, nullable=False, default=0)    # Rows handled in the current phase
+    errors = db.Column(db.Text, nullable=True)                           # One error per line
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
 
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -197,17 +496,34 @@ class Subcategory(db.Model):
 
 class TransactionsCategories(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    transaction_id = db.Column(db.Integer, db.ForeignKey('transactions.id'), nullable=False)
+    transaction_id = db.Column(db.Integer, nullable=False)              # transactions.id, no foreign key since transactions is partitioned
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
     sub_category_id = db.Column(db.Integer, db.ForeignKey('subcategory.id'), nullable=True)
+    rule_id = db.Column(db.Integer, nullable=True)                       # Rule that assigned it, NULL when set by hand
+    rule_version = db.Column(db.Integer, nullable=True)                  # Rules.version at the time
 
 # Rules table for setting up rules that have one or many rule conditions and one or mant rule actions
 class Rules(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(32), nullable=False)
     description = db.Column(db.String(32), nullable=True)
-    conditions = db.relationship('RuleConditions', backref='rule', cascade="all, delete-orphan", lazy=True)
-    actions = db.relationship('RuleActions', backref='rule', cascade="all, delete-orphan", lazy=True)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Bumped each time the rule is saved
+    # In the order they were entered, which is the order a condition chain is evaluated in
+    conditions = db.relationship('RuleConditions', backref='rule', cascade="all, delete-orphan", lazy=True, order_by='RuleConditions.id')
+    actions = db.relationship('RuleActions', backref='rule', cascade="all, delete-orphan", lazy=True, order_by='RuleActions.id')
+
+# Background re-categorisation after a rule is saved or deleted, see rule_jobs.py
+class RuleJobs(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    rule_id = db.Column(db.Integer, nullable=False)
+    rule_version = db.Column(db.Integer, nullable=True)                  # NULL when the rule was deleted
+    status = db.Column(db.String(16), nullable=False, default='queued')  # queued, running, done, failed
+    rows_total = db.Column(db.Integer, nullable=False, default=0)        # Transactions the rule could affect
+    rows_processed = db.Column(db.Integer, nullable=False, default=0)
+    rows_changed = db.Column(db.Integer, nullable=False, default=0)      # Transactions whose categories were rewritten
+    errors = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
 
 # Rule Actions table for what category and sub category to apply  when one or more rules are matched includes associate Rules ID
 class RuleActions(db.Model):
@@ -0,0 +1,120 @@
+import os
+from difflib import SequenceMatcher
+from sqlalchemy import text
+from database import logger, transaction_partition_bounds
+from manifest import ALL_STAGED
+
+# The nine columns a staged row must match on to count as an existing transaction (gifts_import, transactions)
+DUPLICATE_MATCH_COLUMNS = [
+    ('source_account_number', 'account_number'), ('amount', 'amount'), ('date', 'date'),
+    ('payee', 'payee'), ('particulars', 'particulars'), ('code', 'code'), ('reference', 'reference'),
+    ('transaction_type', 'transaction_type'), ('destination_account_number', 'destination_account_number')
+]
+
+# Near duplicates share account and amount, fall within this many days of each other
+# and score at least the threshold on the weighted text similarity below. A field blank on both
+# sides scores 0, it is no evidence of a repeat: the same payee and amount on adjacent days
+# (a daily coffee) only matches when its particulars or reference agree as well.
+NEAR_DUPLICATE_DAYS = int(os.getenv('IMPORT_NEAR_DUPLICATE_DAYS', 1))
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('IMPORT_NEAR_DUPLICATE_THRESHOLD', 0.85))
+NEAR_DUPLICATE_WEIGHTS = {'payee': 0.5, 'particulars': 0.25, 'reference': 0.25}
+
+def exact_match_condition(staged='gi', existing='t'):
+    return ' AND '.join(f'{existing}."{t}" = {staged}."{g}"' for g, t in DUPLICATE_MATCH_COLUMNS)
+
+def existing_duplicates_query(first_date, last_date, scope=ALL_STAGED):
+    # (sql, params) for the ids of staged, not covered rows in scope (see manifest.staged_scope)
+    # that exactly match a transaction. Each
+    # year of first_date..last_date is its own UNION ALL branch, planned against that one transactions
+    # partition so it can probe the partition's index; a single EXISTS over several years is costed
+    # against every partition for each probe and planned as a hash join over all of them instead.
+    scope_sql, params = scope
+    params = dict(params)
+    branches = []
+    for index, (start, end) in enumerate(transaction_partition_bounds(first_date, last_date)):
+        params[f'start_{index}'], params[f'end_{index}'] = start, end
+        branches.append(f"""
+            SELECT gi.id FROM gifts_import gi
+            WHERE gi."record_type" = 3 AND NOT gi.covered AND gi.date >= :start_{index} AND gi.date < :end_{index}
+            AND {scope_sql}
+            AND EXISTS (
+                SELECT 1 FROM transactions t
+                WHERE {exact_match_condition()} AND t.date >= :start_{index} AND t.date < :end_{index}
+            )
+        """)
+    return ' UNION ALL '.join(branches) or 'SELECT NULL::integer AS id WHERE false', params
+
+def similarity(a, b):
+    a = (a or '').strip().lower()
+    b = (b or '').strip().lower()
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+def score_candidate(staged, existing):
+    return sum(weight * similarity(staged[field], existing[field]) for field, weight in NEAR_DUPLICATE_WEIGHTS.items())
+
+def find_candidates(conn, days, scope=ALL_STAGED):
+    # Block on (account, amount) and the date window so each staged row is only compared
+    # with the handful of transactions it could plausibly repeat. Exact duplicates are left
+    # to the normal duplicate check. The staged date range, as constants, lets the planner
+    # skip the transactions partitions outside it.
+    scope_sql, scope_params = scope
+    first_date, last_date = conn.execute(text(f"""
+        SELECT MIN(gi.date), MAX(gi.date) FROM gifts_import gi WHERE gi."record_type" = 3 AND NOT gi.covered AND {scope_sql}
+    """), scope_params).fetchone()
+    if first_date is None:
+        return []
+    result = conn.execute(text(f"""
+        SELECT
+            gi.id AS staged_id, gi.payee, gi.particulars, gi.reference,
+            t.id AS transaction_id, t.payee AS t_payee, t.particulars AS t_particulars, t.reference AS t_reference,
+            ABS(t.date - gi.date) AS day_distance
+        FROM gifts_import gi
+        JOIN transactions t
+            ON t.account_number = gi.source_account_number
+            AND t.amount = gi.amount
+            AND t.date BETWEEN gi.date - :days AND gi.date + :days
+            AND t.date BETWEEN CAST(:first_date AS date) - :days AND CAST(:last_date AS date) + :days
+        WHERE gi."record_type" = 3 AND NOT gi.covered AND {scope_sql}
+        AND NOT EXISTS (
+            SELECT 1 FROM transactions x WHERE {exact_match_condition(existing='x')} AND x.date BETWEEN :first_date AND :last_date
+        )
+    """), {**scope_params, 'days': days, 'first_date': first_date, 'last_date': last_date})
+    return result.fetchall()
+
+def detect_near_duplicates(conn, days=None, threshold=None, scope=ALL_STAGED):
+    days = NEAR_DUPLICATE_DAYS if days is None else days
+    threshold = NEAR_DUPLICATE_THRESHOLD if threshold is None else threshold
+    logger.info(f"detect near duplicates")
+
+    scope_sql, scope_params = scope
+    conn.execute(text(f"""
+        UPDATE gifts_import gi SET near_duplicate_id = NULL, near_duplicate_score = NULL
+        WHERE gi."record_type" = 3 AND gi.near_duplicate_id IS NOT NULL AND {scope_sql}
+    """), scope_params)
+
+    candidates = find_candidates(conn, days, scope)
+    best = {}
+    for row in candidates:
+        staged = {'payee': row.payee, 'particulars': row.particulars, 'reference': row.reference}
+        existing = {'payee': row.t_payee, 'particulars': row.t_particulars, 'reference': row.t_reference}
+        score = score_candidate(staged, existing)
+        # Prefer the closest date when two candidates score the same
+        key = (score, -row.day_distance)
+        if score >= threshold and (row.staged_id not in best or key > best[row.staged_id][0]):
+            best[row.staged_id] = (key, row.transaction_id)
+
+    if best:
+        conn.execute(text("""
+            UPDATE gifts_import SET near_duplicate_id = :transaction_id, near_duplicate_score = :score
+            WHERE id = :id
+        """), [
+            {'id': staged_id, 'transaction_id': transaction_id, 'score': round(key[0], 3)}
+            for staged_id, (key, transaction_id) in best.items()
+        ])
+
+    logger.info(f"Compared {len(candidates)} candidate pairs, found {len(best)} near duplicates")
+    return len(best)
@@ -0,0 +1,64 @@
+import csv
+import datetime
+import os
+from collections import namedtuple
+
+GIFTS_FIELDNAMES = [
+    'record_type', 'internal_reference', 'source_account_number', 'amount', 'unknown',
+    'transaction_reference', 'particulars', 'code', 'reference', 'payee', 'date', 'optional',
+    'transaction_type', 'misc_field', 'destination_account_number'
+]
+
+# Column positions in a .gifts line
+RECORD_TYPE, INTERNAL_REFERENCE, SOURCE_ACCOUNT_NUMBER, AMOUNT, UNKNOWN, TRANSACTION_REFERENCE, \
+    PARTICULARS, CODE, REFERENCE, PAYEE, DATE, OPTIONAL, TRANSACTION_TYPE, MISC_FIELD, \
+    DESTINATION_ACCOUNT_NUMBER = range(len(GIFTS_FIELDNAMES))
+
+GIFTS_DATE_FORMAT = '%d/%m/%y'
+
+Reject = namedtuple('Reject', ['line_number', 'reason', 'raw'])
+
+def _int(value):
+    return int(value) if value else 0
+
+def parse_gifts(file, rejects=None):
+    # Yields one plain tuple per record: the GIFTS_FIELDNAMES values converted to their column
+    # types, followed by the line number. Lines that fail conversion are skipped and added to
+    # rejects. A file only holds a few hundred distinct dates, so each is parsed once.
+    dates = {}
+    strptime = datetime.datetime.strptime
+    width = len(GIFTS_FIELDNAMES)
+    reader = csv.reader(file)
+    for fields in reader:
+        if not fields:
+            continue
+        if len(fields) < width:
+            # Missing trailing columns are NULL, as they were with csv.DictReader
+            fields = fields + [None] * (width - len(fields))
+        try:
+            date = fields[DATE]
+            if date:
+                parsed = dates.get(date)
+                if parsed is None:
+                    parsed = dates[date] = strptime(date, GIFTS_DATE_FORMAT).date()
+                date = parsed
+            else:
+                date = None
+            amount = fields[AMOUNT]
+            yield (
+                _int(fields[RECORD_TYPE]), _int(fields[INTERNAL_REFERENCE]), fields[SOURCE_ACCOUNT_NUMBER],
+                float(amount) if amount else 0, _int(fields[UNKNOWN]), _int(fields[TRANSACTION_REFERENCE]),
+                fields[PARTICULARS], fields[CODE], fields[REFERENCE], fields[PAYEE], date, fields[OPTIONAL],
+                fields[TRANSACTION_TYPE], _int(fields[MISC_FIELD]), fields[DESTINATION_ACCOUNT_NUMBER],
+                reader.line_num
+            )
+        except ValueError as e:
+            if rejects is not None:
+                rejects.append(Reject(reader.line_num, str(e), ','.join(field for field in fields if field is not None)))
+
+def write_reject_report(path, rejects):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', newline='') as report:
+        writer = csv.writer(report)
+        writer.writerow(Reject._fields)
+        writer.writerows(rejects)
@@ -0,0 +1,38 @@
+import multiprocessing
+import os
+
+# Production server: gunicorn -c gunicorn.conf.py
+# Send HUP to the master to gracefully replace the workers (finishing in flight requests). With
+# preload_app the code is loaded by the master, so deploy new code by restarting the master.
+wsgi_app = 'app:create_app()'
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+
+# Each worker has its own connection pool of up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections,
+# so the default stops at 8 workers to stay inside Postgres' default max_connections of 100
+workers = int(os.getenv('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+
+# Import the app once in the master and fork the workers from it
+preload_app = True
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+
+def post_fork(server, worker):
+    # Connections opened by the master must not be shared with the workers
+    from database import engine
+    engine.dispose(close=False)
+
+def when_ready(server):
+    # Runs in the master once the app is loaded and before the first worker starts, so no job can
+    # be running yet
+    from app import recover_interrupted_jobs
+    recover_interrupted_jobs()
+
+def worker_exit(server, worker):
+    # A reload or a recycled worker would otherwise drop the jobs it queued without marking them
+    from app import cancel_queued_jobs
+    cancel_queued_jobs()
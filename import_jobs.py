@@ -0,0 +1,121 @@
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from database import logger, engine, pool_stats, set_database_role
+from data_processor import process_files
+from perf import track_sql
+
+IMPORT_JOB_WORKERS = int(os.getenv('IMPORT_JOB_WORKERS', 2))
+# Progress is written to import_jobs at most this often, phase changes and errors are written straight away
+IMPORT_JOB_UPDATE_INTERVAL = float(os.getenv('IMPORT_JOB_UPDATE_INTERVAL', 0.5))
+IMPORT_JOB_MAX_ERRORS = 100
+
+# Import jobs have their own threads, rule jobs have theirs (rule_jobs.executor), so a long rule
+# job does not hold up an upload's merge
+executor = ThreadPoolExecutor(
+    max_workers=IMPORT_JOB_WORKERS, thread_name_prefix='import-job', initializer=set_database_role, initargs=('worker',)
+)
+# Jobs this process has queued and not finished: job id -> (future, cleanup when cancelled)
+pending = {}
+
+def create_import_job(files):
+    with engine.connect() as conn:
+        return conn.execute(text("""
+            INSERT INTO import_jobs (status, phase, files, rows_processed, created_at, updated_at)
+            VALUES ('queued', NULL, :files, 0, now(), now())
+            RETURNING id
+        """), {'files': files}).scalar()
+
+def update_import_job(job_id, **fields):
+    assignments = ', '.join(f"{name} = :{name}" for name in fields)
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+            UPDATE import_jobs SET {assignments}, updated_at = now() WHERE id = :id
+        """), {'id': job_id, **fields})
+
+def fail_interrupted_jobs():
+    # Jobs run in the process that queued them, so at server startup any job still queued or
+    # running was lost with its process and will never finish
+    with engine.connect() as conn:
+        return conn.execute(text("""
+            UPDATE import_jobs
+            SET status = 'failed', errors = concat_ws(E'\n', errors, 'Interrupted by a server restart'), updated_at = now()
+            WHERE status IN ('queued', 'running')
+        """)).rowcount
+
+def get_import_job(job_id):
+    with engine.connect() as conn:
+        row = conn.execute(text("""
+            SELECT id, status, phase, files, rows_processed, errors, created_at, updated_at
+            FROM import_jobs WHERE id = :id
+        """), {'id': job_id}).fetchone()
+    if not row:
+        return None
+    job = row._asdict()
+    job['errors'] = job['errors'].splitlines() if job['errors'] else []
+    return job
+
+def job_progress(job_id):
+    # rows_processed is the running total for the current phase, summed over all files in the job
+    state = {'phase': None, 'rows': 0, 'phase_rows': {}, 'errors': [], 'written': 0.0}
+
+    def progress(phase, rows=0, error=None):
+        changed = phase != state['phase']
+        state['phase'] = phase
+        state['phase_rows'][phase] = state['phase_rows'].get(phase, 0) + rows
+        state['rows'] = state['phase_rows'][phase]
+        if error and len(state['errors']) < IMPORT_JOB_MAX_ERRORS:
+            state['errors'].append(error)
+
+        now = time.monotonic()
+        if changed or error or now - state['written'] >= IMPORT_JOB_UPDATE_INTERVAL:
+            state['written'] = now
+            update_import_job(job_id, phase=phase, rows_processed=state['rows'], errors='\n'.join(state['errors']) or None)
+
+    return progress, state
+
+def run_import_job(job_id, files, run_import):
+    # run_import(progress) does the work, the job records its progress and outcome
+    logger.info(f"Import job {job_id} started with {files} files")
+    update_import_job(job_id, status='running')
+    progress, state = job_progress(job_id)
+    try:
+        with track_sql(f"Import job {job_id} SQL"):
+            run_import(progress)
+    except Exception as e:
+        logger.exception(f"Import job {job_id} failed")
+        state['errors'].append(f"{type(e).__name__}: {e}")
+        update_import_job(job_id, status='failed', rows_processed=state['rows'], errors='\n'.join(state['errors']))
+        return
+    update_import_job(job_id, status='done', rows_processed=state['rows'], errors='\n'.join(state['errors']) or None)
+    logger.info(f"Import job {job_id} finished, connection pool {pool_stats()}")
+
+def import_uploaded(folder, paths, progress):
+    # Parse and load the upload's spooled files (data_processor.load_files, several files at once
+    # in the file worker pool), merge them, then remove the spool folder
+    try:
+        process_files(paths, progress)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def submit_import(folder, paths):
+    job_id = create_import_job(len(paths))
+    future = executor.submit(run_import_job, job_id, len(paths), lambda progress: import_uploaded(folder, paths, progress))
+    pending[job_id] = (future, lambda: shutil.rmtree(folder, ignore_errors=True))
+    future.add_done_callback(lambda _: pending.pop(job_id, None))
+    return job_id
+
+def cancel_queued_jobs():
+    # For a worker that is stopping: jobs it queued that have not started would be dropped without
+    # a trace, so they are cancelled and marked failed. Running jobs are finished before the
+    # process exits, unless gunicorn's graceful_timeout kills it first; those are marked failed
+    # at the next server start (fail_interrupted_jobs).
+    cancelled = 0
+    for job_id, (future, cleanup) in list(pending.items()):
+        if future.cancel():
+            cleanup()
+            update_import_job(job_id, status='failed', errors='Cancelled, the server worker stopped before the job started')
+            cancelled += 1
+    return cancelled
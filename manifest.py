@@ -0,0 +1,142 @@
+import bisect
+import hashlib
+from sqlalchemy import text
+from database import logger
+
+# Import manifest (migrations/0004_import_manifest.sql): one row per ingested .gifts file, keyed by
+# the sha256 of its content, with the date and line range of each account's transactions in it.
+# A file whose checksum is already listed is not staged again. Once a file has been merged, the
+# account dates it covers are already in transactions or the review queue, so rows of later files
+# on those dates are staged as covered and go to review without the duplicate checks. The last date
+# of a range is not counted as covered, the export may have been taken part way through that day.
+
+def covered_ranges(conn):
+    # {account: (starts, ends)}, the [first_date, last_date) ranges of merged files, overlapping
+    # ranges joined and sorted so a date is looked up with one bisect
+    rows = conn.execute(text("""
+        SELECT ma.account_number, ma.first_date, ma.last_date
+        FROM import_manifest_accounts ma
+        JOIN import_manifest m ON m.id = ma.manifest_id
+        WHERE m.merged_at IS NOT NULL AND ma.first_date < ma.last_date
+        ORDER BY ma.account_number, ma.first_date
+    """)).fetchall()
+    ranges = {}
+    for account, first_date, last_date in rows:
+        starts, ends = ranges.setdefault(account, ([], []))
+        if ends and first_date <= ends[-1]:
+            ends[-1] = max(ends[-1], last_date)
+        else:
+            starts.append(first_date)
+            ends.append(last_date)
+    return ranges
+
+# Files on disk are hashed in blocks of this size
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+def file_checksum(file_path):
+    # The checksum FileManifest gives the file's lines, for utf-8 files: hashing the raw bytes
+    # is the same as hashing each decoded line re-encoded
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(CHECKSUM_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def identical_file(conn, checksum):
+    # (file_name, imported_at) of an earlier file with this checksum, or None
+    return conn.execute(text("""
+        SELECT file_name, imported_at FROM import_manifest WHERE checksum = :checksum
+    """), {'checksum': checksum}).fetchone()
+
+class FileManifest:
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.digest = hashlib.sha256()
+        self.accounts = {}  # account -> [first_date, last_date, records, first_line, last_line]
+        self.records = 0
+        self.covered = 0
+
+    def lines(self, lines):
+        # Passes the file's lines through, adding them to the checksum
+        for line in lines:
+            self.digest.update(line.encode())
+            yield line
+
+    def add(self, account, date, line_number):
+        # Counts one transaction record, True when an earlier merged file covers its date
+        self.records += 1
+        entry = self.accounts.get(account)
+        if entry is None:
+            entry = self.accounts[account] = [date, date, 0, line_number, line_number]
+        elif date is not None:
+            entry[0] = date if entry[0] is None else min(entry[0], date)
+            entry[1] = date if entry[1] is None else max(entry[1], date)
+        entry[2] += 1
+        entry[4] = line_number
+
+        covered = False
+        if date is not None and account in self.ranges:
+            starts, ends = self.ranges[account]
+            index = bisect.bisect_right(starts, date) - 1
+            covered = index >= 0 and date < ends[index]
+        self.covered += covered
+        return covered
+
+    def identical(self, conn):
+        return identical_file(conn, self.digest.hexdigest())
+
+    def record(self, conn, file_name, file_seq):
+        # Adds the file to the manifest on the caller's transaction. Returns the manifest id, or None
+        # when a file with the same checksum is already listed (including one still being loaded,
+        # whose transaction this waits for).
+        manifest_id = conn.execute(text("""
+            INSERT INTO import_manifest (checksum, file_name, file_seq, records, covered_records, imported_at)
+            VALUES (:checksum, :file_name, :file_seq, :records, :covered_records, now())
+            ON CONFLICT (checksum) DO NOTHING
+            RETURNING id
+        """), {
+            'checksum': self.digest.hexdigest(), 'file_name': file_name, 'file_seq': file_seq,
+            'records': self.records, 'covered_records': self.covered,
+        }).scalar()
+        if manifest_id is not None and self.accounts:
+            conn.execute(text("""
+                INSERT INTO import_manifest_accounts (manifest_id, account_number, first_date, last_date, records, first_line, last_line)
+                VALUES (:manifest_id, :account_number, :first_date, :last_date, :records, :first_line, :last_line)
+            """), [
+                {'manifest_id': manifest_id, 'account_number': account, 'first_date': first_date, 'last_date': last_date,
+                 'records': records, 'first_line': first_line, 'last_line': last_line}
+                for account, (first_date, last_date, records, first_line, last_line) in self.accounts.items()
+            ])
+        return manifest_id
+
+# Scope of a merge started outside merge_staged_rows (benchmarks, tests): every staged row
+ALL_STAGED = ('TRUE', {})
+
+def staged_scope(manifest_ids=(), alias='gi'):
+    # (sql, params) condition for the staged rows a merge or the review queue may touch: rows of
+    # merged files, of the unmerged files in manifest_ids (those a merge captured when it started)
+    # and rows staged before the manifest existed. A file's rows are committed in one transaction
+    # with its manifest row, so a file staged while a merge runs is left whole for the next one.
+    return f"""NOT EXISTS (
+        SELECT 1 FROM import_manifest scope_m
+        WHERE scope_m.file_seq = {alias}.file_seq AND scope_m.merged_at IS NULL
+        AND scope_m.id <> ALL(CAST(:scope_manifest_ids AS integer[]))
+    )""", {'scope_manifest_ids': list(manifest_ids)}
+
+def unmerged_manifests(conn):
+    return conn.execute(text("SELECT id FROM import_manifest WHERE merged_at IS NULL")).scalars().all()
+
+def mark_merged(conn, manifest_ids):
+    # Only files whose rows were staged before the merge started, a file committed during the
+    # merge has not been merged yet and must not cover anything
+    if manifest_ids:
+        conn.execute(text("""
+            UPDATE import_manifest SET merged_at = now() WHERE id = ANY(:ids)
+        """), {'ids': list(manifest_ids)})
+        logger.info(f"Marked {len(manifest_ids)} manifest files merged")
+
+def forget_files(conn, file_name):
+    # Lets a file be imported again, e.g. after its staged rows were rejected
+    return conn.execute(text("""
+        DELETE FROM import_manifest WHERE file_name = :file_name
+    """), {'file_name': file_name}).rowcount
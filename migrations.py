@@ -0,0 +1,64 @@
+import os
+import re
+from sqlalchemy import text
+from database import logger
+
+# Versioned schema changes, applied in order by flask bootstrap-db. Each script is named
+# <version>_<description>.sql and runs in its own transaction together with its schema_migrations row.
+MIGRATIONS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+# Only one process may migrate at a time
+MIGRATION_LOCK_KEY = 727002
+
+def available_migrations():
+    migrations = []
+    for name in os.listdir(MIGRATIONS_FOLDER):
+        match = MIGRATION_FILE.match(name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_FOLDER, name)))
+    return sorted(migrations)
+
+def latest_version():
+    migrations = available_migrations()
+    return migrations[-1][0] if migrations else 0
+
+def schema_version(engine):
+    with engine.connect() as conn:
+        if conn.execute(text("SELECT to_regclass('schema_migrations')")).scalar() is None:
+            return 0
+        return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar()
+
+def run_migrations(engine):
+    # Returns the versions applied
+    applied = []
+    with engine.connect() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+        """))
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {'key': MIGRATION_LOCK_KEY})
+        try:
+            done = set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+            for version, name, path in available_migrations():
+                if version in done:
+                    continue
+                logger.info(f"Applying migration {version} {name}")
+                with open(path) as script:
+                    sql = script.read()
+                with engine.execution_options(isolation_level="READ COMMITTED").begin() as migration:
+                    # Straight to the DBAPI cursor without parameters, so the script's :: casts and
+                    # format() % placeholders are not read as bind parameters
+                    cursor = migration.connection.cursor()
+                    cursor.execute(sql)
+                    cursor.close()
+                    migration.execute(text("""
+                        INSERT INTO schema_migrations (version, name) VALUES (:version, :name)
+                    """), {'version': version, 'name': name})
+                applied.append(version)
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': MIGRATION_LOCK_KEY})
+    return applied
@@ -0,0 +1,14 @@
+-- Columns added after the first release. create_all does not add columns to existing tables.
+ALTER TABLE gifts_import
+ADD COLUMN IF NOT EXISTS near_duplicate_id INTEGER,
+ADD COLUMN IF NOT EXISTS near_duplicate_score FLOAT,
+ADD COLUMN IF NOT EXISTS file_seq BIGINT,
+ADD COLUMN IF NOT EXISTS line_number INTEGER;
+
+CREATE SEQUENCE IF NOT EXISTS gifts_import_file_seq;
+
+ALTER TABLE rules ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+
+ALTER TABLE transactions_categories
+ADD COLUMN IF NOT EXISTS rule_id INTEGER,
+ADD COLUMN IF NOT EXISTS rule_version INTEGER;
@@ -0,0 +1,18 @@
+-- Exact duplicate lookup in process_transactions and the near duplicate date window
+CREATE INDEX IF NOT EXISTS transactions_account_amount_date_idx ON transactions (account_number, amount, date);
+
+-- Per account reads: view_account_summary for one account, balance history, snapshots
+CREATE INDEX IF NOT EXISTS transactions_account_date_idx ON transactions (account_number, date);
+
+-- Rule preview and search pages, newest first
+CREATE INDEX IF NOT EXISTS transactions_date_id_idx ON transactions (date, id);
+
+-- Categories of given transactions (recategorise batches) and of one rule (recategorise candidates)
+CREATE INDEX IF NOT EXISTS transactions_categories_transaction_id_idx ON transactions_categories (transaction_id);
+CREATE INDEX IF NOT EXISTS transactions_categories_rule_id_idx ON transactions_categories (rule_id);
+
+-- Staged rows by record type, and the latest payee per destination account in process_payees
+CREATE INDEX IF NOT EXISTS gifts_import_record_type_idx ON gifts_import (record_type);
+CREATE INDEX IF NOT EXISTS gifts_import_payee_window_idx ON gifts_import
+    (destination_account_number, date DESC, file_seq DESC NULLS LAST, line_number DESC, id DESC)
+    WHERE record_type = 3;
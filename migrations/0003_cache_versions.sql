@@ -0,0 +1,5 @@
+-- Version counters for the read-through cache in cache.py, bumped by the write paths of each data set
+CREATE TABLE IF NOT EXISTS cache_versions (
+    name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
@@ -0,0 +1,27 @@
+-- Files already ingested, by content checksum, and the transactions each covers per account (manifest.py)
+CREATE TABLE IF NOT EXISTS import_manifest (
+    id SERIAL PRIMARY KEY,
+    checksum TEXT NOT NULL UNIQUE,          -- sha256 of the file content
+    file_name TEXT NOT NULL,
+    file_seq BIGINT,
+    records INTEGER NOT NULL,               -- Transaction records in the file
+    covered_records INTEGER NOT NULL,       -- Of those, staged as covered by earlier files
+    imported_at TIMESTAMP NOT NULL DEFAULT now(),
+    merged_at TIMESTAMP                     -- Set once its staged rows have been merged
+);
+
+CREATE TABLE IF NOT EXISTS import_manifest_accounts (
+    manifest_id INTEGER NOT NULL REFERENCES import_manifest (id) ON DELETE CASCADE,
+    account_number VARCHAR(32) NOT NULL,
+    first_date DATE,
+    last_date DATE,
+    records INTEGER NOT NULL,
+    first_line INTEGER,
+    last_line INTEGER,
+    PRIMARY KEY (manifest_id, account_number)
+);
+
+CREATE INDEX IF NOT EXISTS import_manifest_file_name_idx ON import_manifest (file_name);
+
+-- Staged rows on account dates an earlier merged file already covered
+ALTER TABLE gifts_import ADD COLUMN IF NOT EXISTS covered BOOLEAN NOT NULL DEFAULT false;
@@ -0,0 +1,58 @@
+-- transactions range partitioned by year of date, so date bounded reads and the duplicate check
+-- only touch the years they need. There is no default partition: every insert path creates the
+-- years of its dates first with transactions_ensure_partitions (database.ensure_transaction_partitions).
+-- The primary key includes the partition key, so transactions_categories can no longer have a
+-- foreign key to transactions.id.
+CREATE OR REPLACE FUNCTION transactions_ensure_partitions(first_date DATE, last_date DATE) RETURNS INTEGER AS $$
+DECLARE
+    year INTEGER;
+    created INTEGER := 0;
+BEGIN
+    IF first_date IS NULL OR last_date IS NULL THEN
+        RETURN 0;
+    END IF;
+    -- Two imports must not race to create the same year
+    PERFORM pg_advisory_xact_lock(727003);
+    FOR year IN EXTRACT(YEAR FROM first_date)::INTEGER .. EXTRACT(YEAR FROM last_date)::INTEGER LOOP
+        IF to_regclass(format('transactions_%s', year)) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+                'transactions_' || year, make_date(year, 1, 1), make_date(year + 1, 1, 1));
+            created := created + 1;
+        END IF;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    columns TEXT;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'transactions'::regclass) = 'p' THEN
+        RETURN;
+    END IF;
+
+    -- The view, triggers and search indexes are recreated by bootstrap-db after the migrations
+    DROP VIEW IF EXISTS view_account_summary;
+    ALTER TABLE transactions RENAME TO transactions_unpartitioned;
+    CREATE TABLE transactions (LIKE transactions_unpartitioned INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING STORAGE)
+        PARTITION BY RANGE (date);
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY transactions.id', pg_get_serial_sequence('transactions_unpartitioned', 'id'));
+
+    PERFORM transactions_ensure_partitions(MIN(date), MAX(date)) FROM transactions_unpartitioned;
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+    FROM pg_attribute
+    WHERE attrelid = 'transactions_unpartitioned'::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = '';
+    EXECUTE format('INSERT INTO transactions (%s) SELECT %s FROM transactions_unpartitioned', columns, columns);
+    DROP TABLE transactions_unpartitioned CASCADE;
+
+    -- Keys and indexes are built after the copy, under the names the old table's had.
+    -- 0002_hot_query_indexes.sql, now partitioned indexes:
+    ALTER TABLE transactions ADD PRIMARY KEY (id, date);
+    CREATE INDEX transactions_account_amount_date_idx ON transactions (account_number, amount, date);
+    CREATE INDEX transactions_account_date_idx ON transactions (account_number, date);
+    CREATE INDEX transactions_date_id_idx ON transactions (date, id);
+END;
+$$;
+
+ANALYZE transactions;
@@ -0,0 +1,135 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import Blueprint, g, request, session, jsonify
+from sqlalchemy import event
+from database import logger, engine
+
+# SQL instrumentation: every statement run through the shared engine (Flask-SQLAlchemy sessions and
+# the raw connections in data_processor alike) is counted against the request or job running it.
+# Statements slower than SLOW_QUERY_SECONDS go to the database.slow_queries logger, which is also
+# written to SLOW_QUERY_LOG when that is set. COPY through the raw psycopg2 cursor is not counted.
+SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_SECONDS', 0.5))
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG')
+# Slowest statements kept per request or job, and requests kept per route for /debug/perf
+PERF_SLOWEST = 5
+PERF_WINDOW = int(os.getenv('PERF_WINDOW', 1000))
+
+slow_query_logger = logging.getLogger('database.slow_queries')
+if SLOW_QUERY_LOG:
+    slow_query_logger.addHandler(logging.FileHandler(SLOW_QUERY_LOG))
+
+class SqlStats:
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.slowest = []  # (seconds, statement), slowest first
+
+    def add(self, statement, seconds):
+        self.statements += 1
+        self.seconds += seconds
+        if len(self.slowest) < PERF_SLOWEST or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(key=lambda slow: slow[0], reverse=True)
+            del self.slowest[PERF_SLOWEST:]
+
+    def summary(self):
+        slowest = '; '.join(f"{seconds * 1000:.1f}ms {' '.join(statement.split())[:200]}" for seconds, statement in self.slowest[:3])
+        return f"{self.statements} statements, {self.seconds:.3f}s in the database" + (f", slowest: {slowest}" if slowest else "")
+
+# Stats of the request or job running in this thread, None when nothing is tracking
+sql_stats = ContextVar('sql_stats', default=None)
+
+@event.listens_for(engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+@event.listens_for(engine, 'after_cursor_execute')
+def finish_statement(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['statement_started'].pop()
+    stats = sql_stats.get()
+    if stats is not None:
+        stats.add(statement, seconds)
+    if seconds >= SLOW_QUERY_SECONDS:
+        slow_query_logger.warning(f"Slow query {seconds:.3f}s: {' '.join(statement.split())}")
+
+@event.listens_for(engine, 'handle_error')
+def fail_statement(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('statement_started'):
+        conn.info['statement_started'].pop()
+
+@contextmanager
+def track_sql(name):
+    # Counts the statements run inside the block and logs a summary when it ends
+    stats = SqlStats()
+    token = sql_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        sql_stats.reset(token)
+        logger.info(f"{name}: {stats.summary()}")
+
+# Rolling request timings per route: (total ms, database ms, statements). Kept per process, so each
+# gunicorn worker reports only the requests it served.
+route_timings = {}
+route_timings_lock = threading.Lock()
+
+def percentile(values, fraction):
+    # Nearest rank on sorted values
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def route_percentiles():
+    with route_timings_lock:
+        snapshot = {route: list(timings) for route, timings in route_timings.items()}
+    report = {}
+    for route, timings in sorted(snapshot.items()):
+        total = sorted(timing[0] for timing in timings)
+        database = sorted(timing[1] for timing in timings)
+        report[route] = {
+            'requests': len(timings),
+            'total_ms': {'p50': percentile(total, 0.5), 'p95': percentile(total, 0.95), 'p99': percentile(total, 0.99)},
+            'db_ms': {'p50': percentile(database, 0.5), 'p95': percentile(database, 0.95), 'p99': percentile(database, 0.99)},
+            'statements_mean': sum(timing[2] for timing in timings) / len(timings),
+        }
+    return report
+
+perf_bp = Blueprint('perf', __name__)
+
+@perf_bp.before_app_request
+def start_request():
+    g.perf_started = time.perf_counter()
+    g.perf_token = sql_stats.set(SqlStats())
+
+@perf_bp.after_app_request
+def finish_request(response):
+    stats = sql_stats.get()
+    if stats is None or 'perf_started' not in g:
+        return response
+    total_ms = (time.perf_counter() - g.perf_started) * 1000
+    db_ms = stats.seconds * 1000
+    response.headers['Server-Timing'] = f'db;dur={db_ms:.1f};desc="{stats.statements} statements", total;dur={total_ms:.1f}'
+    route = f"{request.method} {request.url_rule.rule if request.url_rule else '(unmatched)'}"
+    with route_timings_lock:
+        route_timings.setdefault(route, deque(maxlen=PERF_WINDOW)).append((round(total_ms, 1), round(db_ms, 1), stats.statements))
+    return response
+
+@perf_bp.teardown_app_request
+def reset_request(exception):
+    # Server threads are reused, so statements after the request must not count against it
+    if 'perf_token' in g:
+        sql_stats.reset(g.perf_token)
+
+@perf_bp.route('/debug/perf')
+def debug_perf():
+    if 'username' in session:
+        return jsonify(route_percentiles())
+    return jsonify({'error': 'Unauthorized'}), 403
+
+def init_perf(app):
+    # Registered before the main blueprint so the first request schema check is counted too
+    app.register_blueprint(perf_bp)
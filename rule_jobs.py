@@ -0,0 +1,82 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from database import logger, engine, set_database_role
+from rules_engine import recategorise_rule
+from perf import track_sql
+
+# Rule jobs take turns on an advisory lock (rules_engine.recategorise_lock), more threads would
+# only wait for it
+RULE_JOB_WORKERS = int(os.getenv('RULE_JOB_WORKERS', 1))
+
+executor = ThreadPoolExecutor(
+    max_workers=RULE_JOB_WORKERS, thread_name_prefix='rule-job', initializer=set_database_role, initargs=('worker',)
+)
+# Jobs this process has queued and not finished, by job id
+pending = {}
+
+def create_rule_job(rule_id, rule_version):
+    with engine.connect() as conn:
+        return conn.execute(text("""
+            INSERT INTO rule_jobs (rule_id, rule_version, status, rows_total, rows_processed, rows_changed, created_at, updated_at)
+            VALUES (:rule_id, :rule_version, 'queued', 0, 0, 0, now(), now())
+            RETURNING id
+        """), {'rule_id': rule_id, 'rule_version': rule_version}).scalar()
+
+def update_rule_job(job_id, **fields):
+    assignments = ', '.join(f"{name} = :{name}" for name in fields)
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+            UPDATE rule_jobs SET {assignments}, updated_at = now() WHERE id = :id
+        """), {'id': job_id, **fields})
+
+def fail_interrupted_jobs():
+    # As import_jobs.fail_interrupted_jobs. Saving the rule again queues a job that re-evaluates
+    # what the lost one would have.
+    with engine.connect() as conn:
+        return conn.execute(text("""
+            UPDATE rule_jobs
+            SET status = 'failed', errors = concat_ws(E'\n', errors, 'Interrupted by a server restart'), updated_at = now()
+            WHERE status IN ('queued', 'running')
+        """)).rowcount
+
+def get_rule_job(job_id):
+    with engine.connect() as conn:
+        row = conn.execute(text("""
+            SELECT id, rule_id, rule_version, status, rows_total, rows_processed, rows_changed, errors, created_at, updated_at
+            FROM rule_jobs WHERE id = :id
+        """), {'id': job_id}).fetchone()
+    return row._asdict() if row else None
+
+def run_rule_job(job_id, rule_id):
+    logger.info(f"Rule job {job_id} started for rule {rule_id}")
+    update_rule_job(job_id, status='running')
+
+    def progress(processed, total, changed):
+        update_rule_job(job_id, rows_processed=processed, rows_total=total, rows_changed=changed)
+
+    try:
+        with track_sql(f"Rule job {job_id} SQL"):
+            changed = recategorise_rule(engine, rule_id, progress)
+    except Exception as e:
+        logger.exception(f"Rule job {job_id} failed")
+        update_rule_job(job_id, status='failed', errors=f"{type(e).__name__}: {e}")
+        return
+    update_rule_job(job_id, status='done', rows_changed=changed)
+    logger.info(f"Rule job {job_id} finished")
+
+def submit_recategorise(rule_id, rule_version=None):
+    job_id = create_rule_job(rule_id, rule_version)
+    future = executor.submit(run_rule_job, job_id, rule_id)
+    pending[job_id] = future
+    future.add_done_callback(lambda _: pending.pop(job_id, None))
+    return job_id
+
+def cancel_queued_jobs():
+    # As import_jobs.cancel_queued_jobs
+    cancelled = 0
+    for job_id, future in list(pending.items()):
+        if future.cancel():
+            update_rule_job(job_id, status='failed', errors='Cancelled, the server worker stopped before the job started')
+            cancelled += 1
+    return cancelled
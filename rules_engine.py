@@ -0,0 +1,317 @@
+import base64
+import datetime
+import json
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from sqlalchemy import text
+from database import logger
+
+# Transactions columns a rule condition may test, and how its string value is converted
+RULE_FIELDS = {
+    'account_number': str,
+    'date': datetime.date.fromisoformat,
+    'amount': float,
+    'particulars': str,
+    'code': str,
+    'reference': str,
+    'payee': str,
+    'transaction_type': str,
+    'destination_account_number': str,
+}
+RULE_OPERATORS = ['=', '!=', '<', '<=', '>', '>=', 'like']
+# `like` compiles to LIKE '%value%', which Postgres only accepts on the text columns
+TEXT_RULE_FIELDS = {field for field, convert in RULE_FIELDS.items() if convert is str}
+
+# Transactions re-evaluated per database transaction when a rule changes
+RECATEGORISE_BATCH_SIZE = 5000
+# Only one re-categorisation job runs at a time, across threads and worker processes
+RECATEGORISE_LOCK_KEY = 727002
+
+# The version and actions of each rule as they were loaded, from rule_snapshot's parameters.
+# Categories are written from these rather than from the rules tables, so they carry the version
+# of the conditions that were evaluated even when the rule is saved again while a job runs.
+SNAPSHOT_VERSIONS = """unnest(CAST(:snapshot_rule_ids AS integer[]), CAST(:snapshot_versions AS integer[])) AS rv(rule_id, version)"""
+SNAPSHOT_ACTIONS = """unnest(
+    CAST(:snapshot_action_rule_ids AS integer[]), CAST(:snapshot_category_ids AS integer[]), CAST(:snapshot_subcategory_ids AS integer[])
+) WITH ORDINALITY AS ra(rule_id, category_id, subcategory_id, position)"""
+
+# Rule preview page size
+PREVIEW_PAGE_SIZE = 100
+PREVIEW_MAX_PAGE_SIZE = 500
+
+# Columns returned for a transaction in previews and search results
+TRANSACTION_COLUMNS = """
+    t.id, t.account_number, t.date, t.amount, t.particulars, t.code, t.reference, t.payee,
+    t.transaction_type, t.destination_account_number
+"""
+
+def load_rules(conn):
+    # All rules with their conditions and actions in three queries, in rule id order
+    rules = {}
+    for row in conn.execute(text("SELECT id, name, version FROM rules ORDER BY id")):
+        rules[row.id] = {'id': row.id, 'name': row.name, 'version': row.version, 'conditions': [], 'actions': []}
+    for row in conn.execute(text("""
+        SELECT rule_id, field, operator, value, and_condition FROM rule_conditions ORDER BY rule_id, id
+    """)):
+        if row.rule_id in rules:
+            rules[row.rule_id]['conditions'].append(row._asdict())
+    for row in conn.execute(text("""
+        SELECT rule_id, category_id, subcategory_id FROM rule_actions ORDER BY rule_id, id
+    """)):
+        if row.rule_id in rules:
+            rules[row.rule_id]['actions'].append(row._asdict())
+    return list(rules.values())
+
+def rule_snapshot(rules):
+    # Parameters for SNAPSHOT_VERSIONS and SNAPSHOT_ACTIONS
+    actions = [(rule['id'], action) for rule in rules for action in rule['actions']]
+    return {
+        'snapshot_rule_ids': [rule['id'] for rule in rules],
+        'snapshot_versions': [rule['version'] for rule in rules],
+        'snapshot_action_rule_ids': [rule_id for rule_id, _ in actions],
+        'snapshot_category_ids': [action['category_id'] for _, action in actions],
+        'snapshot_subcategory_ids': [action['subcategory_id'] for _, action in actions],
+    }
+
+def normalise_conditions(conditions):
+    # Splits a condition chain into its shape (AND/OR joins, fields and operators) and its values,
+    # converted to the column types. Chains with the same shape compile to the same SQL.
+    # Raises ValueError for fields or operators a rule may not use, or values of the wrong type.
+    shape = []
+    values = []
+    for i, condition in enumerate(conditions):
+        field = condition.get('field')
+        operator = (condition.get('operator') or '').lower()
+        if field not in RULE_FIELDS:
+            raise ValueError(f"Invalid field: {field}")
+        if operator not in RULE_OPERATORS:
+            raise ValueError(f"Invalid operator: {condition.get('operator')}")
+        if operator == 'like' and field not in TEXT_RULE_FIELDS:
+            raise ValueError(f"Contains (like) only applies to text fields, not {field}")
+        # The first condition's AND/OR is ignored
+        joiner = None if i == 0 else ('AND' if str(condition.get('and_condition')).lower() == 'true' else 'OR')
+        shape.append((joiner, field, operator))
+        try:
+            values.append(f"%{condition.get('value')}%" if operator == 'like' else RULE_FIELDS[field](condition.get('value')))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid value for {field}: {condition.get('value')}") from e
+    return tuple(shape), values
+
+def chain_sql(shape, prefix, alias='t'):
+    # Conditions are joined left to right, so SQL precedence applies (AND before OR), as in the rule preview
+    parts = []
+    for i, (joiner, field, operator) in enumerate(shape):
+        if joiner:
+            parts.append(joiner)
+        parts.append(f"{alias}.{field} {'LIKE' if operator == 'like' else operator} :{prefix}_{i}")
+    return ' '.join(parts)
+
+def compile_condition_chain(conditions, params, prefix, alias='t'):
+    shape, values = normalise_conditions(conditions)
+    params.update({f"{prefix}_{i}": value for i, value in enumerate(values)})
+    return chain_sql(shape, prefix, alias)
+
+def compile_rule(rule, params, prefix, alias='t'):
+    # Predicate for one rule, or None when it has nothing to apply or an invalid condition
+    if not rule['conditions'] or not rule['actions']:
+        return None
+    try:
+        return compile_condition_chain(rule['conditions'], params, prefix, alias)
+    except ValueError as e:
+        logger.warning(f"Skipping rule {rule['id']} ({rule['name']}): {e}")
+        return None
+
+def compile_rules(rules, alias='t'):
+    # One CASE expression that evaluates to the id of the first matching rule (lowest id wins)
+    params = {}
+    branches = []
+    for rule in rules:
+        predicate = compile_rule(rule, params, f"r{rule['id']}", alias)
+        if predicate is not None:
+            branches.append(f"WHEN {predicate} THEN {int(rule['id'])}")
+    if not branches:
+        return None, params
+    return f"CASE {' '.join(branches)} END", params
+
+def categorise_transactions(conn, transaction_ids=None):
+    # Apply every rule to the given transactions, or to all uncategorised transactions when
+    # transaction_ids is None, and write their actions to transactions_categories in one statement
+    if transaction_ids is not None and not transaction_ids:
+        return 0
+    started = time.perf_counter()
+    rules = load_rules(conn)
+    case, params = compile_rules(rules)
+    if case is None:
+        return 0
+
+    if transaction_ids is None:
+        scope = "NOT EXISTS (SELECT 1 FROM transactions_categories tc WHERE tc.transaction_id = t.id)"
+    else:
+        scope = "t.id = ANY(:transaction_ids)"
+        params['transaction_ids'] = list(transaction_ids)
+
+    categorised = conn.execute(text(f"""
+        INSERT INTO transactions_categories (transaction_id, category_id, sub_category_id, rule_id, rule_version)
+        SELECT matched.id, ra.category_id, ra.subcategory_id, rv.rule_id, rv.version
+        FROM (
+            SELECT t.id, {case} AS rule_id
+            FROM transactions t
+            WHERE {scope}
+        ) matched
+        JOIN {SNAPSHOT_VERSIONS} ON rv.rule_id = matched.rule_id
+        JOIN {SNAPSHOT_ACTIONS} ON ra.rule_id = matched.rule_id
+        ORDER BY matched.id, ra.position
+    """), {**params, **rule_snapshot(rules)}).rowcount
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Categorised transactions against {len(rules)} rules in {elapsed:.2f}s, wrote {categorised} categories")
+    return categorised
+
+def find_recategorise_candidates(conn, rule_id, rules):
+    # The only transactions a rule edit or delete can affect: those the rule categorised before
+    # (any version) and those its current version matches. Transactions with a category that no
+    # rule assigned (rule_id NULL) are left alone. The two sets are a UNION rather than an OR so
+    # the rule's predicate can use the search indexes on its own.
+    params = {'rule_id': rule_id}
+    rule = next((rule for rule in rules if rule['id'] == rule_id), None)
+    predicate = compile_rule(rule, params, 'candidate') if rule else None
+    return conn.execute(text(f"""
+        SELECT candidates.id
+        FROM (
+            SELECT t.id
+            FROM transactions_categories tc
+            JOIN transactions t ON t.id = tc.transaction_id
+            WHERE tc.rule_id = :rule_id
+            UNION
+            SELECT t.id FROM transactions t WHERE {predicate or 'false'}
+        ) candidates
+        WHERE NOT EXISTS (SELECT 1 FROM transactions_categories tc WHERE tc.transaction_id = candidates.id AND tc.rule_id IS NULL)
+        ORDER BY candidates.id
+    """), params).scalars().all()
+
+def recategorise_batch(conn, transaction_ids, case, params):
+    # Re-run every rule over the batch and rewrite the categories of transactions whose winning
+    # rule or rule version changed. params includes the rule_snapshot the CASE was compiled from.
+    # Returns the number of transactions rewritten.
+    conn.execute(text(f"""
+        CREATE TEMP TABLE recategorised ON COMMIT DROP AS
+        SELECT matched.id, matched.rule_id, rv.version AS rule_version
+        FROM (
+            SELECT t.id, {case or 'NULL::integer'} AS rule_id
+            FROM transactions t
+            WHERE t.id = ANY(:transaction_ids)
+        ) matched
+        LEFT JOIN {SNAPSHOT_VERSIONS} ON rv.rule_id = matched.rule_id
+    """), {**params, 'transaction_ids': transaction_ids})
+    changed = conn.execute(text("""
+        SELECT e.id
+        FROM recategorised e
+        LEFT JOIN (
+            SELECT transaction_id, MIN(rule_id) AS rule_id, MIN(rule_version) AS rule_version
+            FROM transactions_categories
+            WHERE transaction_id = ANY(:transaction_ids)
+            GROUP BY transaction_id
+        ) existing ON existing.transaction_id = e.id
+        WHERE e.rule_id IS DISTINCT FROM existing.rule_id
+        OR e.rule_version IS DISTINCT FROM existing.rule_version
+    """), {'transaction_ids': transaction_ids}).scalars().all()
+    if changed:
+        conn.execute(text("""
+            DELETE FROM transactions_categories WHERE transaction_id = ANY(:changed)
+        """), {'changed': changed})
+        conn.execute(text(f"""
+            INSERT INTO transactions_categories (transaction_id, category_id, sub_category_id, rule_id, rule_version)
+            SELECT e.id, ra.category_id, ra.subcategory_id, e.rule_id, e.rule_version
+            FROM recategorised e
+            JOIN {SNAPSHOT_ACTIONS} ON ra.rule_id = e.rule_id
+            WHERE e.id = ANY(:changed)
+            ORDER BY e.id, ra.position
+        """), {**params, 'changed': changed})
+    return len(changed)
+
+@contextmanager
+def recategorise_lock(engine):
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {'key': RECATEGORISE_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': RECATEGORISE_LOCK_KEY})
+
+def recategorise_rule(engine, rule_id, progress=None):
+    # Incrementally re-evaluate the transactions a saved or deleted rule could affect, in batches
+    # of RECATEGORISE_BATCH_SIZE, each in its own transaction. progress(processed, total, changed)
+    # Jobs run one at a time and load the rules once they hold the lock, so each job starts from
+    # rules at least as new as the job before it. A rule saved while a job runs gets its own job
+    # after it, which finds the categories this one wrote tagged with the older version.
+    started = time.perf_counter()
+    with recategorise_lock(engine):
+        with engine.connect() as conn:
+            rules = load_rules(conn)
+            candidates = find_recategorise_candidates(conn, rule_id, rules)
+        case, params = compile_rules(rules)
+        params.update(rule_snapshot(rules))
+
+        changed = 0
+        for start in range(0, len(candidates), RECATEGORISE_BATCH_SIZE):
+            batch = candidates[start:start + RECATEGORISE_BATCH_SIZE]
+            with engine.execution_options(isolation_level="READ COMMITTED").begin() as conn:
+                changed += recategorise_batch(conn, batch, case, params)
+            if progress:
+                progress(start + len(batch), len(candidates), changed)
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Recategorised {len(candidates)} transactions for rule {rule_id} in {elapsed:.2f}s, changed {changed}")
+    return changed
+
+@lru_cache(maxsize=256)
+def preview_statement(shape, after_cursor):
+    # Compiled once per condition shape, newest first so a page is a short range read on (date, id).
+    # `like` conditions are plain LIKE '%value%', which the pg_trgm indexes on the search fields serve.
+    # t.date <= :cursor_date repeats the keyset so later pages skip the newer partitions
+    keyset = "AND t.date <= :cursor_date AND (t.date, t.id) < (:cursor_date, :cursor_id)" if after_cursor else ""
+    return text(f"""
+        SELECT {TRANSACTION_COLUMNS}, a.account_name as account_name
+        FROM transactions t
+        JOIN accounts a ON t.account_number = a.account_number
+        WHERE ({chain_sql(shape, 'value')}) {keyset}
+        ORDER BY t.date DESC, t.id DESC
+        LIMIT :limit
+    """)
+
+@lru_cache(maxsize=256)
+def preview_estimate_statement(shape):
+    return text(f"""
+        EXPLAIN (FORMAT JSON) SELECT 1 FROM transactions t WHERE {chain_sql(shape, 'value')}
+    """)
+
+def encode_preview_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([row.date.isoformat(), row.id]).encode()).decode()
+
+def decode_preview_cursor(cursor):
+    try:
+        date, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.date.fromisoformat(date), int(id)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def preview_rule(conn, conditions, cursor=None, limit=PREVIEW_PAGE_SIZE):
+    # One page of the transactions a condition chain matches, a cursor for the next page and the
+    # planner's estimate of the total. Raises ValueError for invalid conditions or cursors.
+    shape, values = normalise_conditions(conditions)
+    params = {f"value_{i}": value for i, value in enumerate(values)}
+    limit = max(1, min(int(limit), PREVIEW_MAX_PAGE_SIZE))
+
+    plan = conn.execute(preview_estimate_statement(shape), params).scalar()
+
+    page_params = {**params, 'limit': limit + 1}
+    if cursor:
+        page_params['cursor_date'], page_params['cursor_id'] = decode_preview_cursor(cursor)
+    rows = conn.execute(preview_statement(shape, bool(cursor)), page_params).fetchall()
+
+    return {
+        'transactions': [row._asdict() for row in rows[:limit]],
+        'next_cursor': encode_preview_cursor(rows[limit - 1]) if len(rows) > limit else None,
+        'estimated_count': plan[0]['Plan']['Plan Rows'],
+    }
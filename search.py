@@ -0,0 +1,41 @@
+import re
+from functools import lru_cache
+from sqlalchemy import text
+from rules_engine import TRANSACTION_COLUMNS, PREVIEW_PAGE_SIZE, PREVIEW_MAX_PAGE_SIZE, encode_preview_cursor, decode_preview_cursor
+
+SEARCH_TERM = re.compile(r'[^\W_]+')
+
+def search_query(query):
+    # Every word of the query as a prefix match against search_vector: "count 12" -> 'count:* & 12:*'
+    return ' & '.join(f"{term}:*" for term in SEARCH_TERM.findall((query or '').lower()))
+
+@lru_cache(maxsize=2)
+def search_statement(after_cursor):
+    keyset = "AND t.date <= :cursor_date AND (t.date, t.id) < (:cursor_date, :cursor_id)" if after_cursor else ""
+    return text(f"""
+        SELECT {TRANSACTION_COLUMNS}, a.account_name as account_name
+        FROM transactions t
+        LEFT JOIN accounts a ON t.account_number = a.account_number
+        WHERE t.search_vector @@ to_tsquery('simple', :query) {keyset}
+        ORDER BY t.date DESC, t.id DESC
+        LIMIT :limit
+    """)
+
+def search_transactions(conn, query, cursor=None, limit=PREVIEW_PAGE_SIZE):
+    # One page of transactions whose payee, particulars, code or reference contain words starting
+    # with each word of query, newest first, with a cursor for the next page. Raises ValueError
+    # for a query without any words or an invalid cursor.
+    tsquery = search_query(query)
+    if not tsquery:
+        raise ValueError("No search terms provided")
+    limit = max(1, min(int(limit), PREVIEW_MAX_PAGE_SIZE))
+
+    params = {'query': tsquery, 'limit': limit + 1}
+    if cursor:
+        params['cursor_date'], params['cursor_id'] = decode_preview_cursor(cursor)
+    rows = conn.execute(search_statement(bool(cursor)), params).fetchall()
+
+    return {
+        'transactions': [row._asdict() for row in rows[:limit]],
+        'next_cursor': encode_preview_cursor(rows[limit - 1]) if len(rows) > limit else None,
+    }
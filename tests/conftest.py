@@ -0,0 +1,52 @@
+import os
+import pytest
+
+# Tests that need Postgres run against their own database, created from scratch for the session
+# and dropped afterwards, never the one POSTGRES_DB points at. The server and credentials are the
+# usual POSTGRES_* settings; without a reachable server those tests are skipped.
+TEST_DATABASE = os.getenv('TEST_POSTGRES_DB', 'simplebudget_test')
+os.environ['POSTGRES_DB'] = TEST_DATABASE
+
+# Every table holding data, emptied before each database test
+DATA_TABLES = [
+    'transactions', 'gifts_import', 'accounts', 'payees', 'account_balances', 'account_balance_snapshots',
+    'import_jobs', 'import_manifest', 'import_manifest_accounts', 'rules', 'rule_conditions', 'rule_actions',
+    'rule_jobs', 'transactions_categories', 'category', 'subcategory',
+]
+
+@pytest.fixture(scope='session')
+def test_database():
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.exc import OperationalError
+    from database import ROOT_DATABASE_URI, engine, bootstrap_db, create_transaction_objects, database_role
+    from migrations import run_migrations
+    from app import create_app
+
+    root_engine = create_engine(ROOT_DATABASE_URI, isolation_level='AUTOCOMMIT', connect_args={'connect_timeout': 5})
+    try:
+        with root_engine.connect() as conn:
+            conn.execute(text(f"DROP DATABASE IF EXISTS {TEST_DATABASE} WITH (FORCE)"))
+    except OperationalError as e:
+        root_engine.dispose()
+        pytest.skip(f"No Postgres server for the test database: {str(e.orig).strip().splitlines()[0]}")
+
+    with database_role('worker'):
+        bootstrap_db(create_app())
+        run_migrations(engine)
+        create_transaction_objects()
+    yield engine
+
+    engine.dispose()
+    with root_engine.connect() as conn:
+        conn.execute(text(f"DROP DATABASE IF EXISTS {TEST_DATABASE} WITH (FORCE)"))
+    root_engine.dispose()
+
+@pytest.fixture
+def db(test_database):
+    # The shared engine, with every data table empty and the page cache cleared
+    from sqlalchemy import text
+    import cache
+    with test_database.connect() as conn:
+        conn.execute(text(f"TRUNCATE {', '.join(DATA_TABLES)} RESTART IDENTITY CASCADE"))
+    cache.cache.clear()
+    return test_database
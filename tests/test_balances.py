@@ -0,0 +1,88 @@
+import datetime
+from sqlalchemy import text
+from data_processor import (
+    add_transaction, get_balance_history, get_import_page, merge_staged_rows, reconcile_account_balances, refresh_balance_snapshots,
+)
+from database import ensure_transaction_partitions
+from test_merge import AGAIN, FIRST, rows, upload
+
+def balances(conn):
+    return rows(conn, "SELECT account_number, balance, transaction_count FROM account_balances ORDER BY account_number")
+
+def test_account_balances_follow_every_write(db):
+    with db.connect() as conn:
+        ensure_transaction_partitions(conn, datetime.date(2024, 1, 1), datetime.date(2024, 1, 1))
+        conn.execute(text("""
+            INSERT INTO transactions (account_number, date, amount, payee)
+            VALUES ('a', '2024-01-01', -10.25, 'X'), ('a', '2024-01-02', 5, 'Y'), ('b', '2024-01-03', -1, 'Z')
+        """))
+        assert reconcile_account_balances() == []
+        assert balances(conn) == [('a', -5.25, 2), ('b', -1, 1)]
+
+        conn.execute(text("UPDATE transactions SET account_number = 'b', amount = -4 WHERE payee = 'X'"))
+        assert reconcile_account_balances() == []
+        assert balances(conn) == [('a', 5, 1), ('b', -5, 2)]
+
+        conn.execute(text("DELETE FROM transactions WHERE payee = 'Y'"))
+        assert reconcile_account_balances() == []
+        assert rows(conn, "SELECT balance, transaction_count FROM account_balances WHERE account_number = 'a'") in ([], [(0, 0)])
+
+    upload(('first.gifts', FIRST))
+    merge_staged_rows()
+    assert reconcile_account_balances() == []
+
+    # AGAIN repeats FIRST's two rows, which are held for review, and accepting them counts them again
+    upload(('again.gifts', AGAIN))
+    merge_staged_rows()
+    held = [row['id'] for row in get_import_page()['rows']]
+    assert len(held) == 2
+    assert add_transaction(held) == 2
+    assert reconcile_account_balances() == []
+    with db.connect() as conn:
+        assert rows(conn, "SELECT balance, transaction_count FROM account_balances WHERE account_number = '11-1111-1111111-00'") == [(-90, 5)]
+
+def seed_history(conn):
+    # Account a, opening balance 100, with transactions from January to April 2024
+    ensure_transaction_partitions(conn, datetime.date(2024, 1, 1), datetime.date(2024, 1, 1))
+    conn.execute(text("INSERT INTO accounts (account_number, account_name, opening_balance) VALUES ('a', 'A', 100)"))
+    conn.execute(text("""
+        INSERT INTO transactions (account_number, date, amount, payee)
+        SELECT 'a', DATE '2024-01-01' + i * 3, (i % 7) - 3.5, 'P' FROM generate_series(0, 40) AS i
+    """))
+
+def snapshot_dates(conn):
+    return [row[0] for row in rows(conn, "SELECT snapshot_date FROM account_balance_snapshots WHERE account_number = 'a' ORDER BY snapshot_date")]
+
+def test_back_dated_insert_drops_later_snapshots(db):
+    with db.connect() as conn:
+        seed_history(conn)
+        refresh_balance_snapshots()
+        month_ends = [datetime.date(2024, 1, 31), datetime.date(2024, 2, 29), datetime.date(2024, 3, 31), datetime.date(2024, 4, 30)]
+        assert snapshot_dates(conn) == month_ends
+        conn.execute(text("INSERT INTO transactions (account_number, date, amount, payee) VALUES ('a', '2024-02-10', -50, 'LATE')"))
+        assert snapshot_dates(conn) == month_ends[:1]
+        refresh_balance_snapshots()
+        assert snapshot_dates(conn) == month_ends
+        assert rows(conn, "SELECT balance FROM account_balance_snapshots WHERE snapshot_date = '2024-04-30'") == rows(conn, """
+            SELECT SUM(amount::numeric) FROM transactions WHERE account_number = 'a' AND date <= '2024-04-30'
+        """)
+
+def test_balance_history_matches_a_full_recomputation(db):
+    with db.connect() as conn:
+        seed_history(conn)
+        refresh_balance_snapshots()
+        start, end = datetime.date(2024, 2, 10), datetime.date(2024, 4, 5)
+        # The opening balance plus every transaction up to the day, without the snapshots
+        expected = dict(conn.execute(text("""
+            SELECT day::date, round(100 + COALESCE((
+                SELECT SUM(amount::numeric) FROM transactions WHERE account_number = 'a' AND date <= day
+            ), 0), 2)
+            FROM generate_series(CAST(:start AS date), CAST(:end AS date), interval '1 day') AS day
+        """), {'start': start, 'end': end}).fetchall())
+        # The history starts after the January snapshot, so it is summed from there
+        assert snapshot_dates(conn)[0] < start
+    daily = get_balance_history('a', start, end)
+    assert [tuple(row) for row in daily] == sorted(expected.items())
+    monthly = get_balance_history('a', start, end, interval='monthly')
+    assert [row[0] for row in monthly] == [datetime.date(2024, 2, 29), datetime.date(2024, 3, 31), end]
+    assert all(row[1] == expected[row[0]] for row in monthly)
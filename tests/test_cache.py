@@ -0,0 +1,70 @@
+import time
+import pytest
+from sqlalchemy import text
+import cache
+from cache import ACCOUNTS, CATEGORIES, RULES, cached
+from data_processor import add_transaction, get_import_page, merge_staged_rows
+from test_merge import FIRST, AGAIN, upload
+
+@pytest.fixture
+def client(db, monkeypatch):
+    import app
+    # Rule edits queue a recategorise job, which these tests don't need
+    monkeypatch.setattr(app, 'submit_recategorise', lambda rule_id, version=None: 1)
+    client = app.create_app().test_client()
+    with client.session_transaction() as session:
+        session['username'] = 'test'
+    return client
+
+def read(names):
+    # Reads names through the cache, True when the loader ran
+    loads = []
+    cached(names, ('test',) + names, lambda: loads.append(1))
+    return bool(loads)
+
+def bumps(write, names):
+    # Runs write, returns the data sets whose version it changed, after checking reads miss for exactly those
+    for name in names:
+        read((name,))
+    before = cache.versions.get(names)
+    write()
+    after = cache.versions.get(names)
+    changed = {name for name in names if after[name] != before[name]}
+    assert {name for name in names if read((name,))} == changed
+    return changed
+
+def test_a_read_hits_until_its_version_is_bumped(db):
+    assert read((ACCOUNTS,))
+    assert not read((ACCOUNTS,))
+    cache.invalidate(RULES)
+    assert not read((ACCOUNTS,))
+    cache.invalidate(ACCOUNTS)
+    assert read((ACCOUNTS,))
+
+def test_merge_and_accept_bump_accounts(db):
+    names = (ACCOUNTS, CATEGORIES, RULES)
+    upload(('first.gifts', FIRST))
+    assert bumps(merge_staged_rows, names) == {ACCOUNTS}
+    upload(('again.gifts', AGAIN))
+    merge_staged_rows()
+    held = [row['id'] for row in get_import_page()['rows']]
+    assert bumps(lambda: add_transaction(held), names) == {ACCOUNTS}
+
+def test_category_and_rule_edits_bump_their_data_set(db, client):
+    names = (ACCOUNTS, CATEGORIES, RULES)
+    assert bumps(lambda: client.post('/add_category', data={'category_name': 'Food'}), names) == {CATEGORIES}
+    assert bumps(lambda: client.post('/edit_category', data={'category_id': 1, 'category_name': 'Groceries'}), names) == {CATEGORIES}
+    assert bumps(lambda: client.post('/api/add_edit_rule', data={
+        'rule_name': 'Shop', 'condition_field[]': 'payee', 'condition_operator[]': '=', 'condition_value[]': 'SHOP',
+        'condition_and_condition[]': 'true', 'action_category_id[]': '1', 'action_subcategory_id[]': '',
+    }), names) == {RULES}
+    with db.connect() as conn:
+        rule_id = conn.execute(text("SELECT id FROM rules")).scalar()
+    assert bumps(lambda: client.get(f'/delete_rule/{rule_id}'), names) == {RULES}
+
+def test_an_expired_entry_is_reloaded(db, monkeypatch):
+    monkeypatch.setattr(cache.cache, 'ttl', 0.05)
+    assert read((CATEGORIES,))
+    assert not read((CATEGORIES,))
+    time.sleep(0.1)
+    assert read((CATEGORIES,))
@@ -0,0 +1,67 @@
+import datetime
+import pytest
+from sqlalchemy import text
+from database import ensure_transaction_partitions
+from duplicates import NEAR_DUPLICATE_THRESHOLD, detect_near_duplicates, score_candidate, similarity
+
+def fields(payee, particulars='', reference=''):
+    return {'payee': payee, 'particulars': particulars, 'reference': reference}
+
+def test_similarity_ignores_case_and_spaces_and_blanks_count_nothing():
+    assert similarity(' Countdown ', 'COUNTDOWN') == 1.0
+    assert similarity('COUNTDOWN', None) == 0.0
+    assert similarity('', '  ') == 0.0
+    assert 0.8 < similarity('COUNTDOWN AUCKLAND', 'COUNTDOWN AUCKLND') < 1.0
+
+@pytest.mark.parametrize('staged, existing, score', [
+    (fields('SHOP', 'card', 'ref1'), fields('shop', 'CARD', 'REF1'), 1.0),
+    (fields('SHOP', 'card', 'ref1'), fields('SHOP', 'card', 'zzzz'), 0.75),
+    (fields('SHOP', 'card', 'ref1'), fields('XXXX', 'card', 'ref1'), 0.5),
+    # The same payee on its own is not enough
+    (fields('CAFE'), fields('CAFE'), 0.5),
+])
+def test_score_candidate_weights_payee_particulars_and_reference(staged, existing, score):
+    assert score_candidate(staged, existing) == pytest.approx(score)
+
+def test_threshold_needs_more_than_the_payee_and_one_other_field():
+    assert score_candidate(fields('SHOP', 'card', 'ref1'), fields('SHOP', 'card', 'zzzz')) < NEAR_DUPLICATE_THRESHOLD
+    assert score_candidate(fields('COUNTDOWN AUCKLND', 'card', 'ref1'), fields('COUNTDOWN AUCKLAND', 'card', 'ref1')) >= NEAR_DUPLICATE_THRESHOLD
+
+def stage(conn, account, amount, date, payee, particulars='', reference=''):
+    return conn.execute(text("""
+        INSERT INTO gifts_import (
+            "record_type", "internal_reference", "source_account_number", "amount", "unknown", "transaction_reference",
+            "particulars", "code", "reference", "payee", "date", "optional", "transaction_type", "misc_field",
+            "destination_account_number", "consecutive_duplicates"
+        )
+        VALUES (3, 0, :account, :amount, 0, 0, :particulars, '', :reference, :payee, :date, '', 'DD', 0, 'dest', 0)
+        RETURNING id
+    """), {'account': account, 'amount': amount, 'date': date, 'payee': payee, 'particulars': particulars, 'reference': reference}).scalar()
+
+def test_detect_near_duplicates_blocks_on_account_amount_and_days(db):
+    with db.connect() as conn:
+        ensure_transaction_partitions(conn, datetime.date(2024, 1, 1), datetime.date(2024, 1, 1))
+        existing = {(payee, date): id for payee, date, id in conn.execute(text("""
+            INSERT INTO transactions (account_number, amount, date, payee, particulars, code, reference, transaction_type, destination_account_number)
+            VALUES ('a', -12.5, '2024-01-10', 'COUNTDOWN AUCKLAND', 'CARD 1234', '', 'REF9', 'DD', 'dest'),
+                   ('a', -12.5, '2024-01-12', 'COUNTDOWN AUCKLAND', 'CARD 1234', '', 'REF9', 'DD', 'dest'),
+                   ('a', -4.5, '2024-01-10', 'CAFE', '', '', '', 'DD', 'dest')
+            RETURNING payee, date, id
+        """))}
+        staged = {
+            # A day after the first and the second transaction, the second scores the same and is as close
+            'next_day': stage(conn, 'a', -12.5, '2024-01-11', 'COUNTDOWN AUCKLND', 'CARD 1234', 'REF9'),
+            'closest': stage(conn, 'a', -12.5, '2024-01-13', 'COUNTDOWN AUCKLND', 'CARD 1234', 'REF9'),
+            'too_far': stage(conn, 'a', -12.5, '2024-01-15', 'COUNTDOWN AUCKLND', 'CARD 1234', 'REF9'),
+            'other_amount': stage(conn, 'a', -12.6, '2024-01-10', 'COUNTDOWN AUCKLND', 'CARD 1234', 'REF9'),
+            'other_account': stage(conn, 'b', -12.5, '2024-01-10', 'COUNTDOWN AUCKLND', 'CARD 1234', 'REF9'),
+            # Left to the exact duplicate check
+            'exact': stage(conn, 'a', -12.5, '2024-01-10', 'COUNTDOWN AUCKLAND', 'CARD 1234', 'REF9'),
+            # The next day's coffee
+            'repeat_purchase': stage(conn, 'a', -4.5, '2024-01-11', 'CAFE'),
+        }
+        assert detect_near_duplicates(conn) == 2
+        flagged = dict(conn.execute(text("SELECT id, near_duplicate_id FROM gifts_import WHERE near_duplicate_id IS NOT NULL")).fetchall())
+    assert flagged[staged['next_day']] in (existing['COUNTDOWN AUCKLAND', datetime.date(2024, 1, 10)], existing['COUNTDOWN AUCKLAND', datetime.date(2024, 1, 12)])
+    assert flagged[staged['closest']] == existing['COUNTDOWN AUCKLAND', datetime.date(2024, 1, 12)]
+    assert set(flagged) == {staged['next_day'], staged['closest']}
@@ -0,0 +1,39 @@
+import datetime
+import io
+from gifts_parser import GIFTS_FIELDNAMES, parse_gifts, write_reject_report
+
+TRANSACTION = "3,12,12-3456-0000001-00,-45.50,0,7,COUNTDOWN,CODE,REF1,COUNTDOWN,03/02/24,,DD,0,99-0000-0001-00\n"
+
+def test_parse_converts_columns_and_appends_line_number():
+    records = list(parse_gifts(io.StringIO(TRANSACTION)))
+    assert records == [(
+        3, 12, '12-3456-0000001-00', -45.5, 0, 7, 'COUNTDOWN', 'CODE', 'REF1', 'COUNTDOWN',
+        datetime.date(2024, 2, 3), '', 'DD', 0, '99-0000-0001-00', 1,
+    )]
+
+def test_parse_fills_missing_trailing_columns_with_none():
+    record, = parse_gifts(io.StringIO("5,0,12-3456-0000001-00,1000.00,0,0,,,,Account 1,01/01/24\n"))
+    assert len(record) == len(GIFTS_FIELDNAMES) + 1
+    assert record[-5:-1] == (None, None, 0, None)
+
+def test_parse_treats_empty_numbers_and_dates_as_defaults():
+    record, = parse_gifts(io.StringIO("3,,acct,,,,,,,,,,,,\n"))
+    assert record[:6] == (3, 0, 'acct', 0, 0, 0)
+    assert record[GIFTS_FIELDNAMES.index('date')] is None
+
+def test_parse_skips_blank_lines_and_rejects_bad_lines():
+    rejects = []
+    lines = TRANSACTION + "\n3,x,acct,1.00\n" + TRANSACTION.replace('03/02/24', '31/02/24') + TRANSACTION
+    records = list(parse_gifts(io.StringIO(lines), rejects))
+    assert [record[-1] for record in records] == [1, 5]
+    assert [reject.line_number for reject in rejects] == [3, 4]
+    assert rejects[0].raw == '3,x,acct,1.00'
+
+def test_reject_report_lists_rejected_lines(tmp_path):
+    rejects = []
+    list(parse_gifts(io.StringIO("3,x,acct,1.00\n"), rejects))
+    path = tmp_path / 'reports' / 'bad.gifts.rejects.csv'
+    write_reject_report(str(path), rejects)
+    header, row = path.read_text().splitlines()
+    assert header == 'line_number,reason,raw'
+    assert row.startswith('1,') and row.endswith('"3,x,acct,1.00"')
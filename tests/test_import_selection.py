@@ -0,0 +1,33 @@
+import datetime
+import pytest
+from data_processor import import_selection
+
+def test_selection_needs_ids_or_a_filter():
+    with pytest.raises(ValueError):
+        import_selection()
+    with pytest.raises(ValueError):
+        import_selection(account='', near_duplicates=False, covered=False)
+
+def test_selection_by_ids():
+    where, params = import_selection(ids=['3', 4])
+    assert 'gi.id = ANY(:ids)' in where
+    assert params['ids'] == [3, 4]
+
+def test_selection_is_limited_to_merged_transactions():
+    where, params = import_selection(covered=True)
+    assert where.startswith('gi."record_type" = 3 AND NOT EXISTS (')
+    assert 'scope_m.merged_at IS NULL' in where
+    assert params['scope_manifest_ids'] == []
+
+def test_selection_by_filters_and_ids():
+    where, params = import_selection(
+        ids=[1], account='12-3456', min_duplicates='2', max_duplicates=5, near_duplicates=True, covered=True,
+        date_from=datetime.date(2024, 1, 1), date_to=datetime.date(2024, 1, 31),
+    )
+    for condition in [
+        'gi.source_account_number = :account', 'gi.consecutive_duplicates >= :min_duplicates',
+        'gi.near_duplicate_id IS NOT NULL', 'gi.covered', 'gi.date >= :date_from', 'gi.date <= :date_to',
+        'gi.id = ANY(:ids)',
+    ]:
+        assert condition in where
+    assert params['min_duplicates'] == 2 and params['max_duplicates'] == 5
@@ -0,0 +1,43 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import uploads
+from import_jobs import create_import_job, get_import_job, update_import_job
+from rule_jobs import create_rule_job, get_rule_job, update_rule_job
+from uploads import spool_uploads
+
+def test_jobs_left_by_a_restart_are_marked_failed(db, tmp_path, monkeypatch):
+    from app import recover_interrupted_jobs
+    monkeypatch.setattr(uploads, 'IMPORT_SPOOL_FOLDER', str(tmp_path))
+    spool_uploads([('a.gifts', ['1\n'])])
+    queued, running, done = create_import_job(1), create_import_job(1), create_import_job(1)
+    update_import_job(running, status='running', errors='a.gifts line 2: bad date')
+    update_import_job(done, status='done')
+    rule_running = create_rule_job(1, 2)
+    update_rule_job(rule_running, status='running')
+
+    recover_interrupted_jobs()
+    assert [get_import_job(job_id)['status'] for job_id in (queued, running, done)] == ['failed', 'failed', 'done']
+    assert get_import_job(running)['errors'] == ['a.gifts line 2: bad date', 'Interrupted by a server restart']
+    assert get_rule_job(rule_running)['status'] == 'failed'
+    assert os.listdir(tmp_path) == []
+
+def test_queued_jobs_are_cancelled_when_the_worker_stops(db, tmp_path, monkeypatch):
+    import import_jobs, rule_jobs
+    from app import cancel_queued_jobs
+    monkeypatch.setattr(uploads, 'IMPORT_SPOOL_FOLDER', str(tmp_path))
+    assert import_jobs.executor is not rule_jobs.executor
+    # One busy thread per job type, so the next job of each waits in the queue
+    release = threading.Event()
+    for module in (import_jobs, rule_jobs):
+        monkeypatch.setattr(module, 'executor', ThreadPoolExecutor(max_workers=1))
+        module.executor.submit(release.wait)
+    import_job = import_jobs.submit_import(*spool_uploads([('a.gifts', ['1\n'])]))
+    rule_job = rule_jobs.submit_recategorise(1, 2)
+    try:
+        cancel_queued_jobs()
+    finally:
+        release.set()
+    assert get_import_job(import_job)['status'] == 'failed'
+    assert get_rule_job(rule_job)['status'] == 'failed'
+    assert os.listdir(tmp_path) == [] and import_jobs.pending == {} and rule_jobs.pending == {}
@@ -0,0 +1,60 @@
+import datetime
+from sqlalchemy import text
+from manifest import FileManifest, covered_ranges, file_checksum
+
+def day(n):
+    return datetime.date(2024, 1, 1) + datetime.timedelta(days=n)
+
+def test_add_counts_records_and_ranges_per_account():
+    manifest = FileManifest({})
+    for line, (account, date) in enumerate([('a', day(5)), ('a', day(2)), ('b', None), ('a', day(9)), ('b', day(1))], start=2):
+        assert manifest.add(account, date, line) is False
+    assert manifest.records == 5 and manifest.covered == 0
+    assert manifest.accounts == {'a': [day(2), day(9), 3, 2, 5], 'b': [day(1), day(1), 2, 4, 6]}
+
+def test_add_marks_dates_inside_covered_ranges():
+    # [day 0, day 10) and [day 20, day 25) are covered for account a
+    manifest = FileManifest({'a': ([day(0), day(20)], [day(10), day(25)])})
+    covered = [manifest.add(account, date, line) for line, (account, date) in enumerate([
+        ('a', day(-1)), ('a', day(0)), ('a', day(9)), ('a', day(10)), ('a', day(19)), ('a', day(24)),
+        ('a', day(25)), ('a', None), ('b', day(5)),
+    ])]
+    assert covered == [False, True, True, False, False, True, False, False, False]
+    assert manifest.covered == 3
+
+def test_lines_pass_through_and_checksum_content():
+    first, second = FileManifest({}), FileManifest({})
+    assert list(first.lines(['a\n', 'b\n'])) == ['a\n', 'b\n']
+    list(second.lines(['a\n', 'b\r\n']))
+    assert first.digest.hexdigest() != second.digest.hexdigest()
+
+def test_file_checksum_matches_the_checksum_of_its_lines(tmp_path):
+    path = tmp_path / 'a.gifts'
+    path.write_bytes('café,1\r\nb,2\rc,3'.encode())
+    manifest = FileManifest({})
+    with open(path, encoding='utf-8', newline='') as file:
+        list(manifest.lines(file))
+    assert file_checksum(path) == manifest.digest.hexdigest()
+
+def add_manifest(conn, checksum, merged, ranges):
+    manifest_id = conn.execute(text("""
+        INSERT INTO import_manifest (checksum, file_name, records, covered_records, imported_at, merged_at)
+        VALUES (:checksum, :checksum, 0, 0, now(), CASE WHEN :merged THEN now() END)
+        RETURNING id
+    """), {'checksum': checksum, 'merged': merged}).scalar()
+    for account, first, last in ranges:
+        conn.execute(text("""
+            INSERT INTO import_manifest_accounts (manifest_id, account_number, first_date, last_date, records, first_line, last_line)
+            VALUES (:manifest_id, :account, :first, :last, 1, 1, 1)
+        """), {'manifest_id': manifest_id, 'account': account, 'first': first, 'last': last})
+
+def test_covered_ranges_joins_overlapping_merged_files(db):
+    with db.connect() as conn:
+        add_manifest(conn, 'one', True, [('a', day(0), day(10)), ('b', day(3), day(3))])
+        add_manifest(conn, 'two', True, [('a', day(5), day(15))])
+        add_manifest(conn, 'three', True, [('a', day(30), day(40))])
+        add_manifest(conn, 'four', True, [('a', day(15), day(20))])
+        add_manifest(conn, 'unmerged', False, [('a', day(50), day(60)), ('c', day(0), day(5))])
+        ranges = covered_ranges(conn)
+    # Single day files cover nothing, unmerged files are ignored
+    assert ranges == {'a': ([day(0), day(30)], [day(20), day(40)])}
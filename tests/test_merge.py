@@ -0,0 +1,182 @@
+import datetime
+import shutil
+from sqlalchemy import text
+import data_processor
+from database import ensure_transaction_partitions
+from data_processor import load_files, merge_staged_rows, process_accounts, process_file, process_payees, process_transactions
+from manifest import mark_merged, staged_scope, unmerged_manifests
+from uploads import spool_uploads
+
+def gifts_file(account, opening, transactions):
+    # Lines of a .gifts export: the account header, then (amount, payee, date, destination) rows
+    lines = [f"5,0,{account},{opening:.2f},0,0,,,,Account {account},01/01/24,,,0,\n"]
+    for i, (amount, payee, date, destination) in enumerate(transactions):
+        lines.append(f"3,{i},{account},{amount:.2f},0,{i},{payee},,ref{i},{payee},{date},,DD,0,{destination}\n")
+    return lines
+
+FIRST = gifts_file('11-1111-1111111-00', 100, [(-10, 'SHOP', '02/01/24', '99-0000-0001-00'), (-20, 'FUEL', '03/01/24', '99-0000-0002-00')])
+# FIRST exported again a few days later
+AGAIN = FIRST + gifts_file('11-1111-1111111-00', 100, [(-30, 'RENT', '05/01/24', '99-0000-0004-00')])[1:]
+SECOND = gifts_file('22-2222-2222222-00', 50, [(-5, 'CAFE', '04/01/24', '99-0000-0003-00')])
+
+def upload(*files):
+    # Stages (name, lines) files the way an import job does, spooled then loaded one by one
+    folder, paths = spool_uploads(files)
+    try:
+        return load_files(paths, workers=1)
+    finally:
+        shutil.rmtree(folder)
+
+def rows(conn, sql):
+    return [tuple(row) for row in conn.execute(text(sql))]
+
+def test_merge_leaves_files_staged_after_it_started(db):
+    upload(('first.gifts', FIRST))
+    with db.connect() as conn:
+        manifest_ids = unmerged_manifests(conn)
+
+    # A second upload commits while the merge is running
+    upload(('second.gifts', SECOND))
+    scope = staged_scope(manifest_ids)
+    process_accounts(scope)
+    process_payees(scope)
+    process_transactions(scope=scope)
+    with db.connect() as conn:
+        mark_merged(conn, manifest_ids)
+        assert rows(conn, "SELECT account_number FROM accounts") == [('11-1111-1111111-00',)]
+        assert rows(conn, "SELECT account_number FROM transactions ORDER BY amount") == [('11-1111-1111111-00',)] * 2
+        assert rows(conn, "SELECT account_number FROM payees ORDER BY account_number") == [('99-0000-0001-00',), ('99-0000-0002-00',)]
+        # The second file is untouched, header row included
+        assert rows(conn, 'SELECT record_type, source_account_number FROM gifts_import ORDER BY line_number') == [
+            (5, '22-2222-2222222-00'), (3, '22-2222-2222222-00'),
+        ]
+
+    merge_staged_rows()
+    with db.connect() as conn:
+        assert rows(conn, "SELECT account_number FROM accounts ORDER BY account_number") == [
+            ('11-1111-1111111-00',), ('22-2222-2222222-00',),
+        ]
+        assert rows(conn, "SELECT account_number, amount FROM transactions ORDER BY amount") == [
+            ('11-1111-1111111-00', -20), ('11-1111-1111111-00', -10), ('22-2222-2222222-00', -5),
+        ]
+        assert rows(conn, "SELECT COUNT(*) FROM gifts_import") == [(0,)]
+        assert rows(conn, "SELECT COUNT(*) FROM import_manifest WHERE merged_at IS NULL") == [(0,)]
+
+def test_merge_holds_repeated_rows_for_review(db):
+    upload(('first.gifts', FIRST))
+    merge_staged_rows()
+    upload(('again.gifts', AGAIN))
+    merge_staged_rows()
+    with db.connect() as conn:
+        assert rows(conn, "SELECT amount FROM transactions ORDER BY amount") == [(-30,), (-20,), (-10,)]
+        assert rows(conn, "SELECT amount, consecutive_duplicates FROM gifts_import ORDER BY line_number") == [(-10, 1), (-20, 2)]
+
+def test_merge_skips_rules_with_invalid_conditions(db):
+    # Rules saved before conditions were validated can still be in the table
+    with db.connect() as conn:
+        conn.execute(text("INSERT INTO category (name) VALUES ('Shopping')"))
+        conn.execute(text("INSERT INTO rules (id, name) VALUES (1, 'bad'), (2, 'shop')"))
+        conn.execute(text("""
+            INSERT INTO rule_conditions (rule_id, field, operator, value, and_condition)
+            VALUES (1, 'amount', 'like', '10', TRUE), (2, 'payee', '=', 'SHOP', TRUE)
+        """))
+        conn.execute(text("INSERT INTO rule_actions (rule_id, category_id) VALUES (1, 1), (2, 1)"))
+    upload(('first.gifts', FIRST))
+    merge_staged_rows()
+    with db.connect() as conn:
+        assert rows(conn, "SELECT amount FROM transactions ORDER BY amount") == [(-20,), (-10,)]
+        assert rows(conn, "SELECT t.amount, tc.rule_id FROM transactions_categories tc JOIN transactions t ON t.id = tc.transaction_id") == [(-10, 2)]
+
+def test_import_files_command_loads_and_keeps_the_files(db, tmp_path):
+    from app import create_app
+    from database import database_role
+    paths = []
+    for name, lines in [('first.gifts', FIRST), ('second.gifts', SECOND)]:
+        paths.append(tmp_path / name)
+        paths[-1].write_text(''.join(lines))
+    # The command sets the worker role for the rest of the process, keep that to this test
+    with database_role('web'):
+        result = create_app().test_cli_runner().invoke(args=['import-files', '--workers', '1', *map(str, paths)])
+    assert result.exit_code == 0, result.output
+    assert 'Loaded 5 rows from 2 files.' in result.output
+    assert all(path.exists() for path in paths)
+    with db.connect() as conn:
+        assert rows(conn, "SELECT COUNT(*) FROM transactions") == [(3,)]
+
+def test_identical_file_on_disk_is_skipped_before_it_is_read(db, tmp_path, monkeypatch):
+    upload(('first.gifts', FIRST))
+    path = tmp_path / 'copy.gifts'
+    path.write_text(''.join(FIRST))
+    def load_gifts(*args, **kwargs):
+        raise AssertionError('identical file was parsed')
+    monkeypatch.setattr(data_processor, 'load_gifts', load_gifts)
+    result = process_file(str(path))
+    assert result['loaded'] == 0 and result['errors'][0].startswith('copy.gifts is identical to first.gifts')
+
+def test_parallel_load_merges_in_upload_order(db):
+    # The first file is much larger, so with two workers the second one is usually loaded first
+    from conftest import DATA_TABLES
+    large = gifts_file('11-1111-1111111-00', 100, [(-i, f'SHOP{i % 7}', '02/01/24', '99-0000-0001-00') for i in range(1, 3000)])
+    files = [('large.gifts', large), ('again.gifts', large[:1] + large[1:4] + FIRST[1:]), ('second.gifts', SECOND)]
+    outcomes = []
+    for workers in (1, 3):
+        with db.connect() as conn:
+            conn.execute(text(f"TRUNCATE {', '.join(DATA_TABLES)} RESTART IDENTITY CASCADE"))
+        folder, paths = spool_uploads(files)
+        try:
+            load_files(paths, workers=workers)
+        finally:
+            shutil.rmtree(folder)
+        merge_staged_rows()
+        with db.connect() as conn:
+            outcomes.append((
+                rows(conn, "SELECT file_name FROM import_manifest ORDER BY file_seq"),
+                rows(conn, "SELECT account_number, date, amount, payee FROM transactions ORDER BY id"),
+                rows(conn, "SELECT line_number, amount, consecutive_duplicates FROM gifts_import ORDER BY file_seq, line_number"),
+            ))
+    assert outcomes[0][0] == [('large.gifts',), ('again.gifts',), ('second.gifts',)]
+    assert outcomes[0][2] != []
+    assert outcomes[1] == outcomes[0]
+
+def merge_line(amount, payee, date, reference='', destination='99-0000-0001-00'):
+    # A transaction line with a fixed reference, so repeats are identical; destination None leaves
+    # the trailing column out, which is staged as NULL
+    line = f"3,0,11-1111-1111111-00,{amount:.2f},0,0,{payee},,{reference},{payee},{date},,DD,0"
+    return line + ('\n' if destination is None else f",{destination}\n")
+
+MODES_FILE = FIRST[:1] + [
+    merge_line(-10, 'SHOP', '02/01/24', 'r1'),                   # already in transactions
+    merge_line(-5, 'CAFE', '04/01/24'), merge_line(-5, 'CAFE', '04/01/24'), merge_line(-5, 'CAFE', '04/01/24'),
+    merge_line(-7, 'BOOKS', '04/01/24'),
+    merge_line(-3, 'NODEST', '05/01/24', destination=None),      # NULL never compares equal
+    merge_line(-3, 'NODEST', '05/01/24', destination=None),
+    merge_line(-20, 'FUEL', '03/01/24', 'r2'),                   # already in transactions
+    merge_line(-5, 'CAFE', '04/01/24'),
+    merge_line(-8, 'MARKET', '06/01/24'),
+]
+
+def test_row_and_set_merges_end_in_the_same_state(db):
+    from conftest import DATA_TABLES
+    outcomes = {}
+    for mode in ('row', 'set'):
+        with db.connect() as conn:
+            conn.execute(text(f"TRUNCATE {', '.join(DATA_TABLES)} RESTART IDENTITY CASCADE"))
+            ensure_transaction_partitions(conn, datetime.date(2024, 1, 1), datetime.date(2024, 1, 1))
+            conn.execute(text("""
+                INSERT INTO transactions (account_number, amount, date, payee, particulars, code, reference, transaction_type, destination_account_number)
+                VALUES ('11-1111-1111111-00', -10, '2024-01-02', 'SHOP', 'SHOP', '', 'r1', 'DD', '99-0000-0001-00'),
+                       ('11-1111-1111111-00', -20, '2024-01-03', 'FUEL', 'FUEL', '', 'r2', 'DD', '99-0000-0001-00')
+            """))
+        upload(('modes.gifts', MODES_FILE))
+        process_accounts()
+        process_payees()
+        process_transactions(mode)
+        with db.connect() as conn:
+            outcomes[mode] = (
+                rows(conn, "SELECT id, account_number, amount, date, payee, reference, destination_account_number FROM transactions ORDER BY id"),
+                rows(conn, "SELECT line_number, payee, consecutive_duplicates, near_duplicate_id FROM gifts_import ORDER BY line_number"),
+            )
+    transactions, held = outcomes['set']
+    assert [row[4] for row in transactions] == ['SHOP', 'FUEL', 'CAFE', 'BOOKS', 'NODEST', 'NODEST', 'MARKET']
+    assert [row[1:3] for row in held] == [('SHOP', 1), ('CAFE', 1), ('CAFE', 2), ('FUEL', 1), ('CAFE', 2)]
+    assert outcomes['row'] == outcomes['set']
@@ -0,0 +1,46 @@
+import logging
+import re
+import pytest
+from sqlalchemy import text
+import perf
+
+@pytest.fixture
+def client(db):
+    from app import create_app
+    perf.route_timings.clear()
+    return create_app().test_client()
+
+def login(client):
+    with client.session_transaction() as session:
+        session['username'] = 'test'
+
+def test_responses_carry_server_timing(client):
+    login(client)
+    response = client.get('/categories')
+    timing = re.fullmatch(r'db;dur=([\d.]+);desc="(\d+) statements", total;dur=([\d.]+)', response.headers['Server-Timing'])
+    assert timing, response.headers['Server-Timing']
+    db_ms, statements, total_ms = float(timing[1]), int(timing[2]), float(timing[3])
+    assert statements > 0
+    assert db_ms <= total_ms
+
+@pytest.mark.parametrize('threshold, logged', [(0, True), (60, False)])
+def test_slow_queries_are_logged_over_the_threshold(db, caplog, monkeypatch, threshold, logged):
+    monkeypatch.setattr(perf, 'SLOW_QUERY_SECONDS', threshold)
+    with caplog.at_level(logging.WARNING, logger='database.slow_queries'):
+        with db.connect() as conn:
+            conn.execute(text("SELECT 42"))
+    slow = [record.getMessage() for record in caplog.records if record.name == 'database.slow_queries']
+    assert any('SELECT 42' in message for message in slow) == logged
+
+def test_debug_perf_needs_a_login(client):
+    assert client.get('/debug/perf').status_code == 403
+
+def test_debug_perf_reports_percentiles_per_route(client):
+    login(client)
+    for _ in range(3):
+        client.get('/categories')
+    report = client.get('/debug/perf').get_json()
+    categories = report['GET /categories']
+    assert categories['requests'] == 3
+    assert categories['total_ms']['p50'] <= categories['total_ms']['p99']
+    assert categories['statements_mean'] > 0
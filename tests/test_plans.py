@@ -0,0 +1,130 @@
+import datetime
+import pytest
+from sqlalchemy import text
+from benchmark import seed_transactions, stage_rows
+from data_processor import new_payees_query
+from duplicates import existing_duplicates_query
+from manifest import staged_scope
+from rules_engine import normalise_conditions, preview_statement
+from search import search_query, search_statement
+
+# EXPLAIN checks that the hot queries, as the app runs them, are planned on their indexes. A plan
+# fails when it has a Seq Scan over a table the planner estimates at more than PLAN_THRESHOLD rows.
+PLAN_TRANSACTIONS = 200000
+PLAN_STAGED = 2000
+PLAN_ACCOUNTS = 50
+PLAN_THRESHOLD = 10000
+
+HOT_QUERIES = {
+    # A date bounded report should read only the partitions of its year
+    'year_report': """
+        SELECT date, SUM(amount) FROM transactions
+        WHERE account_number = :account_number AND date BETWEEN :report_start AND :report_end
+        GROUP BY date
+    """,
+    'account_summary': "SELECT * FROM view_account_summary WHERE account_number = :account_number",
+    'transaction_categories': "SELECT * FROM transactions_categories WHERE transaction_id = ANY(:transaction_ids)",
+    'rule_categories': "SELECT transaction_id FROM transactions_categories WHERE rule_id = :rule_id",
+}
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+def explain(conn, sql, params):
+    return conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"), params).scalar()[0]['Plan']
+
+def large_seq_scans(conn, plan):
+    scans = {node['Relation Name'] for node in plan_nodes(plan) if node['Node Type'] == 'Seq Scan'}
+    estimates = dict(conn.execute(text("""
+        SELECT relname, reltuples FROM pg_class WHERE relnamespace = 'public'::regnamespace AND relname = ANY(:names)
+    """), {'names': list(scans)}).fetchall())
+    return sorted(table for table in scans if estimates.get(table, 0) > PLAN_THRESHOLD)
+
+def plan_indexes(plan):
+    return {node['Index Name'] for node in plan_nodes(plan) if 'Index Name' in node}
+
+def analyze(conn, *tables):
+    for table in tables:
+        conn.execute(text(f"ANALYZE {table}"))
+
+@pytest.fixture(scope='module')
+def seeded(test_database):
+    # A large transactions table with categories, and a small import
+    with test_database.connect() as conn:
+        seed_transactions(conn, PLAN_TRANSACTIONS, accounts=PLAN_ACCOUNTS)
+        stage_rows(conn, PLAN_STAGED, PLAN_TRANSACTIONS)
+        conn.execute(text("TRUNCATE accounts, transactions_categories, category RESTART IDENTITY CASCADE"))
+        conn.execute(text("""
+            INSERT INTO accounts (account_number, account_name, opening_balance)
+            SELECT 'bench-' || i, 'Bench ' || i, 0 FROM generate_series(0, :accounts - 1) AS i
+        """), {'accounts': PLAN_ACCOUNTS})
+        conn.execute(text("INSERT INTO category (name) VALUES ('Bench')"))
+        conn.execute(text("""
+            INSERT INTO transactions_categories (transaction_id, category_id, rule_id, rule_version)
+            SELECT id, 1, id % 500, 1 FROM transactions
+        """))
+        analyze(conn, 'transactions', 'gifts_import', 'accounts', 'transactions_categories')
+    yield test_database
+    with test_database.connect() as conn:
+        conn.execute(text("TRUNCATE transactions, gifts_import, accounts, transactions_categories, category RESTART IDENTITY CASCADE"))
+
+def test_seeded_tables_are_above_the_threshold(seeded):
+    with seeded.connect() as conn:
+        partition = conn.execute(text("SELECT reltuples FROM pg_class WHERE relname = 'transactions_2022'")).scalar()
+        categories = conn.execute(text("SELECT reltuples FROM pg_class WHERE relname = 'transactions_categories'")).scalar()
+    assert partition > PLAN_THRESHOLD and categories > PLAN_THRESHOLD
+
+@pytest.mark.parametrize('name', list(HOT_QUERIES))
+def test_hot_query_avoids_large_seq_scans(seeded, name):
+    params = {
+        'account_number': 'bench-1', 'transaction_ids': list(range(1, 501)), 'rule_id': 7,
+        'report_start': datetime.date(2022, 1, 1), 'report_end': datetime.date(2022, 12, 31),
+    }
+    with seeded.connect() as conn:
+        plan = explain(conn, HOT_QUERIES[name], params)
+        assert large_seq_scans(conn, plan) == []
+    if name == 'year_report':
+        relations = {node['Relation Name'] for node in plan_nodes(plan) if 'Relation Name' in node}
+        assert relations == {'transactions_2022'}
+
+def test_exact_duplicate_check_avoids_large_seq_scans(seeded):
+    with seeded.connect() as conn:
+        staged_range = conn.execute(text("SELECT MIN(date), MAX(date) FROM gifts_import")).fetchone()
+        sql, params = existing_duplicates_query(*staged_range, staged_scope([1, 2]))
+        assert large_seq_scans(conn, explain(conn, sql, params)) == []
+
+def test_rule_preview_avoids_large_seq_scans(seeded):
+    shape, values = normalise_conditions([{'field': 'payee', 'operator': '=', 'value': 'PAYEE 7'}])
+    with seeded.connect() as conn:
+        plan = explain(conn, preview_statement(shape, False).text, {'value_0': values[0], 'limit': 101})
+        assert large_seq_scans(conn, plan) == []
+
+def test_search_uses_the_search_vector_index(seeded):
+    with seeded.connect() as conn:
+        plan = explain(conn, search_statement(False).text, {'query': search_query('ref1234'), 'limit': 101})
+    assert any(index.startswith('transactions_') and index.endswith('search_vector_idx') for index in plan_indexes(plan))
+
+def test_like_condition_uses_the_trigram_index(seeded):
+    with seeded.connect() as conn:
+        if not conn.execute(text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")).scalar():
+            pytest.skip('pg_trgm is not installed')
+        shape, values = normalise_conditions([{'field': 'reference', 'operator': 'like', 'value': 'ref1234'}])
+        plan = explain(conn, preview_statement(shape, False).text, {'value_0': values[0], 'limit': 101})
+    assert any(index.endswith('reference_trgm_idx') for index in plan_indexes(plan))
+
+def test_new_payees_reads_a_large_import_through_its_index(seeded):
+    # process_payees has to find the latest row per destination among every staged row, so the
+    # import here is well above the threshold
+    with seeded.connect() as conn:
+        stage_rows(conn, PLAN_THRESHOLD * 3, PLAN_TRANSACTIONS)
+        analyze(conn, 'gifts_import')
+        try:
+            staged = conn.execute(text("SELECT reltuples FROM pg_class WHERE relname = 'gifts_import'")).scalar()
+            assert staged > PLAN_THRESHOLD
+            scope_sql, scope_params = staged_scope([1, 2])
+            assert large_seq_scans(conn, explain(conn, new_payees_query(scope_sql), scope_params)) == []
+        finally:
+            conn.execute(text("DELETE FROM gifts_import WHERE id > :staged"), {'staged': PLAN_STAGED})
+            analyze(conn, 'gifts_import')
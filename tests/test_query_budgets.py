@@ -0,0 +1,59 @@
+import pytest
+from sqlalchemy import event, text
+import cache
+
+# Most SQL statements a page may issue with an empty cache, whatever the number of rows it shows
+QUERY_BUDGETS = {'/accounts': 2, '/categories': 3, '/rules': 6}
+
+def seed_page_data(conn, rules):
+    # rules rules with three conditions and two actions each, and a category with five
+    # subcategories per ten rules
+    categories = max(1, rules // 10)
+    conn.execute(text("INSERT INTO category (name) SELECT 'Category ' || i FROM generate_series(1, :count) AS i"), {'count': categories})
+    conn.execute(text("""
+        INSERT INTO subcategory (name, category_id)
+        SELECT 'Subcategory ' || i, (i % :categories) + 1 FROM generate_series(1, :categories * 5) AS i
+    """), {'categories': categories})
+    conn.execute(text("INSERT INTO rules (name) SELECT 'Rule ' || i FROM generate_series(1, :count) AS i"), {'count': rules})
+    conn.execute(text("""
+        INSERT INTO rule_conditions (rule_id, field, operator, value, and_condition)
+        SELECT i, field, '=', 'value ' || i, true
+        FROM generate_series(1, :count) AS i CROSS JOIN unnest(ARRAY['payee', 'particulars', 'reference']) AS field
+    """), {'count': rules})
+    conn.execute(text("""
+        INSERT INTO rule_actions (rule_id, category_id, subcategory_id)
+        SELECT i, (i % :categories) + 1, NULL FROM generate_series(1, :count) AS i
+        UNION ALL
+        SELECT i, (i % :categories) + 1, (i % (:categories * 5)) + 1 FROM generate_series(1, :count) AS i
+    """), {'count': rules, 'categories': categories})
+    conn.execute(text("""
+        INSERT INTO accounts (account_number, account_name, opening_balance)
+        SELECT 'acct-' || i, 'Account ' || i, 0 FROM generate_series(1, :count) AS i
+    """), {'count': categories})
+
+@pytest.fixture
+def client(db):
+    from app import create_app
+    client = create_app().test_client()
+    with client.session_transaction() as session:
+        session['username'] = 'test'
+    client.get('/login')
+    return client
+
+@pytest.mark.parametrize('rules', [10, 500])
+@pytest.mark.parametrize('page', list(QUERY_BUDGETS))
+def test_page_stays_within_its_query_budget(db, client, page, rules):
+    with db.connect() as conn:
+        seed_page_data(conn, rules)
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    cache.cache.clear()
+    event.listen(db, 'before_cursor_execute', count)
+    try:
+        response = client.get(page)
+    finally:
+        event.remove(db, 'before_cursor_execute', count)
+    assert response.status_code == 200
+    assert len(statements) <= QUERY_BUDGETS[page], statements
@@ -0,0 +1,56 @@
+from sqlalchemy import text
+from data_processor import add_transaction, delete_gifts_import, get_import_accounts, get_import_page, merge_staged_rows
+from test_merge import AGAIN, FIRST, SECOND, rows, upload
+
+def stage_review_queue():
+    # Two rows held for review from a merged file, then a second upload still waiting for its merge
+    upload(('first.gifts', FIRST))
+    merge_staged_rows()
+    upload(('again.gifts', AGAIN))
+    merge_staged_rows()
+    upload(('second.gifts', SECOND))
+
+def test_unmerged_files_are_not_in_the_review_queue(db):
+    stage_review_queue()
+    page = get_import_page()
+    assert [row['account_number'] for row in page['rows']] == ['11-1111-1111111-00'] * 2
+    assert [row.account_number for row in get_import_accounts()] == ['11-1111-1111111-00']
+
+def test_accept_and_reject_leave_unmerged_files_alone(db):
+    stage_review_queue()
+    assert add_transaction(account='22-2222-2222222-00') == 0
+    assert delete_gifts_import(max_duplicates=5) == 2
+    with db.connect() as conn:
+        # Header row included, the merge still creates the account
+        assert rows(conn, "SELECT record_type, source_account_number FROM gifts_import ORDER BY line_number") == [
+            (5, '22-2222-2222222-00'), (3, '22-2222-2222222-00'),
+        ]
+    assert delete_gifts_import("*") == 0
+
+    merge_staged_rows()
+    with db.connect() as conn:
+        assert rows(conn, "SELECT account_number FROM accounts ORDER BY account_number") == [
+            ('11-1111-1111111-00',), ('22-2222-2222222-00',),
+        ]
+        assert rows(conn, "SELECT account_number, amount FROM transactions ORDER BY amount") == [
+            ('11-1111-1111111-00', -30), ('11-1111-1111111-00', -20), ('11-1111-1111111-00', -10), ('22-2222-2222222-00', -5),
+        ]
+
+def test_accept_by_id_skips_header_rows(db):
+    upload(('first.gifts', FIRST))
+    merge_staged_rows()
+    upload(('again.gifts', AGAIN))
+    merge_staged_rows()
+    with db.connect() as conn:
+        # A header row staged before the manifest existed is never accepted as a transaction
+        conn.execute(text("""
+            INSERT INTO gifts_import (
+                record_type, internal_reference, source_account_number, amount, unknown, transaction_reference, payee,
+                misc_field, consecutive_duplicates
+            )
+            VALUES (5, 0, 'legacy', 1, 0, 0, 'Legacy', 0, 0)
+        """))
+        ids = conn.execute(text("SELECT id FROM gifts_import")).scalars().all()
+    assert add_transaction(ids) == 2
+    with db.connect() as conn:
+        assert rows(conn, "SELECT record_type, source_account_number FROM gifts_import") == [(5, 'legacy')]
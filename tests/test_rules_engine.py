@@ -0,0 +1,155 @@
+import datetime
+import pytest
+from sqlalchemy import text
+from database import ensure_transaction_partitions
+from rules_engine import (
+    categorise_transactions, chain_sql, compile_rules, decode_preview_cursor, encode_preview_cursor,
+    find_recategorise_candidates, load_rules, normalise_conditions, recategorise_batch, recategorise_rule, rule_snapshot,
+)
+
+def condition(field, operator, value, and_condition=True):
+    return {'field': field, 'operator': operator, 'value': value, 'and_condition': and_condition}
+
+def test_normalise_conditions_splits_shape_and_converted_values():
+    shape, values = normalise_conditions([
+        condition('payee', '=', 'COUNTDOWN', False),
+        condition('amount', '<', '-10.5', 'false'),
+        condition('date', '>=', '2024-03-01', 'True'),
+        condition('particulars', 'LIKE', 'fuel'),
+    ])
+    assert shape == (
+        (None, 'payee', '='), ('OR', 'amount', '<'), ('AND', 'date', '>='), ('AND', 'particulars', 'like'),
+    )
+    assert values == ['COUNTDOWN', -10.5, datetime.date(2024, 3, 1), '%fuel%']
+
+def test_same_shape_compiles_to_the_same_sql():
+    first, _ = normalise_conditions([condition('payee', '=', 'A'), condition('amount', '>', '1')])
+    second, _ = normalise_conditions([condition('payee', '=', 'B'), condition('amount', '>', '2')])
+    assert first == second
+
+@pytest.mark.parametrize('bad', [
+    condition('id', '=', '1'),
+    condition('payee; DROP TABLE rules', '=', 'x'),
+    condition('payee', '~', 'x'),
+    condition('amount', '=', 'ten'),
+    condition('date', '=', '31/01/2024'),
+    condition('amount', 'like', '10'),
+    condition('date', 'like', '2024'),
+    condition('amount', '=', None),
+])
+def test_normalise_conditions_rejects_invalid_conditions(bad):
+    with pytest.raises(ValueError):
+        normalise_conditions([bad])
+
+def test_chain_sql_joins_left_to_right():
+    shape = ((None, 'payee', '='), ('OR', 'particulars', 'like'), ('AND', 'amount', '<'))
+    assert chain_sql(shape, 'r1', 'gi') == 'gi.payee = :r1_0 OR gi.particulars LIKE :r1_1 AND gi.amount < :r1_2'
+
+def test_compile_rules_skips_rules_without_conditions_actions_or_with_invalid_ones():
+    rules = [
+        {'id': 1, 'name': 'empty', 'conditions': [], 'actions': [{}]},
+        {'id': 2, 'name': 'bad', 'conditions': [condition('amount', '=', 'x')], 'actions': [{}]},
+        {'id': 4, 'name': 'like amount', 'conditions': [condition('amount', 'like', '10')], 'actions': [{}]},
+        {'id': 3, 'name': 'good', 'conditions': [condition('payee', '=', 'A')], 'actions': [{}]},
+    ]
+    case, params = compile_rules(rules)
+    assert case == 'CASE WHEN t.payee = :r3_0 THEN 3 END'
+    assert params == {'r3_0': 'A'}
+
+def test_preview_cursor_round_trip():
+    class Row:
+        date = datetime.date(2024, 5, 6)
+        id = 42
+    assert decode_preview_cursor(encode_preview_cursor(Row)) == (datetime.date(2024, 5, 6), 42)
+
+@pytest.mark.parametrize('cursor', ['', 'not base64!', 'WzFd', 'WyJ4IiwgMV0='])
+def test_decode_preview_cursor_rejects_invalid_cursors(cursor):
+    with pytest.raises(ValueError):
+        decode_preview_cursor(cursor)
+
+def add_rule(conn, rule_id, category_id, *conditions, version=1):
+    conn.execute(text("INSERT INTO rules (id, name, version) VALUES (:id, :name, :version)"), {
+        'id': rule_id, 'name': f'rule {rule_id}', 'version': version,
+    })
+    for field, operator, value in conditions:
+        conn.execute(text("""
+            INSERT INTO rule_conditions (rule_id, field, operator, value, and_condition)
+            VALUES (:rule_id, :field, :operator, :value, TRUE)
+        """), {'rule_id': rule_id, 'field': field, 'operator': operator, 'value': value})
+    conn.execute(text("INSERT INTO rule_actions (rule_id, category_id) VALUES (:rule_id, :category_id)"), {
+        'rule_id': rule_id, 'category_id': category_id,
+    })
+
+def edit_rule(conn, rule_id, *conditions):
+    # What add_edit_rule does: new conditions and the next version, in one transaction
+    conn.execute(text("DELETE FROM rule_conditions WHERE rule_id = :rule_id"), {'rule_id': rule_id})
+    for field, operator, value in conditions:
+        conn.execute(text("""
+            INSERT INTO rule_conditions (rule_id, field, operator, value, and_condition)
+            VALUES (:rule_id, :field, :operator, :value, TRUE)
+        """), {'rule_id': rule_id, 'field': field, 'operator': operator, 'value': value})
+    conn.execute(text("UPDATE rules SET version = version + 1 WHERE id = :rule_id"), {'rule_id': rule_id})
+
+def categories(conn):
+    # {payee and amount: (category_id, rule_id, rule_version)}
+    return {
+        f"{row.payee} {row.amount:g}": (row.category_id, row.rule_id, row.rule_version)
+        for row in conn.execute(text("""
+            SELECT t.payee, t.amount, tc.category_id, tc.rule_id, tc.rule_version
+            FROM transactions_categories tc JOIN transactions t ON t.id = tc.transaction_id
+        """))
+    }
+
+@pytest.fixture
+def categorised(db):
+    # Rule 2 (SHOP, category 1) wins over rule 3 (amount < -40, category 3) by its lower id.
+    # FUEL -20 was categorised by hand.
+    with db.connect() as conn:
+        ensure_transaction_partitions(conn, datetime.date(2024, 1, 1), datetime.date(2024, 1, 1))
+        conn.execute(text("INSERT INTO category (name) VALUES ('Shopping'), ('Fuel'), ('Big')"))
+        conn.execute(text("""
+            INSERT INTO transactions (account_number, date, amount, payee)
+            VALUES ('a', '2024-01-01', -10, 'SHOP'), ('a', '2024-01-01', -50, 'FUEL'),
+                   ('a', '2024-01-01', -100, 'SHOP'), ('a', '2024-01-01', -20, 'FUEL')
+        """))
+        conn.execute(text("INSERT INTO transactions_categories (transaction_id, category_id) VALUES (4, 2)"))
+        add_rule(conn, 2, 1, ('payee', '=', 'SHOP'))
+        add_rule(conn, 3, 3, ('amount', '<', '-40'))
+        categorise_transactions(conn)
+        assert categories(conn) == {
+            'SHOP -10': (1, 2, 1), 'FUEL -50': (3, 3, 1), 'SHOP -100': (1, 2, 1), 'FUEL -20': (2, None, None),
+        }
+    return db
+
+def test_recategorise_an_edited_rule(categorised):
+    with categorised.connect() as conn:
+        edit_rule(conn, 2, ('payee', '=', 'FUEL'))
+        assert sorted(find_recategorise_candidates(conn, 2, load_rules(conn))) == [1, 2, 3]
+    assert recategorise_rule(categorised, 2) == 3
+    with categorised.connect() as conn:
+        assert categories(conn) == {'FUEL -50': (1, 2, 2), 'SHOP -100': (3, 3, 1), 'FUEL -20': (2, None, None)}
+
+def test_recategorise_a_deleted_rule(categorised):
+    with categorised.connect() as conn:
+        for table, column in [('rule_conditions', 'rule_id'), ('rule_actions', 'rule_id'), ('rules', 'id')]:
+            conn.execute(text(f"DELETE FROM {table} WHERE {column} = 2"))
+    assert recategorise_rule(categorised, 2) == 2
+    with categorised.connect() as conn:
+        assert categories(conn) == {'FUEL -50': (3, 3, 1), 'SHOP -100': (3, 3, 1), 'FUEL -20': (2, None, None)}
+
+def test_late_batch_of_an_older_job_is_fixed_by_the_next_one(categorised):
+    # An older job compiled the rules before rule 2 was edited and commits its batch after the edit
+    with categorised.connect() as conn:
+        rules = load_rules(conn)
+        edit_rule(conn, 2, ('payee', '=', 'FUEL'))
+    case, params = compile_rules(rules)
+    params.update(rule_snapshot(rules))
+    with categorised.execution_options(isolation_level="READ COMMITTED").begin() as conn:
+        conn.execute(text("DELETE FROM transactions_categories WHERE rule_id IS NOT NULL"))
+        recategorise_batch(conn, [1, 2, 3], case, params)
+    with categorised.connect() as conn:
+        # Written with the version its conditions came from
+        assert categories(conn)['SHOP -10'] == (1, 2, 1)
+    recategorise_rule(categorised, 2)
+    with categorised.connect() as conn:
+        assert categories(conn) == {'FUEL -50': (1, 2, 2), 'SHOP -100': (3, 3, 1), 'FUEL -20': (2, None, None)}
@@ -0,0 +1,137 @@
+import io
+import os
+import pytest
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data
+import uploads
+from uploads import file_lines, spool_uploads, stream_uploads
+
+BOUNDARY = 'testboundary'
+
+def multipart(*parts):
+    # A multipart/form-data body from (field, filename, bytes) parts, filename None for plain fields
+    body = b''
+    for field, filename, content in parts:
+        disposition = f'form-data; name="{field}"' + (f'; filename="{filename}"' if filename else '')
+        body += f'--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n\r\n'.encode() + content + b'\r\n'
+    return io.BytesIO(body + f'--{BOUNDARY}--\r\n'.encode())
+
+def read_all(stream, **limits):
+    return [(filename, list(lines)) for filename, lines in stream_uploads(stream, BOUNDARY, **limits)]
+
+def test_file_lines_keeps_line_endings_across_blocks():
+    events = [Data(b'a,1\r', True), Data(b'\nb,2\rc,', True), Data(b'3', False)]
+    assert list(file_lines(iter(events), 'x.gifts', 100)) == ['a,1\r\n', 'b,2\r', 'c,3']
+
+def test_file_lines_decodes_characters_split_between_blocks():
+    data = 'café\n'.encode()
+    events = [Data(data[:4], True), Data(data[4:], False)]
+    assert list(file_lines(iter(events), 'x.gifts', 100)) == ['café\n']
+
+def test_file_lines_enforces_the_file_limit():
+    events = iter([Data(b'a' * 6, True), Data(b'a' * 6, False)])
+    with pytest.raises(RequestEntityTooLarge):
+        list(file_lines(events, 'x.gifts', 10))
+
+@pytest.mark.parametrize('read_size', [2, 7, 64 * 1024])
+def test_stream_uploads_yields_files_in_order(monkeypatch, read_size):
+    monkeypatch.setattr(uploads, 'UPLOAD_READ_SIZE', read_size)
+    stream = multipart(
+        ('note', None, b'ignored'),
+        ('files', 'a.gifts', b'1,a\r\n2,b\r\n'),
+        ('other', 'c.gifts', b'not mine\n'),
+        ('files', 'b.gifts', b'3,c\n4,d'),
+    )
+    assert read_all(stream) == [('a.gifts', ['1,a\r\n', '2,b\r\n']), ('b.gifts', ['3,c\n', '4,d'])]
+
+def test_stream_uploads_does_not_depend_on_where_blocks_end(monkeypatch):
+    # Every split of the body into blocks, including ones ending inside a delimiter
+    expected = [('a.gifts', '1,a\r\n2,b'), ('b.gifts', '3,c\r')]
+    for read_size in range(2, 100):
+        monkeypatch.setattr(uploads, 'UPLOAD_READ_SIZE', read_size)
+        stream = multipart(('files', 'a.gifts', b'1,a\r\n2,b'), ('files', 'b.gifts', b'3,c\r'))
+        assert [(name, ''.join(lines)) for name, lines in read_all(stream)] == expected, read_size
+
+def test_stream_uploads_skips_what_the_consumer_leaves():
+    stream = multipart(('files', 'a.gifts', b'1\n2\n3\n'), ('files', 'b.gifts', b'4\n'))
+    names = []
+    for filename, lines in stream_uploads(stream, BOUNDARY):
+        names.append((filename, next(lines)))
+    assert names == [('a.gifts', '1\n'), ('b.gifts', '4\n')]
+
+def test_stream_uploads_enforces_the_request_limit(monkeypatch):
+    monkeypatch.setattr(uploads, 'UPLOAD_READ_SIZE', 16)
+    stream = multipart(('files', 'a.gifts', b'1,a\n' * 20))
+    with pytest.raises(RequestEntityTooLarge):
+        read_all(stream, max_request_bytes=40)
+
+def test_stream_uploads_rejects_invalid_utf8():
+    with pytest.raises(UnicodeDecodeError):
+        read_all(multipart(('files', 'a.gifts', b'\xff\xfe\n')))
+
+def test_spool_uploads_keeps_bytes_and_repeated_names(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, 'IMPORT_SPOOL_FOLDER', str(tmp_path))
+    stream = multipart(('files', 'a.gifts', 'café\r\n1'.encode()), ('files', 'a.gifts', b'2\r'))
+    folder, paths = spool_uploads(stream_uploads(stream, BOUNDARY))
+    assert [os.path.basename(path) for path in paths] == ['a.gifts', 'a.gifts']
+    assert [open(path, 'rb').read() for path in paths] == ['café\r\n1'.encode(), b'2\r']
+    assert os.path.dirname(folder) == str(tmp_path)
+
+def test_spool_uploads_leaves_nothing_on_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, 'IMPORT_SPOOL_FOLDER', str(tmp_path))
+    stream = multipart(('files', 'a.gifts', b'1\n'), ('files', 'b.gifts', b'\xff\n'))
+    with pytest.raises(UnicodeDecodeError):
+        spool_uploads(stream_uploads(stream, BOUNDARY))
+    assert spool_uploads([]) == (None, [])
+    assert os.listdir(tmp_path) == []
+
+@pytest.fixture
+def client(db, tmp_path, monkeypatch):
+    from app import create_app
+    monkeypatch.setattr(uploads, 'IMPORT_SPOOL_FOLDER', str(tmp_path))
+    return create_app().test_client()
+
+def post_upload(client, *parts, login=True):
+    if login:
+        with client.session_transaction() as session:
+            session['username'] = 'test'
+    return client.post('/api/import_data', data=multipart(*parts).getvalue(),
+                       content_type=f'multipart/form-data; boundary={BOUNDARY}')
+
+def test_upload_needs_a_login(client):
+    assert post_upload(client, ('files', 'a.gifts', b''), login=False).status_code == 403
+
+def test_upload_is_spooled_for_the_import_job(client, monkeypatch):
+    import app
+    submitted = []
+    monkeypatch.setattr(app, 'submit_import', lambda folder, paths: submitted.append((folder, paths)) or 7)
+    response = post_upload(client, ('files', 'a.gifts', b'1\n2\n'), ('files', 'b.gifts', b'3\n'))
+    assert response.status_code == 202 and response.get_json()['job_id'] == 7
+    (folder, paths), = submitted
+    assert [open(path, 'rb').read() for path in paths] == [b'1\n2\n', b'3\n']
+
+def test_rejected_upload_leaves_no_spool(client, tmp_path):
+    assert post_upload(client, ('files', 'a.gifts', b'1\n'), ('files', 'b.csv', b'2\n')).status_code == 400
+    assert os.listdir(tmp_path) == []
+
+def test_upload_is_503_when_the_job_cannot_be_created(client, tmp_path, monkeypatch):
+    import app
+    from sqlalchemy.exc import OperationalError
+    def submit_import(folder, paths):
+        raise OperationalError('INSERT INTO import_jobs', {}, Exception('connection refused'))
+    monkeypatch.setattr(app, 'submit_import', submit_import)
+    assert post_upload(client, ('files', 'a.gifts', b'1\n')).status_code == 503
+    assert os.listdir(tmp_path) == []
+
+def test_import_job_loads_merges_and_removes_the_spool(client, tmp_path):
+    import import_jobs
+    from sqlalchemy import text
+    from test_merge import FIRST, SECOND
+    folder, paths = spool_uploads([('first.gifts', FIRST), ('second.gifts', SECOND)])
+    job_id = import_jobs.create_import_job(len(paths))
+    import_jobs.run_import_job(job_id, len(paths), lambda progress: import_jobs.import_uploaded(folder, paths, progress))
+    job = import_jobs.get_import_job(job_id)
+    assert job['status'] == 'done' and job['errors'] == []
+    assert os.listdir(tmp_path) == []
+    with import_jobs.engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM transactions")).scalar() == 3
@@ -0,0 +1,127 @@
+import codecs
+import os
+import re
+import shutil
+import tempfile
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, Data, Epilogue, File, NeedData
+
+# Uploads are read from the request body in blocks of this size, so a request holds at most one
+# block and one line in memory
+UPLOAD_READ_SIZE = 64 * 1024
+IMPORT_MAX_FILE_BYTES = int(os.getenv('IMPORT_MAX_FILE_BYTES', 50 * 1024 * 1024))
+IMPORT_MAX_REQUEST_BYTES = int(os.getenv('IMPORT_MAX_REQUEST_BYTES', 200 * 1024 * 1024))
+
+# The files of each upload are spooled to their own folder in here until the import job has
+# loaded them, so the disk used is bounded by IMPORT_MAX_REQUEST_BYTES per queued upload
+IMPORT_SPOOL_FOLDER = os.getenv('IMPORT_SPOOL_FOLDER', os.path.join(tempfile.gettempdir(), 'simple-budget-uploads'))
+
+# Bytes after a delimiter that tell a part boundary ("\r\n") from the closing one ("--\r\n")
+DELIMITER_LOOKAHEAD = 4
+
+# The line endings open(newline='') splits on, as process_file reads saved files
+LINE_END = re.compile(r'\r\n|\n|\r')
+
+def multipart_events(stream, boundary, max_request_bytes):
+    # Events of a multipart/form-data body read incrementally from stream. Raises
+    # RequestEntityTooLarge once more than max_request_bytes have been read.
+    decoder = MultipartDecoder(boundary.encode())
+    delimiter = b'--' + boundary.encode()
+    received = 0
+    held = b''
+    fed = b''
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            block = stream.read(UPLOAD_READ_SIZE)
+            received += len(block)
+            if received > max_request_bytes:
+                raise RequestEntityTooLarge(f"Upload is larger than {max_request_bytes} bytes")
+            # The decoder passes the CR before a delimiter on as part data when its buffer ends
+            # just after "--boundary", so the bytes from a delimiter (which may have started in
+            # the previous block) wait until the line break after it has been read
+            data, held = held + block, b''
+            window = fed + data
+            end = window.rfind(delimiter)
+            if block and end != -1 and len(window) - end - len(delimiter) < DELIMITER_LOOKAHEAD:
+                split = max(end - len(fed), 0)
+                data, held = data[:split], data[split:]
+            if data or not block:
+                decoder.receive_data(data or None)
+                fed = (fed + data)[-len(delimiter):]
+            continue
+        if isinstance(event, Epilogue):
+            return
+        yield event
+
+def file_lines(events, filename, max_file_bytes):
+    # Text lines of one file part, line endings kept for the csv reader, until its last Data event
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    size = 0
+    pending = ''
+    for event in events:
+        if not isinstance(event, Data):
+            raise ValueError(f"Unexpected multipart part inside {filename}")
+        size += len(event.data)
+        if size > max_file_bytes:
+            raise RequestEntityTooLarge(f"{filename} is larger than {max_file_bytes} bytes")
+        pending += decoder.decode(event.data, final=not event.more_data)
+        start = 0
+        for match in LINE_END.finditer(pending):
+            # A \r at the end of a block may be the first half of \r\n
+            if event.more_data and match.group() == '\r' and match.end() == len(pending):
+                break
+            yield pending[start:match.end()]
+            start = match.end()
+        pending = pending[start:]
+        if not event.more_data:
+            break
+    if pending:
+        yield pending
+
+def stream_uploads(stream, boundary, field='files', max_file_bytes=IMPORT_MAX_FILE_BYTES, max_request_bytes=IMPORT_MAX_REQUEST_BYTES):
+    # (filename, lines) for each file posted in field, in upload order. Each lines iterator reads
+    # straight from the request body, so it must be consumed before the next file is asked for.
+    # Other fields are skipped. Raises RequestEntityTooLarge, UnicodeDecodeError or ValueError.
+    events = multipart_events(stream, boundary, max_request_bytes)
+    for event in events:
+        if isinstance(event, File) and event.name == field and event.filename:
+            lines = file_lines(events, event.filename, max_file_bytes)
+            yield event.filename, lines
+            # Skip whatever the consumer left of this file
+            for _ in lines:
+                pass
+
+def spool_uploads(files):
+    # Writes each (filename, lines) to a new folder under IMPORT_SPOOL_FOLDER, one subfolder per
+    # file so names in the upload may repeat. Returns (folder, paths) in upload order, or
+    # (None, []) when there were no files. On any error nothing is left behind.
+    os.makedirs(IMPORT_SPOOL_FOLDER, exist_ok=True)
+    folder = tempfile.mkdtemp(prefix='upload-', dir=IMPORT_SPOOL_FOLDER)
+    paths = []
+    try:
+        for filename, lines in files:
+            path = os.path.join(folder, str(len(paths)), filename)
+            os.mkdir(os.path.dirname(path))
+            # Written back as utf-8 with the line endings kept, the file has the bytes that were uploaded
+            with open(path, 'w', encoding='utf-8', newline='') as file:
+                file.writelines(lines)
+            paths.append(path)
+    except BaseException:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+    if not paths:
+        shutil.rmtree(folder, ignore_errors=True)
+        return None, []
+    return folder, paths
+
+def remove_spooled_uploads():
+    # Spool folders left by uploads whose import jobs will never run, for server startup
+    if not os.path.isdir(IMPORT_SPOOL_FOLDER):
+        return 0
+    removed = 0
+    for entry in os.scandir(IMPORT_SPOOL_FOLDER):
+        if entry.name.startswith('upload-') and entry.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    return removed